@@ -0,0 +1,302 @@
+# final_bench.py - Benchmarks for the final_db layer on synthetic databases
+#
+# Usage:
+#   python final_bench.py generate 100k [--dir bench_data] [--seed N]
+#   python final_bench.py run 10k 100k [--dir bench_data] [--ops N]
+#                         [--output results.json] [--compare baseline.json] [--threshold 0.10]
+#
+# Sizes are post counts such as 10k, 100k or 1m. Datasets are written to
+# <dir>/posts_<size>.db and generated on first use; all of them share one
+# blob store in <dir>/blob_store. Attachments are drawn from a pool of
+# blobs with a mix of text, image and video sizes, so the store stays
+# small even for a million posts.
+#
+# Each run works on a copy of the dataset, so write benchmarks never change
+# it. Results are printed as a table and can be saved as JSON; --compare
+# reports the change against an earlier results file and exits with 1 if
+# any benchmark's p50 latency got worse by more than the threshold.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import final_blobs
+import final_db
+from final_objects import Post
+
+DEFAULT_DIR = "bench_data"
+DEFAULT_OPS = 1000
+DEFAULT_THRESHOLD = 0.10
+GENERATE_BATCH_SIZE = 10000
+
+# Attachment pool: (share of blobs, file extension, median size in bytes, spread)
+# Sizes are log-normal around the median.
+BLOB_KINDS = (
+    (0.25, ".txt", 4 * 1024, 1.0),
+    (0.60, ".jpg", 180 * 1024, 0.8),
+    (0.15, ".mp4", 3 * 1024 * 1024, 0.6),
+)
+BLOB_POOL_SIZE = 64
+MAX_BLOB_SIZE = 16 * 1024 * 1024
+
+# Share of posts with 0, 1, 2 and 3 attachments
+ATTACHMENT_COUNTS = (0.30, 0.50, 0.15, 0.05)
+
+USERS = 1000
+WORDS = ("sunset", "coffee", "beach", "game", "music", "friends", "city", "food", "travel",
+         "dog", "cat", "weekend", "study", "project", "party", "concert", "mountain", "snow")
+
+
+def parse_size(text):
+    """Turn '10k', '100k' or '1m' into a post count."""
+    text = text.strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+
+def dataset_path(data_dir, size):
+    return os.path.join(data_dir, f"posts_{size.lower()}.db")
+
+
+def make_blob_pool(rng, count=BLOB_POOL_SIZE):
+    """
+    Write the attachment pool into the blob store.
+    Returns:
+        list: (file_name, blob_hash, size) for each blob.
+    """
+    pool = []
+    for i in range(count):
+        roll, cumulative = rng.random(), 0.0
+        for share, ext, median, sigma in BLOB_KINDS:
+            cumulative += share
+            if roll <= cumulative:
+                break
+        size = min(int(rng.lognormvariate(0, sigma) * median), MAX_BLOB_SIZE)
+        data = rng.randbytes(max(size, 1))
+        blob_hash, size, _, _ = final_blobs.write_blob(data)
+        pool.append((f"file_{i}{ext}", blob_hash, size))
+    return pool
+
+
+def generate(db_path, posts, seed=0):
+    """Create a synthetic database with the given number of posts."""
+    rng = random.Random(seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    final_db.DB_PATH = db_path
+
+    pool = make_blob_pool(rng)
+    with final_db.transaction() as cursor:
+        for _, blob_hash, size in pool:
+            final_blobs.register_blob(cursor, blob_hash, size)
+
+    start = datetime.now() - timedelta(days=365)
+    started = time.perf_counter()
+    for first in range(1, posts + 1, GENERATE_BATCH_SIZE):
+        rows, attachments, comments = [], [], []
+        for post_id in range(first, min(first + GENERATE_BATCH_SIZE, posts + 1)):
+            files = rng.choices(pool, k=rng.choices(range(4), ATTACHMENT_COUNTS)[0])
+            names = [name for name, _, _ in files] + ["none.txt"] * (3 - len(files))
+            posted = start + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+            rows.append((post_id, int(rng.paretovariate(1.2)) % USERS + 1, "Image",
+                         " ".join(rng.choices(WORDS, k=rng.randint(3, 12))),
+                         posted.strftime("%Y-%m-%d %H:%M:%S"), names[0], names[1], names[2]))
+            for slot, (name, blob_hash, _) in enumerate(files, start=1):
+                attachments.append((post_id, slot, name, blob_hash))
+            for _ in range(rng.choices((0, 1, 3, 10), (0.5, 0.3, 0.15, 0.05))[0]):
+                comments.append((post_id, rng.randint(1, USERS), posted.strftime("%Y-%m-%d %H:%M:%S"),
+                                 " ".join(rng.choices(WORDS, k=rng.randint(1, 6)))))
+
+        with final_db.transaction() as cursor:
+            cursor.executemany("""
+                INSERT INTO Posts (
+                    post_id, user_id, file_type, content, post_DateTime,
+                    file_name_1, file_name_2, file_name_3
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            cursor.executemany(
+                "INSERT INTO Attachments (post_id, slot, file_name, blob_hash) VALUES (?, ?, ?, ?)", attachments)
+            cursor.executemany(
+                "INSERT INTO Comments (post_id, user_id, created_at, body) VALUES (?, ?, ?, ?)", comments)
+            views = [int(rng.paretovariate(1.1)) - 1 for _ in rows]
+            cursor.executemany(
+                "UPDATE Analytics SET views = ?, likes = ? WHERE post_id = ?",
+                [(v, rng.randint(0, v), row[0]) for v, row in zip(views, rows)])
+        print(f"  {db_path}: {post_id} / {posts} posts", end="\r")
+
+    final_db.close_all()
+    print(f"  {db_path}: {posts} posts in {time.perf_counter() - started:.1f}s")
+
+
+def measure(func, args_list):
+    """
+    Call func(*args) for each args tuple and time every call.
+    Returns:
+        dict: Operation count, total seconds, throughput and latency percentiles.
+    """
+    latencies = []
+    for args in args_list:
+        started = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - started)
+    total = sum(latencies)
+    ordered = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "total_s": round(total, 6),
+        "ops_per_s": round(len(latencies) / total, 1) if total else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 4),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 4),
+        "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 4),
+    }
+
+
+def run_benchmarks(db_path, ops=DEFAULT_OPS, seed=0):
+    """Run every benchmark on a working copy of a dataset and return the results."""
+    rng = random.Random(seed)
+    work_dir = tempfile.mkdtemp(prefix="final_bench_")
+    work_db = os.path.join(work_dir, "bench.db")
+    with sqlite3.connect(db_path) as source, sqlite3.connect(work_db) as target:
+        source.backup(target)
+    original_path, final_db.DB_PATH = final_db.DB_PATH, work_db
+    final_db.clear_cache()
+
+    try:
+        post_ids = final_db.get_post_ids()
+        random_ids = [(rng.choice(post_ids),) for _ in range(ops)]
+        hot_ids = [(rng.choice(post_ids[:20]),) for _ in range(ops)]
+        likes = [(post_id, rng.randint(1, USERS)) for (post_id,) in random_ids]
+        results = {}
+
+        results["get_all_posts"] = measure(final_db.get_all_posts, [()] * 3)
+        results["get_post_by_id"] = measure(final_db.get_post_by_id, random_ids)
+        results["get_post_by_id_hot"] = measure(final_db.get_post_by_id, hot_ids)
+        results["get_attached_files"] = measure(final_db.get_attached_files, random_ids)
+        results["increment_view"] = measure(final_db.increment_view, random_ids)
+        results["increment_like"] = measure(final_db.increment_like, likes)
+        results["flush_counters"] = measure(final_db.flush_counters, [()])
+        results["has_liked"] = measure(final_db.has_liked, likes)
+        results["ensure_analytics_for_all_posts"] = measure(final_db.ensure_analytics_for_all_posts, [()] * 3)
+
+        cursor = final_db.get_connection().execute("""
+            SELECT DISTINCT a.file_name, a.blob_hash, b.size, b.codec
+            FROM Attachments a JOIN Blobs b ON b.blob_hash = a.blob_hash LIMIT 16
+        """)
+        samples = [(name, final_blobs.open_blob(blob_hash, size, codec).read())
+                   for name, blob_hash, size, codec in cursor.fetchall()]
+        inserts = []
+        for i in range(max(1, ops // 10)):
+            post = Post(user_id=rng.randint(1, USERS), date_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        content=" ".join(rng.choices(WORDS, k=6)))
+            inserts.append((post, rng.sample(samples, k=min(len(samples), rng.randint(0, 2)))))
+        results["insert_post"] = measure(final_db.insert_post, inserts)
+
+        return {
+            "meta": {
+                "dataset": os.path.abspath(db_path),
+                "posts": len(post_ids),
+                "ops": ops,
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "date": datetime.now().isoformat(timespec="seconds"),
+            },
+            "results": results,
+        }
+    finally:
+        final_db.flush_counters()
+        final_db.close_all()
+        final_db.DB_PATH = original_path
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Print the p50 change of each benchmark against a baseline run.
+    Returns:
+        list: Names of benchmarks that regressed by more than threshold.
+    """
+    regressions = []
+    for size, run in current.items():
+        if size not in baseline:
+            continue
+        print(f"\n{size} vs baseline (p50):")
+        for name, result in run["results"].items():
+            old = baseline[size]["results"].get(name)
+            if not old or not old["p50_ms"]:
+                continue
+            change = result["p50_ms"] / old["p50_ms"] - 1
+            flag = "  REGRESSION" if change > threshold else ""
+            print(f"  {name:32} {old['p50_ms']:10.4f} -> {result['p50_ms']:10.4f} ms  {change:+.1%}{flag}")
+            if flag:
+                regressions.append(f"{size}/{name}")
+    return regressions
+
+
+def print_results(size, run):
+    print(f"\n{size}: {run['meta']['posts']} posts")
+    print(f"  {'benchmark':32} {'ops/s':>12} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, result in run["results"].items():
+        print(f"  {name:32} {result['ops_per_s'] or 0:12.1f} {result['p50_ms']:10.4f} {result['p99_ms']:10.4f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark final_db on synthetic databases.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="build a synthetic dataset")
+    gen.add_argument("size", help="number of posts, e.g. 10k, 100k or 1m")
+
+    run = sub.add_parser("run", help="run the benchmarks")
+    run.add_argument("sizes", nargs="+", help="datasets to benchmark, e.g. 10k 100k 1m")
+    run.add_argument("--ops", type=int, default=DEFAULT_OPS, help="operations per benchmark")
+    run.add_argument("--output", help="write the results to this JSON file")
+    run.add_argument("--compare", help="compare against an earlier results file")
+    run.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                     help="p50 slowdown counted as a regression (0.10 = 10%%)")
+
+    for p in (gen, run):
+        p.add_argument("--dir", default=DEFAULT_DIR, help="folder holding the datasets")
+        p.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dir, exist_ok=True)
+    final_blobs.BLOB_DIR = os.path.join(args.dir, "blob_store")
+
+    if args.command == "generate":
+        generate(dataset_path(args.dir, args.size), parse_size(args.size), args.seed)
+        return 0
+
+    results = {}
+    for size in args.sizes:
+        path = dataset_path(args.dir, size)
+        if not os.path.exists(path):
+            generate(path, parse_size(size), args.seed)
+        results[size] = run_benchmarks(path, args.ops, args.seed)
+        print_results(size, results[size])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
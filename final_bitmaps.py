@@ -0,0 +1,192 @@
+# final_bitmaps.py - Compressed bitmaps of user ids
+# A Bitmap is a set of integers from 0 to 2**32 - 1 split into chunks of
+# 65536 by their high 16 bits. A chunk with up to ARRAY_LIMIT members
+# keeps them as a sorted array of 16-bit values (2 bytes each); a fuller
+# chunk is a plain 65536-bit bitmap (8 KiB), so no chunk ever takes more
+# than 8 KiB. Looking a value up is one dict lookup and either a bit test
+# or a binary search over at most ARRAY_LIMIT values, and the number of
+# members is kept up to date, so len() is exact and free.
+# final_db stores one Bitmap per post, holding the ids of the users who
+# liked it; to_bytes()/from_bytes() convert it to and from a BLOB.
+
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+MAX_VALUE = 2 ** 32 - 1
+
+# Members above which a chunk switches from a sorted array to a bitmap
+ARRAY_LIMIT = 4096
+
+CHUNK_BYTES = 65536 // 8
+
+_MAGIC = b"BM1"
+_HEADER = struct.Struct("<3sI")    # magic, number of chunks
+_CHUNK = struct.Struct("<HBI")     # high 16 bits, kind, number of members
+_ARRAY, _DENSE = 0, 1
+
+
+def _le_array(values):
+    # Serialized arrays are little-endian whatever the machine is
+    if sys.byteorder == "big":
+        values = array("H", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class Bitmap:
+    __slots__ = ("__chunks", "__sizes", "__count")
+
+    def __init__(self, values=()):
+        self.__chunks = {}  # high 16 bits -> array("H") (sorted) or bytearray bitmap
+        self.__sizes = {}   # high 16 bits -> members in that chunk
+        self.__count = 0
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        """
+        Add a value.
+        Returns:
+            bool: True if it was not in the bitmap yet.
+        """
+        key, low = self.__split(value)
+        chunk = self.__chunks.get(key)
+        if chunk is None:
+            self.__chunks[key] = array("H", [low])
+        elif isinstance(chunk, array):
+            index = bisect_left(chunk, low)
+            if index < len(chunk) and chunk[index] == low:
+                return False
+            if len(chunk) < ARRAY_LIMIT:
+                chunk.insert(index, low)
+            else:
+                dense = bytearray(CHUNK_BYTES)
+                for member in chunk:
+                    dense[member >> 3] |= 1 << (member & 7)
+                dense[low >> 3] |= 1 << (low & 7)
+                self.__chunks[key] = dense
+        else:
+            if chunk[low >> 3] >> (low & 7) & 1:
+                return False
+            chunk[low >> 3] |= 1 << (low & 7)
+        self.__sizes[key] = self.__sizes.get(key, 0) + 1
+        self.__count += 1
+        return True
+
+    def discard(self, value):
+        """
+        Remove a value.
+        Returns:
+            bool: True if it was in the bitmap.
+        """
+        key, low = self.__split(value)
+        chunk = self.__chunks.get(key)
+        if chunk is None:
+            return False
+        if isinstance(chunk, array):
+            index = bisect_left(chunk, low)
+            if index == len(chunk) or chunk[index] != low:
+                return False
+            del chunk[index]
+        else:
+            if not chunk[low >> 3] >> (low & 7) & 1:
+                return False
+            chunk[low >> 3] &= ~(1 << (low & 7)) & 0xFF
+        self.__count -= 1
+        self.__sizes[key] -= 1
+        if not self.__sizes[key]:
+            del self.__chunks[key]
+            del self.__sizes[key]
+        elif self.__sizes[key] <= ARRAY_LIMIT and not isinstance(chunk, array):
+            self.__chunks[key] = array("H", self.__dense_members(chunk))
+        return True
+
+    def __contains__(self, value):
+        if not isinstance(value, int) or not 0 <= value <= MAX_VALUE:
+            return False
+        chunk = self.__chunks.get(value >> 16)
+        if chunk is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(chunk, array):
+            index = bisect_left(chunk, low)
+            return index < len(chunk) and chunk[index] == low
+        return bool(chunk[low >> 3] >> (low & 7) & 1)
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        for key in sorted(self.__chunks):
+            chunk = self.__chunks[key]
+            members = chunk if isinstance(chunk, array) else self.__dense_members(chunk)
+            base = key << 16
+            for low in members:
+                yield base | low
+
+    def copy(self):
+        other = Bitmap()
+        other.__chunks = {key: chunk[:] for key, chunk in self.__chunks.items()}
+        other.__sizes = dict(self.__sizes)
+        other.__count = self.__count
+        return other
+
+    def to_bytes(self):
+        """Serialize the bitmap (chunks in order, little-endian)."""
+        parts = [_HEADER.pack(_MAGIC, len(self.__chunks))]
+        for key in sorted(self.__chunks):
+            chunk = self.__chunks[key]
+            if isinstance(chunk, array):
+                parts.append(_CHUNK.pack(key, _ARRAY, len(chunk)))
+                parts.append(_le_array(chunk))
+            else:
+                parts.append(_CHUNK.pack(key, _DENSE, self.__sizes[key]))
+                parts.append(bytes(chunk))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuild a bitmap written by to_bytes(). Raises ValueError if data is not one."""
+        bitmap = cls()
+        try:
+            magic, chunk_count = _HEADER.unpack_from(data)
+            if magic != _MAGIC:
+                raise ValueError("not a bitmap")
+            offset = _HEADER.size
+            for _ in range(chunk_count):
+                key, kind, size = _CHUNK.unpack_from(data, offset)
+                offset += _CHUNK.size
+                length = 2 * size if kind == _ARRAY else CHUNK_BYTES
+                if offset + length > len(data):
+                    raise ValueError("truncated bitmap")
+                if kind == _ARRAY:
+                    chunk = array("H")
+                    chunk.frombytes(data[offset:offset + length])
+                    if sys.byteorder == "big":
+                        chunk.byteswap()
+                else:
+                    chunk = bytearray(data[offset:offset + length])
+                offset += length
+                bitmap.__chunks[key] = chunk
+                bitmap.__sizes[key] = size
+                bitmap.__count += size
+        except struct.error:
+            raise ValueError("truncated bitmap")
+        return bitmap
+
+    @staticmethod
+    def __split(value):
+        if not 0 <= value <= MAX_VALUE:
+            raise ValueError(f"Bitmap values must be between 0 and {MAX_VALUE}: {value}")
+        return value >> 16, value & 0xFFFF
+
+    @staticmethod
+    def __dense_members(chunk):
+        return [index << 3 | bit
+                for index, byte in enumerate(chunk) if byte
+                for bit in range(8) if byte >> bit & 1]
+
+    def __str__(self):
+        return f"Bitmap({self.__count} values, {len(self.__chunks)} chunks)"
@@ -0,0 +1,367 @@
+# final_blobs.py - Content-addressed storage for post attachments
+# Attachment bytes live in files named by their SHA-256 hash, so identical
+# uploads are stored once. The Blobs table keeps a reference count per hash
+# and the Attachments table maps (post_id, slot) to a stored blob; triggers
+# on Attachments keep the counts up to date (see final_schema). Blobs may be
+# stored compressed (see final_codecs); the hash is always of the original
+# bytes.
+#
+# Several databases (the shards in final_db, possibly open in several
+# processes) can share one blob folder. Removing unreferenced files and
+# checking that a newly referenced file is still there both happen under
+# gc_lock(), a lock file in the folder, so one database cannot remove a
+# file another has just started to use.
+
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import final_codecs
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+BLOB_DIR = "blob_store"
+
+# Files are streamed in and out in chunks of this size, so a large video
+# never has to fit in memory. Requests for bigger chunks are capped.
+CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _chunk_size(chunk_size):
+    """Clamp a requested chunk size to the per-request memory cap."""
+    return max(1, min(chunk_size or CHUNK_SIZE, MAX_CHUNK_SIZE))
+
+
+class BlobHandle:
+    """
+    Lazy, read-only handle to one attachment.
+    Nothing is read until view(), read(), stream() or copy_to() is called.
+    Uncompressed file-backed blobs are memory-mapped so views share pages
+    with the OS cache. Other blobs come from opener(), which returns a
+    file-like reader (decompressing compressed blobs as they are read).
+    """
+
+    def __init__(self, blob_hash=None, size=0, path=None, opener=None):
+        self.__blob_hash = blob_hash
+        self.__size = size
+        self.__path = path
+        self.__opener = opener
+        self.__map = None
+        self.__data = None
+
+    def get_hash(self):
+        return self.__blob_hash
+
+    def get_size(self):
+        return self.__size
+
+    def get_path(self):
+        return self.__path
+
+    def view(self):
+        """Return a zero-copy memoryview over the blob's bytes."""
+        if self.__path is not None:
+            if self.__size == 0:
+                return memoryview(b"")
+            if self.__map is None:
+                with open(self.__path, "rb") as f:
+                    self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.__map)
+        if self.__data is None:
+            with self.__opener() as reader:
+                self.__data = reader.read()
+        return memoryview(self.__data)
+
+    def read(self):
+        """Return a copy of the blob's bytes."""
+        return bytes(self.view())
+
+    def stream(self):
+        """Return a file-like reader over the blob (seekable unless it comes from opener())."""
+        if self.__path is not None:
+            if not self.__size:
+                return io.BytesIO(b"")
+            with open(self.__path, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__data is not None:
+            return io.BytesIO(self.__data)
+        return self.__opener()
+
+    def copy_to(self, dest, chunk_size=CHUNK_SIZE):
+        """
+        Write the blob to a binary file object one chunk at a time.
+        Returns:
+            int: Number of bytes written.
+        """
+        chunk_size = _chunk_size(chunk_size)
+        written = 0
+        with self.stream() as reader:
+            while True:
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    return written
+                dest.write(chunk)
+                written += len(chunk)
+
+    def close(self):
+        """Release the memory map, if one was opened."""
+        if self.__map is not None:
+            try:
+                self.__map.close()
+            except BufferError:
+                # A caller still holds a view; the map is freed with it
+                pass
+            self.__map = None
+        self.__data = None
+
+    def __len__(self):
+        return self.__size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return f"BlobHandle(Hash: {self.__blob_hash}, Size: {self.__size})"
+
+
+_gc_thread_lock = threading.Lock()
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after 10 seconds; keep waiting
+            pass
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def gc_lock():
+    """
+    Hold the blob folder's garbage collection lock, shared by every thread,
+    shard and process that uses the folder.
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    with _gc_thread_lock, open(os.path.join(BLOB_DIR, ".gc-lock"), "a+b") as f:
+        _lock_file(f)
+        try:
+            yield
+        finally:
+            _unlock_file(f)
+
+
+def hash_bytes(data):
+    """Return the hex SHA-256 content hash used as a blob key."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_path(blob_hash, codec=final_codecs.RAW):
+    """Return the on-disk path for a blob, fanned out by hash prefix."""
+    return os.path.join(BLOB_DIR, blob_hash[:2], blob_hash + final_codecs.get_codec(codec).suffix)
+
+
+def find_blob(blob_hash):
+    """Return the codec of the stored copy of a blob, or None if there is none."""
+    for codec in final_codecs.CODECS:
+        if os.path.exists(blob_path(blob_hash, codec)):
+            return codec
+    return None
+
+
+def write_blob(source, chunk_size=CHUNK_SIZE, codec=final_codecs.RAW):
+    """
+    Store bytes, or the contents of a binary file object, under their
+    content hash if they are not already present. File objects are hashed,
+    compressed with the given codec and written one chunk at a time. If
+    compressing saves too little the blob is stored uncompressed. The data
+    goes to a temp name and is renamed into place, so readers never see a
+    partial blob.
+    Returns:
+        tuple: (blob_hash, size, codec, stored_size); the codec and stored
+        size are those of the copy already on disk if there was one.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    chunk_size = _chunk_size(chunk_size)
+
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_DIR, prefix=".tmp-")
+    try:
+        digest = hashlib.sha256()
+        compressor = final_codecs.get_codec(codec).compressor()
+        size = stored_size = 0
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+                f.write(data)
+                stored_size += len(data)
+            data = compressor.flush()
+            f.write(data)
+            stored_size += len(data)
+
+        if codec != final_codecs.RAW and stored_size > size * (1 - final_codecs.MIN_SAVING):
+            # Not worth decompressing on every read
+            temp_path = _decompress_file(temp_path, codec, chunk_size)
+            codec, stored_size = final_codecs.RAW, size
+
+        blob_hash = digest.hexdigest()
+        existing = find_blob(blob_hash)
+        if existing is not None:
+            os.remove(temp_path)
+            return blob_hash, size, existing, os.path.getsize(blob_path(blob_hash, existing))
+        path = blob_path(blob_hash, codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return blob_hash, size, codec, stored_size
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _decompress_file(temp_path, codec, chunk_size):
+    """Replace a compressed temp file with an uncompressed one; returns the new path."""
+    fd, raw_path = tempfile.mkstemp(dir=BLOB_DIR, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f, final_codecs.open_reader(temp_path, codec) as reader:
+            while True:
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+    except BaseException:
+        os.remove(raw_path)
+        raise
+    finally:
+        os.remove(temp_path)
+    return raw_path
+
+
+def register_blob(cursor, blob_hash, size, codec=final_codecs.RAW, stored_size=None):
+    """
+    Make sure a stored blob has a row in Blobs, with the codec it was
+    written with. Reference counts are maintained by triggers when
+    Attachments rows are added or removed.
+    """
+    cursor.execute("""
+        INSERT INTO Blobs (blob_hash, size, ref_count, codec, stored_size) VALUES (?, ?, 0, ?, ?)
+        ON CONFLICT (blob_hash) DO NOTHING
+    """, (blob_hash, size, codec, size if stored_size is None else stored_size))
+
+
+def collect_garbage(cursor, in_use=None):
+    """
+    Delete blobs that are no longer referenced.
+    Must run inside a write transaction so no writer can re-reference a
+    blob between the row delete and the file removal.
+    When the blob folder is shared by several databases (see the shards in
+    final_db), in_use(blob_hash) tells whether another one still needs the
+    file; those rows are dropped but their files are kept. The check and
+    the removal happen under gc_lock(), see ensure_blob().
+    Returns:
+        int: Number of blobs removed.
+    """
+    cursor.execute("DELETE FROM Blobs WHERE ref_count <= 0 RETURNING blob_hash, codec")
+    removed = cursor.fetchall()
+    if not removed:
+        return 0
+    with gc_lock():
+        for blob_hash, codec in removed:
+            if in_use is not None and in_use(blob_hash):
+                continue
+            try:
+                os.remove(blob_path(blob_hash, codec))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Still open somewhere (Windows cannot remove open files);
+                # the row is gone, so remove_orphans() deletes it later
+                print(f"Could not remove blob {blob_hash}: {e}")
+    return len(removed)
+
+
+def remove_orphans(is_referenced, stop=None):
+    """
+    Delete blob files that no database has a row for any more, such as
+    files collect_garbage() could not remove because they were open.
+    is_referenced(blob_hash) tells whether any database still uses a hash.
+    Stops between folders once the stop event is set.
+    Returns:
+        int: Number of files removed.
+    """
+    if not os.path.isdir(BLOB_DIR):
+        return 0
+    removed = 0
+    for folder in os.scandir(BLOB_DIR):
+        if stop is not None and stop.is_set():
+            break
+        if not folder.is_dir():
+            continue
+        with gc_lock():
+            for entry in os.scandir(folder.path):
+                # Temp files are blobs still being written
+                if entry.name.startswith(".") or is_referenced(entry.name.split(".")[0]):
+                    continue
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def ensure_blob(blob_hash, codec, source):
+    """
+    Write a blob again if a garbage collection in another database removed
+    its file before our reference to it was committed. Call after the
+    commit: a collection that has not checked yet then sees the reference,
+    and one that has is finished, because both hold gc_lock().
+    source() returns the blob's bytes or a binary file object.
+    Returns:
+        bool: True if the file had to be written again.
+    """
+    with gc_lock():
+        if os.path.exists(blob_path(blob_hash, codec)):
+            return False
+        write_blob(source(), codec=codec)
+        return True
+
+
+def open_blob(blob_hash, size, codec=final_codecs.RAW):
+    """Return a lazy handle to a stored blob; compressed blobs are decompressed as they are read."""
+    path = blob_path(blob_hash, codec)
+    if codec == final_codecs.RAW:
+        return BlobHandle(blob_hash=blob_hash, size=size, path=path)
+    return BlobHandle(blob_hash=blob_hash, size=size, opener=lambda: final_codecs.open_reader(path, codec))
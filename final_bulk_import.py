@@ -0,0 +1,277 @@
+# final_bulk_import.py - Loads large batches of posts from a manifest file
+#
+# Usage: python final_bulk_import.py manifest.jsonl [--batch-size N] [--workers N] [--db PATH] [--shards N]
+#                                     [--defer-indexes]
+#
+# The manifest has one JSON object per line:
+#   {"user_id": 1, "content": "...", "file_type": "Image",
+#    "date_time": "2024-01-01 12:00:00", "files": ["photos/a.jpg", "notes.txt"]}
+# Relative file paths are resolved against the manifest's folder. Files
+# that are missing or cannot be read are reported and left out of their
+# post instead of stopping the import.
+#
+# Files are hashed, compressed into the blob store and thumbnailed in a
+# process pool. Each batch of posts is then written with executemany in a single
+# transaction that also records how far the manifest has been loaded, so
+# an interrupted import picks up where it stopped when run again. With
+# several shards every shard gets its share of the batch and keeps its own
+# checkpoint, and the shards are written in parallel. Imported posts are
+# not pushed to followers' timelines.
+#
+# --defer-indexes drops the secondary indexes on Posts and Attachments for
+# the length of the import and rebuilds them at the end, which makes very
+# large loads faster. Only use it when nothing else is using the database:
+# queries made meanwhile fall back to full table scans.
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import final_blobs
+import final_codecs
+import final_db
+import final_thumbs
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def prepare_file(path, file_type=None):
+    """
+    Store one file in the blob store and build its thumbnail (process pool worker).
+    The codec is picked from the file name and the post's file type, as for
+    posts made in the app.
+    Returns:
+        tuple: ((blob_hash, size, codec, stored_size), thumbnail bytes or None),
+        or None if the file could not be read.
+    """
+    try:
+        with open(path, "rb") as f:
+            stored = final_blobs.write_blob(f, codec=final_codecs.choose_codec(path, file_type))
+    except OSError as e:
+        print(f"Skipping {path}: {e}", file=sys.stderr)
+        return None
+    thumb = None
+    if final_thumbs.is_image(path):
+        thumb = final_thumbs.thumbnail_file(final_blobs.blob_path(stored[0], stored[2]))
+    return stored, thumb
+
+
+def read_manifest(path, start_line):
+    """Yield (line_no, entry) for each manifest entry from start_line on."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line_no < start_line or not line.strip():
+                continue
+            entry = json.loads(line)
+            entry["files"] = [os.path.join(base_dir, p) for p in entry.get("files", [])[:3]]
+            entry.setdefault("file_type", "Image")
+            yield line_no, entry
+
+
+def batches(entries, size):
+    """Group an iterator of entries into lists of at most size."""
+    batch = []
+    for item in entries:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_progress(manifest, shard=0):
+    """Return (next_line, posts, deferred index SQL) saved for a manifest in one shard."""
+    row = final_db.get_connection(shard).execute(
+        "SELECT next_line, posts, deferred_indexes FROM ImportProgress WHERE manifest = ?",
+        (manifest,)).fetchone()
+    if row is None:
+        return 0, 0, None
+    return row[0], row[1], json.loads(row[2]) if row[2] else None
+
+
+def defer_indexes(manifest, shard=0):
+    """
+    Drop the secondary indexes on the tables being loaded and remember
+    their definitions in the manifest's checkpoint row.
+    Returns:
+        list: The CREATE INDEX statements to run when the import is done.
+    """
+    with final_db.transaction(shard) as cursor:
+        cursor.execute("""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ('Posts', 'Attachments')
+        """)
+        indexes = cursor.fetchall()
+        for name, _ in indexes:
+            cursor.execute(f"DROP INDEX {name}")
+        statements = [sql for _, sql in indexes]
+        cursor.execute("""
+            INSERT INTO ImportProgress (manifest, next_line, posts, deferred_indexes) VALUES (?, 0, 0, ?)
+            ON CONFLICT (manifest) DO UPDATE SET deferred_indexes = excluded.deferred_indexes
+        """, (manifest, json.dumps(statements)))
+    return statements
+
+
+def restore_indexes(manifest, statements, shard=0):
+    """Rebuild the deferred indexes and clear them from the checkpoint."""
+    with final_db.transaction(shard) as cursor:
+        for sql in statements:
+            cursor.execute(sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+        cursor.execute("UPDATE ImportProgress SET deferred_indexes = NULL WHERE manifest = ?", (manifest,))
+
+
+def _restore_all(manifest, deferred):
+    """Rebuild the deferred indexes of every shard that has some."""
+    final_db.fan_out(lambda shard: restore_indexes(manifest, deferred[shard], shard)
+                     if deferred[shard] is not None else None)
+
+
+def write_batch(shard, manifest, batch, prepared, next_line):
+    """
+    Insert one shard's share of a batch and advance its checkpoint in one transaction.
+    Returns:
+        int: Number of posts inserted.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with final_db.transaction(shard) as cursor:
+        post_id = final_db.next_row_id(cursor, "Posts", "post_id", shard)
+        posts, blobs, attachments, thumbnails = [], {}, [], {}
+        for _, entry in batch:
+            # Files that could not be stored are left out of the post
+            paths = [p for p in entry["files"] if prepared[p, entry["file_type"]] is not None]
+            names = [os.path.basename(p) for p in paths]
+            padded = names + ["none.txt"] * (3 - len(names))
+            posts.append((post_id, entry.get("user_id", 1), entry["file_type"],
+                          entry.get("content", ""), entry.get("date_time", now),
+                          padded[0], padded[1], padded[2]))
+            for slot, (name, path) in enumerate(zip(names, paths), start=1):
+                stored, thumb = prepared[path, entry["file_type"]]
+                blob_hash = stored[0]
+                blobs[blob_hash] = stored
+                attachments.append((post_id, slot, name, blob_hash))
+                if thumb is not None:
+                    thumbnails[blob_hash] = thumb
+            # Ids in a shard step by the shard count to stay unique across shards
+            post_id += final_db.SHARD_COUNT
+
+        cursor.executemany("""
+            INSERT INTO Posts (
+                post_id, user_id, file_type, content, post_DateTime,
+                file_name_1, file_name_2, file_name_3
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, posts)
+        for stored in blobs.values():
+            final_blobs.register_blob(cursor, *stored)
+        cursor.executemany(
+            "INSERT INTO Attachments (post_id, slot, file_name, blob_hash) VALUES (?, ?, ?, ?)",
+            attachments)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO Thumbnails (blob_hash, thumb) VALUES (?, ?)", thumbnails.items())
+        cursor.execute("""
+            INSERT INTO ImportProgress (manifest, next_line, posts) VALUES (?, ?, ?)
+            ON CONFLICT (manifest) DO UPDATE SET next_line = excluded.next_line, posts = posts + excluded.posts
+        """, (manifest, next_line, len(posts)))
+    return len(posts)
+
+
+def run_import(manifest_path, batch_size=DEFAULT_BATCH_SIZE, workers=None, defer=False):
+    """
+    Import every post in a manifest, resuming from the last checkpoint.
+    With defer, the secondary indexes are dropped while loading and rebuilt
+    at the end (even if the import fails); only use it when nothing else is
+    using the database.
+    Returns:
+        int: Number of posts imported by this run.
+    """
+    manifest = os.path.abspath(manifest_path)
+    progress = final_db.fan_out(lambda shard: load_progress(manifest, shard))
+    # Each shard has its own checkpoint; start from the one furthest behind
+    done_lines = [next_line for next_line, _, _ in progress]
+    next_line = min(done_lines)
+    done_before = sum(posts for _, posts, _ in progress)
+    if next_line:
+        print(f"Resuming {manifest} at line {next_line} ({done_before} posts already imported)")
+    # Indexes left dropped by an interrupted run are rebuilt at the end, or
+    # straight away when this run does not defer them
+    deferred = [statements for _, _, statements in progress]
+    if defer:
+        deferred = [statements if statements is not None else defer_indexes(manifest, shard)
+                    for shard, statements in enumerate(deferred)]
+    else:
+        _restore_all(manifest, deferred)
+        deferred = [None] * len(deferred)
+
+    imported = 0
+    skipped = 0
+    total_bytes = 0
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in batches(read_manifest(manifest, next_line), batch_size):
+                batch_started = time.perf_counter()
+
+                # The file type can change the codec, so a file is stored once per type it is posted as
+                files = sorted({(p, entry["file_type"]) for _, entry in batch for p in entry["files"]})
+                results = pool.map(prepare_file, [p for p, _ in files], [t for _, t in files],
+                                   chunksize=max(1, len(files) // 64))
+                prepared = dict(zip(files, results))
+
+                # Lines a shard already holds from an interrupted run are skipped for it
+                by_shard = [[] for _ in final_db.shards()]
+                for line_no, entry in batch:
+                    shard = final_db.shard_for_user(entry.get("user_id", 1))
+                    if line_no >= done_lines[shard]:
+                        by_shard[shard].append((line_no, entry))
+                done_lines = [max(done, batch[-1][0] + 1) for done in done_lines]
+                written = sum(final_db.fan_out(lambda shard: write_batch(shard, manifest, by_shard[shard],
+                                                                         prepared, done_lines[shard])))
+                # A garbage collection or orphan sweep may have removed a file
+                # before the batch referencing it was committed
+                for (path, _), result in prepared.items():
+                    if result is not None:
+                        final_blobs.ensure_blob(result[0][0], result[0][2], lambda: open(path, "rb"))
+
+                batch_bytes = sum(result[0][1] for result in prepared.values() if result is not None)
+                imported += written
+                skipped += sum(result is None for result in prepared.values())
+                total_bytes += batch_bytes
+                elapsed = time.perf_counter() - batch_started
+                print(f"  {imported} posts: batch of {written} in {elapsed:.2f}s "
+                      f"({written / elapsed:.0f} posts/s, {batch_bytes / elapsed / 1e6:.1f} MB/s)")
+    finally:
+        _restore_all(manifest, deferred)
+
+    elapsed = time.perf_counter() - started
+    rate = imported / elapsed if elapsed else 0
+    print(f"Imported {imported} posts ({total_bytes / 1e6:.1f} MB) in {elapsed:.1f}s, {rate:.0f} posts/s")
+    if skipped:
+        print(f"Skipped {skipped} files that could not be read")
+    return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import posts from a JSON-lines manifest.")
+    parser.add_argument("manifest", help="path to the manifest file")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="posts written per transaction")
+    parser.add_argument("--workers", type=int, default=None, help="file preparation processes")
+    parser.add_argument("--db", default=final_db.DB_PATH, help="database file to load into")
+    parser.add_argument("--shards", type=int, default=final_db.SHARD_COUNT, help="number of database shards")
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="drop secondary indexes while loading (only when the database is not in use)")
+    args = parser.parse_args(argv)
+
+    final_db.DB_PATH = args.db
+    final_db.SHARD_COUNT = args.shards
+    run_import(args.manifest, args.batch_size, args.workers, args.defer_indexes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# final_cache.py - In-process read-through cache for database objects
+# final_db keeps recently read posts, analytics rows and attachment lists
+# here so the posts everyone is looking at are not read from disk on every
+# screen. Writes in final_db invalidate the affected entries; the TTL only
+# covers changes made by other processes (e.g. final_bulk_import.py).
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Default memory budget per cache (bytes) and entry lifetime (seconds)
+CACHE_MAX_BYTES = 4 * 1024 * 1024
+CACHE_TTL = 60.0
+
+# Stored in place of None so that "no such row" can be cached too
+_MISSING = object()
+
+
+def estimate_size(value):
+    """Rough number of bytes a cached value keeps alive."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(estimate_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    else:
+        for cls in type(value).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name.startswith("__") and not name.endswith("__"):
+                    name = f"_{cls.__name__}{name}"
+                if hasattr(value, name):
+                    size += estimate_size(getattr(value, name))
+    return size
+
+
+class ObjectCache:
+    """
+    Thread-safe LRU cache with a memory budget and a time-to-live.
+    Entries are charged estimate_size() bytes; the least recently used are
+    evicted when the total goes over max_bytes. Every invalidation bumps a
+    generation counter, and a value loaded while an invalidation happened
+    is returned but not stored, so a reader can never put back stale data.
+    """
+
+    def __init__(self, name, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> (value, cost, expires)
+        self.__total = 0
+        self.__generation = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() to fill a miss."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[2] > time.monotonic():
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    value = entry[0]
+                    return None if value is _MISSING else value
+                self.__remove(key)
+                self.__expirations += 1
+            self.__misses += 1
+            generation = self.__generation
+
+        value = loader()
+
+        with self.__lock:
+            if generation == self.__generation:
+                self.__store(key, _MISSING if value is None else value)
+        return value
+
+    def invalidate(self, *keys):
+        """Drop the given keys."""
+        with self.__lock:
+            self.__generation += 1
+            for key in keys:
+                if key in self.__entries:
+                    self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+            self.__total = 0
+
+    def configure(self, max_bytes=None, ttl=None):
+        """Change the memory budget and/or TTL, evicting entries if needed."""
+        with self.__lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if ttl is not None:
+                self.ttl = ttl
+            self.__evict()
+
+    def get_stats(self):
+        """Return hit/miss/eviction counts and current size as a dict."""
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups else 0.0,
+                "evictions": self.__evictions,
+                "expirations": self.__expirations,
+                "entries": len(self.__entries),
+                "bytes": self.__total,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __store(self, key, value):
+        if key in self.__entries:
+            self.__remove(key)
+        cost = estimate_size(key) + estimate_size(value)
+        if cost > self.max_bytes:
+            return
+        self.__entries[key] = (value, cost, time.monotonic() + self.ttl)
+        self.__total += cost
+        self.__evict()
+
+    def __evict(self):
+        while self.__total > self.max_bytes and self.__entries:
+            _, (_, cost, _) = self.__entries.popitem(last=False)
+            self.__total -= cost
+            self.__evictions += 1
+
+    def __remove(self, key):
+        _, cost, _ = self.__entries.pop(key)
+        self.__total -= cost
@@ -0,0 +1,181 @@
+# final_codecs.py - Compression codecs for attachments in the blob store
+# Each blob file is written with one codec, picked from the file's name:
+# media that is already compressed (JPEG, PNG, video, archives) is stored
+# as is, text is compressed with LZMA and everything else with zlib. A
+# compressed copy is only kept if it saves at least MIN_SAVING of the size.
+# The codec is recorded in the Blobs table and as the blob file's suffix,
+# and compressed blobs are decompressed as a stream while they are read.
+# New formats can be added with register_codec().
+
+import io
+import lzma
+import zlib
+
+RAW = "raw"
+
+# Keep a compressed copy only if it is at least this much smaller (fraction)
+MIN_SAVING = 0.05
+
+# Compressed bytes read from disk per decompression step
+READ_CHUNK_SIZE = 64 * 1024
+
+# Formats that are compressed already; another pass would only cost time
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+                     ".mp4", ".mov", ".mkv", ".webm", ".avi", ".mp3", ".m4a", ".ogg",
+                     ".zip", ".gz", ".bz2", ".xz", ".7z", ".rar", ".docx", ".xlsx", ".pptx")
+TEXT_EXTENSIONS = (".txt", ".csv", ".tsv", ".json", ".jsonl", ".log", ".md", ".html", ".htm",
+                   ".xml", ".svg", ".py", ".js", ".css", ".ini", ".yaml", ".yml")
+
+# Codec used for text, and for any other file that is not stored as is
+TEXT_CODEC = "lzma"
+DEFAULT_CODEC = "zlib"
+
+
+class _Passthrough:
+    # Compressor/decompressor that leaves the bytes unchanged
+    eof = False
+
+    def __init__(self):
+        self.unconsumed_tail = b""
+
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data, max_length=-1):
+        if max_length < 0:
+            max_length = len(data)
+        self.unconsumed_tail = bytes(data[max_length:])
+        return bytes(data[:max_length])
+
+    def flush(self):
+        return b""
+
+
+class Codec:
+    """
+    A named storage format. compressor() returns an object with
+    compress(data) and flush(); decompressor() returns one that works like
+    zlib's or lzma's: decompress(data, max_length), eof, and either
+    unconsumed_tail or needs_input. The base class stores bytes unchanged.
+    """
+    name = RAW
+    suffix = ""
+
+    def compressor(self):
+        return _Passthrough()
+
+    def decompressor(self):
+        return _Passthrough()
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    suffix = ".zz"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class LZMACodec(Codec):
+    name = "lzma"
+    suffix = ".xz"
+
+    def __init__(self, preset=6):
+        self.preset = preset
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=self.preset)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """Make a codec available for writing and reading blobs."""
+    CODECS[codec.name] = codec
+
+
+register_codec(Codec())
+register_codec(ZlibCodec())
+register_codec(LZMACodec())
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec: {name}")
+
+
+def choose_codec(file_name, file_type=None):
+    """
+    Pick the codec for a new attachment from its name, or from the post's
+    file type when the extension says nothing.
+    Returns:
+        str: The codec name.
+    """
+    name = file_name.lower()
+    if name.endswith(STORED_EXTENSIONS):
+        return RAW
+    if name.endswith(TEXT_EXTENSIONS) or file_type == "Text":
+        return TEXT_CODEC
+    return DEFAULT_CODEC
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    Read-only, forward-only file object over a compressed blob file.
+    At most one chunk of compressed input is held, and each read
+    decompresses no more than the caller's buffer can take, however well
+    the data compressed.
+    """
+
+    def __init__(self, path, codec):
+        self.__file = open(path, "rb")
+        self.__decompressor = get_codec(codec).decompressor()
+        self.__input = b""  # Compressed bytes read but not decompressed yet
+
+    def readable(self):
+        return True
+
+    def __has_output(self):
+        # lzma keeps input it has not turned into output inside the decompressor
+        return getattr(self.__decompressor, "needs_input", True) is False
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        if not size:
+            return 0
+        while not self.__decompressor.eof:
+            if not self.__input and not self.__has_output():
+                self.__input = self.__file.read(READ_CHUNK_SIZE)
+                if not self.__input:
+                    return 0
+            data = self.__decompressor.decompress(self.__input, size)
+            # zlib hands back the input it stopped at; lzma keeps it itself
+            self.__input = getattr(self.__decompressor, "unconsumed_tail", b"")
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+        return 0
+
+    def close(self):
+        if not self.closed:
+            self.__file.close()
+        super().close()
+
+
+def open_reader(path, codec):
+    """Return a buffered file object yielding a stored blob's original bytes."""
+    if codec == RAW:
+        return open(path, "rb")
+    return io.BufferedReader(DecompressingReader(path, codec), READ_CHUNK_SIZE)
@@ -1,146 +1,1570 @@
 # db.py - Handles all data interactions for the social media analytics app
 
+import atexit
+import heapq
+import io
+import math
+import os
 import sqlite3
-from final_objects import Post, Analytics
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+from final_objects import Post, Analytics, Comment, PostBatch, AnalyticsBatch, EngagementBucket
+from final_bitmaps import Bitmap
+import final_blobs
+import final_cache
+import final_codecs
+import final_schema
+import final_thumbs
+import final_trace
 
 DB_PATH = "final.db"
 
+# Number of database files posts are spread over (see SHARDS below and
+# final_shards.py). Every file records which shard it is, so this must
+# match how the database was created or split.
+SHARD_COUNT = int(os.environ.get("FINAL_DB_SHARDS", 1))
+
+# Pragmas applied once to every pooled connection when it is opened.
+# WAL lets readers keep going while a writer commits, and NORMAL sync is
+# still crash-safe under WAL while skipping an fsync on every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Size of sqlite3's per-connection prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+# ================== CONNECTION POOL ==================
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection that remembers whether it has been closed and, while
+    tracing is on, hands out final_trace.TracedCursor cursors.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        super().close()
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = final_trace.TracedCursor if final_trace.enabled else sqlite3.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        if final_trace.enabled:
+            return self.cursor().execute(sql, parameters)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if final_trace.enabled:
+            return self.cursor().executemany(sql, seq_of_parameters)
+        return super().executemany(sql, seq_of_parameters)
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_open_connections = weakref.WeakSet()
+_migrated_paths = set()
+
+def _open_connection(path, shard=0):
+    """Open and tune a new pooled connection to the given database file."""
+    conn = sqlite3.connect(
+        path,
+        factory=PooledConnection,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    if final_trace.enabled:
+        conn.set_trace_callback(final_trace.trace_statement)
+    with _pool_lock:
+        # Create or upgrade the schema the first time a path is opened
+        if path not in _migrated_paths:
+            final_schema.migrate(conn)
+            _check_shard_info(conn, path, shard)
+            _migrated_paths.add(path)
+        _open_connections.add(conn)
+    return conn
+
+def _thread_state():
+    """The calling thread's connections and transaction depths, keyed by path."""
+    if not hasattr(_local, "conns"):
+        _local.conns = {}
+        _local.depths = {}
+    return _local.conns, _local.depths
+
+def get_connection(shard=0):
+    """
+    Return the calling thread's long-lived connection to a shard, opening it
+    on first use. Connections run in autocommit mode; use transaction() to
+    group statements.
+    """
+    path = shard_path(shard)
+    conns, depths = _thread_state()
+    conn = conns.get(path)
+    if conn is None or conn.closed:
+        if not 0 <= shard < SHARD_COUNT:
+            raise ValueError(f"shard {shard} does not exist, SHARD_COUNT is {SHARD_COUNT}")
+        conn = conns[path] = _open_connection(path, shard)
+        depths[path] = 0
+    return conn
+
+@contextmanager
+def transaction(shard=0):
+    """
+    Run a block of statements in a single write transaction on one shard.
+    Yields a cursor; commits on success and rolls back on error.
+    Nested calls on the same shard join the outer transaction.
+    """
+    conn = get_connection(shard)
+    path = shard_path(shard)
+    _, depths = _thread_state()
+    if depths[path]:
+        depths[path] += 1
+        try:
+            yield conn.cursor()
+        finally:
+            depths[path] -= 1
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    depths[path] = 1
+    try:
+        yield conn.cursor()
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        depths[path] = 0
+
+def close_all():
+    """
+    Close every pooled connection, e.g. on shutdown or after changing
+    DB_PATH or SHARD_COUNT. Files are checked again when next opened.
+    """
+    with _pool_lock:
+        connections = list(_open_connections)
+        _open_connections.clear()
+        _migrated_paths.clear()
+    for conn in connections:
+        if not conn.closed:
+            conn.close()
+    _local.conns = {}
+    _local.depths = {}
+
+def enable_tracing(slow_query_ms=None):
+    """
+    Start recording query timings, row and BLOB byte counts, function
+    latencies and slow queries (see final_trace).
+    """
+    if slow_query_ms is not None:
+        final_trace.SLOW_QUERY_MS = slow_query_ms
+    final_trace.enabled = True
+    with _pool_lock:
+        connections = list(_open_connections)
+    for conn in connections:
+        if not conn.closed:
+            conn.set_trace_callback(final_trace.trace_statement)
+
+def disable_tracing():
+    """Stop recording; what was recorded stays available from final_trace.get_stats()."""
+    final_trace.enabled = False
+    with _pool_lock:
+        connections = list(_open_connections)
+    for conn in connections:
+        if not conn.closed:
+            conn.set_trace_callback(None)
+
 def connect():
-    """Connect to the database and return the connection and cursor."""
+    """Open a standalone connection and cursor. Prefer get_connection()."""
     conn = sqlite3.connect(DB_PATH)
     return conn, conn.cursor()
 
+# ================== SHARDS ==================
+#
+# Posts can be spread over SHARD_COUNT database files. Shard 0 is DB_PATH
+# and shard i is DB_PATH with ".shard<i>" before the extension. A post
+# lives, together with its analytics, comments, attachments and events, in
+# shard post_id % SHARD_COUNT. New posts go to the shard of their user, and
+# their ids are handed out so that id % SHARD_COUNT is that shard, which
+# keeps ids unique across all files. Reads that cover every post run on
+# each shard in parallel and the results are merged in order.
+
+# Threads used to query the shards in parallel
+FAN_OUT_WORKERS = 8
+
+_fan_out_pool = None
+
+def shard_path(shard):
+    """Return the database file holding a shard."""
+    if shard == 0:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.shard{shard}{ext}"
+
+def shard_for_post(post_id):
+    """Return the shard a post (and everything attached to it) is stored in."""
+    return post_id % SHARD_COUNT
+
+def shard_for_user(user_id):
+    """Return the shard new posts by a user are written to."""
+    return (user_id or 0) % SHARD_COUNT
+
+def shards():
+    return range(SHARD_COUNT)
+
+def fan_out(func, *args):
+    """
+    Call func(shard, *args) for every shard, in parallel when there is more
+    than one, and return the results in shard order.
+    """
+    global _fan_out_pool
+    if SHARD_COUNT == 1:
+        return [func(0, *args)]
+    with _pool_lock:
+        if _fan_out_pool is None:
+            _fan_out_pool = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="db-shard")
+    try:
+        futures = [_fan_out_pool.submit(func, shard, *args) for shard in shards()]
+    except RuntimeError:
+        # The pool stops taking work while the interpreter exits; shutdown() still runs
+        return [func(shard, *args) for shard in shards()]
+    return [future.result() for future in futures]
+
+def _check_shard_info(conn, path, shard):
+    """Record which shard a file is, or refuse to use it as a different one."""
+    row = conn.execute("SELECT shard_index, shard_count FROM ShardInfo WHERE id = 1").fetchone()
+    if row is None:
+        if SHARD_COUNT > 1 and conn.execute("SELECT EXISTS (SELECT 1 FROM Posts)").fetchone()[0]:
+            raise sqlite3.DatabaseError(
+                f"{path} holds posts but was never sharded; run final_shards.py split {SHARD_COUNT}")
+        conn.execute("INSERT OR IGNORE INTO ShardInfo (id, shard_index, shard_count) VALUES (1, ?, ?)",
+                     (shard, SHARD_COUNT))
+        row = conn.execute("SELECT shard_index, shard_count FROM ShardInfo WHERE id = 1").fetchone()
+    if tuple(row) != (shard, SHARD_COUNT):
+        raise sqlite3.DatabaseError(
+            f"{path} is shard {row[0]} of {row[1]}, but was opened as shard {shard} of {SHARD_COUNT}")
+
+def _fetch_all(shard, sql, params=()):
+    return get_connection(shard).execute(sql, params).fetchall()
+
+def _query_in_order(sql, params=(), limit=-1, key=itemgetter(0), reverse=False):
+    """
+    Run a SELECT ordered by its first column (or by key, descending when
+    reverse is set) on every shard and return an iterator over all rows in
+    that order, stopping after limit rows.
+    """
+    if SHARD_COUNT == 1:
+        return get_connection().execute(sql, params)
+    rows = heapq.merge(*fan_out(_fetch_all, sql, params), key=key, reverse=reverse)
+    return islice(rows, limit) if limit >= 0 else rows
+
+def next_row_id(cursor, table, column, shard=0):
+    """
+    Return the first unused id of an AUTOINCREMENT table in a shard, never
+    reusing an id below the table's high-water mark. With several shards
+    the id is rounded up so that id % SHARD_COUNT == shard; step by
+    SHARD_COUNT to allocate more. Call inside the shard's transaction.
+    """
+    cursor.execute(f"""
+        SELECT MAX(COALESCE((SELECT MAX({column}) FROM {table}), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name = '{table}'), 0))
+    """)
+    next_id = cursor.fetchone()[0] + 1
+    return next_id + (shard - next_id) % SHARD_COUNT
+
+def _blob_in_other_shards(shard):
+    """
+    Return a check for collect_garbage() that keeps a blob's file while any
+    other shard still has a row for it (the blob store folder is shared).
+    """
+    def in_use(blob_hash):
+        for other in shards():
+            if other != shard and get_connection(other).execute(
+                    "SELECT 1 FROM Blobs WHERE blob_hash = ?", (blob_hash,)).fetchone():
+                return True
+        return False
+    return in_use if SHARD_COUNT > 1 else None
+
+def remove_orphan_blobs(stop=None):
+    """
+    Delete blob files that no shard references, e.g. ones that were still
+    open when their last post was deleted (see final_blobs.remove_orphans).
+    Returns:
+        int: Number of files removed.
+    """
+    def is_referenced(blob_hash):
+        return any(get_connection(shard).execute(
+            "SELECT 1 FROM Blobs WHERE blob_hash = ?", (blob_hash,)).fetchone() for shard in shards())
+    return final_blobs.remove_orphans(is_referenced, stop)
+
+# ================== OBJECT CACHE ==================
+
+# Analytics change all the time, so other processes' updates should show up sooner
+ANALYTICS_CACHE_TTL = 10.0
+
+_post_cache = final_cache.ObjectCache("posts")
+_analytics_cache = final_cache.ObjectCache("analytics", ttl=ANALYTICS_CACHE_TTL)
+_attachment_cache = final_cache.ObjectCache("attachments")
+_likes_cache = final_cache.ObjectCache("likes")
+_caches = (_post_cache, _analytics_cache, _attachment_cache, _likes_cache)
+
+def _cache_key(post_id):
+    # Entries are keyed by database file as well, so changing DB_PATH never serves another file's rows
+    return (DB_PATH, post_id)
+
+def invalidate_post_cache(post_id):
+    """Drop a post's cached Post, analytics row, attachment list and likers."""
+    key = _cache_key(post_id)
+    for cache in _caches:
+        cache.invalidate(key)
+
+def configure_cache(max_bytes=None, ttl=None):
+    """Set the memory budget (bytes, per cache) and/or TTL (seconds) of the object caches."""
+    for cache in _caches:
+        cache.configure(max_bytes, ttl)
+
+def clear_cache():
+    """Empty the object caches."""
+    for cache in _caches:
+        cache.clear()
+
+def cache_stats():
+    """Return hit/miss/eviction statistics for each object cache, keyed by cache name."""
+    return {cache.name: cache.get_stats() for cache in _caches}
+
 # ================== POST FUNCTIONS ==================
 
-def get_all_posts():
-    """Retrieve all posts from the Posts table."""
-    conn, cursor = connect()
-    cursor.execute("SELECT * FROM Posts ORDER BY post_id ASC")
-    rows = cursor.fetchall()
-    conn.close()
+# Metadata columns only; attachment bytes are never pulled in with a post
+POST_COLUMNS = "post_id, user_id, content, post_DateTime"
 
-    posts = []
-    for row in rows:
-        post = Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
-        posts.append(post)
-    return posts
+# Default number of posts fetched per keyset page
+PAGE_SIZE = 500
 
+# Stay below SQLite's limit on bound parameters per statement
+MAX_IDS_PER_QUERY = 500
+
+def _row_to_post(row):
+    """Build a Post from a row of POST_COLUMNS."""
+    return Post(post_id=row[0], user_id=row[1], date_time=row[3], content=row[2])
+
+def _iter_shard_posts(shard, page_size=PAGE_SIZE, after_id=0):
+    """Yield one shard's posts in post_id order, one keyset page at a time."""
+    last_id = after_id
+    while True:
+        cursor = get_connection(shard).execute(
+            f"SELECT {POST_COLUMNS} FROM Posts WHERE post_id > ? ORDER BY post_id ASC LIMIT ?",
+            (last_id, page_size))
+        rows = cursor.fetchall()
+        for row in rows:
+            yield _row_to_post(row)
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+def iter_posts(page_size=PAGE_SIZE, after_id=0):
+    """
+    Yield posts in post_id order, one keyset page at a time.
+    Only one page of rows per shard is held in memory, however large the table is.
+    Args:
+        page_size (int): Number of posts fetched per query.
+        after_id (int): Start after this post_id.
+    """
+    if SHARD_COUNT == 1:
+        return _iter_shard_posts(0, page_size, after_id)
+    return heapq.merge(*(_iter_shard_posts(shard, page_size, after_id) for shard in shards()),
+                       key=Post.get_post_id)
+
+@final_trace.timed
+def get_all_posts():
+    """Retrieve all posts from the Posts table (every shard, read in parallel)."""
+    if SHARD_COUNT == 1:
+        return list(iter_posts())
+    return list(heapq.merge(*fan_out(lambda shard: list(_iter_shard_posts(shard))), key=Post.get_post_id))
+
+@final_trace.timed
 def get_post_by_id(post_id):
-    """Retrieve a single post by ID."""
-    conn, cursor = connect()
-    cursor.execute("SELECT * FROM Posts WHERE post_id = ?", (post_id,))
-    row = cursor.fetchone()
-    conn.close()
+    """Retrieve a single post by ID (served from the post cache when possible)."""
+    def load():
+        cursor = get_connection(shard_for_post(post_id)).execute(
+            f"SELECT {POST_COLUMNS} FROM Posts WHERE post_id = ?", (post_id,))
+        row = cursor.fetchone()
 
-    if row:
-        return Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
-    return None
+        if row:
+            return _row_to_post(row)
+        return None
+
+    return _post_cache.get_or_load(_cache_key(post_id), load)
+
+@final_trace.timed
+def get_post_ids():
+    """Retrieve every post_id in ascending order, e.g. for navigation."""
+    return [row[0] for row in _query_in_order("SELECT post_id FROM Posts ORDER BY post_id ASC")]
+
+@final_trace.timed
+def get_posts_by_ids(post_ids):
+    """
+    Retrieve many posts at once.
+    Returns:
+        list: Posts in the order of post_ids; missing ids are skipped.
+    """
+    post_ids = list(post_ids)
+    by_shard = {}
+    for pid in post_ids:
+        by_shard.setdefault(shard_for_post(pid), []).append(pid)
+
+    def load(shard):
+        ids = by_shard.get(shard, [])
+        rows = []
+        for i in range(0, len(ids), MAX_IDS_PER_QUERY):
+            chunk = ids[i:i + MAX_IDS_PER_QUERY]
+            placeholders = ", ".join("?" * len(chunk))
+            rows += _fetch_all(shard, f"SELECT {POST_COLUMNS} FROM Posts WHERE post_id IN ({placeholders})", chunk)
+        return rows
+
+    found = {}
+    for rows in fan_out(load):
+        for row in rows:
+            found[row[0]] = _row_to_post(row)
+    return [found[pid] for pid in post_ids if pid in found]
 
-def insert_post(post, files):
+@final_trace.timed
+def insert_post(post, files, file_type="Image"):
     """
     Insert a new post and its files into the database.
+    File contents go to the blob store, compressed in parallel with the
+    codec picked for each file type; the Posts row only keeps the names.
+    The Analytics row and post_ts are filled in by triggers. The post is
+    written to its user's shard and then pushed to the timelines of the
+    user's followers (see FEED FUNCTIONS).
     Args:
         post (Post): A Post object containing metadata.
         files (list): A list of (file_name, file_content) tuples, up to 3.
+            file_content may be bytes or a binary file object; file objects
+            are streamed into the blob store in chunks.
+        file_type (str): The file type chosen for the post.
     Returns:
         int: The newly inserted post_id.
     """
-    conn, cursor = connect()
-
     try:
-        padded_files = files + [("none.txt", None)] * (3 - len(files))
-        cursor.execute("""
-            INSERT INTO Posts (
-                user_id, file_type, content, post_DateTime,
-                file_name_1, file_content_1,
-                file_name_2, file_content_2,
-                file_name_3, file_content_3
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            post.get_user_id(), "Image", post.get_content(), post.get_date_time(),
-            padded_files[0][0], padded_files[0][1],
-            padded_files[1][0], padded_files[1][1],
-            padded_files[2][0], padded_files[2][1]
-        ))
-        post_id = cursor.lastrowid
-
-        cursor.execute("INSERT INTO Analytics (post_id, views, likes) VALUES (?, 0, 0)", (post_id,))
-        conn.commit()
-        return post_id
+        shard = shard_for_user(post.get_user_id())
+
+        # Write blob files and build thumbnails before taking the write lock
+        stored = _store_files(files[:3], file_type)
+        thumbnails = {}
+        for name, (blob_hash, _, codec, _) in stored:
+            if final_thumbs.is_image(name) and blob_hash not in thumbnails and not _fetch_all(
+                    shard, "SELECT 1 FROM Thumbnails WHERE blob_hash = ?", (blob_hash,)):
+                thumbnails[blob_hash] = final_thumbs.thumbnail_file(final_blobs.blob_path(blob_hash, codec))
+
+        with transaction(shard) as cursor:
+            post_id = next_row_id(cursor, "Posts", "post_id", shard)
+            names = [name for name, _ in stored] + ["none.txt"] * (3 - len(stored))
+            cursor.execute("""
+                INSERT INTO Posts (
+                    post_id, user_id, file_type, content, post_DateTime,
+                    file_name_1, file_name_2, file_name_3
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                post_id, post.get_user_id(), file_type, post.get_content(), post.get_date_time(),
+                names[0], names[1], names[2]
+            ))
+            cursor.execute("SELECT post_ts FROM Posts WHERE post_id = ?", (post_id,))
+            post_ts = cursor.fetchone()[0]
+
+            for slot, (name, (blob_hash, size, codec, stored_size)) in enumerate(stored, start=1):
+                final_blobs.register_blob(cursor, blob_hash, size, codec, stored_size)
+                cursor.execute(
+                    "INSERT INTO Attachments (post_id, slot, file_name, blob_hash) VALUES (?, ?, ?, ?)",
+                    (post_id, slot, name, blob_hash))
+
+            for blob_hash, thumb in thumbnails.items():
+                if thumb is not None:
+                    cursor.execute("INSERT OR IGNORE INTO Thumbnails (blob_hash, thumb) VALUES (?, ?)",
+                                   (blob_hash, thumb))
+
+        # A garbage collection in another shard may have removed a blob we
+        # wrote before our reference was committed; make sure it is on disk
+        for (_, (blob_hash, _, codec, _)), (_, content) in zip(stored, files):
+            final_blobs.ensure_blob(blob_hash, codec, _rewound(content))
+        invalidate_post_cache(post_id)
     except Exception as e:
         print("Error inserting post:", e)
-        conn.rollback()
         return None
-    finally:
-        conn.close()
 
+    if TIMELINE_FANOUT:
+        try:
+            _push_to_timelines(post_id, post.get_user_id(), post_ts)
+        except Exception as e:
+            # The post is saved; only the followers' cached timelines miss it
+            print("Error updating timelines:", e)
+    return post_id
+
+def _rewound(content):
+    """Return a source for final_blobs.ensure_blob() that reads content from the start."""
+    def source():
+        if hasattr(content, "seek"):
+            content.seek(0)
+        return content
+    return source
+
+@final_trace.timed
 def delete_post(post_id):
-    """Delete a post and its associated analytics."""
-    conn, cursor = connect()
-    cursor.execute("DELETE FROM Analytics WHERE post_id = ?", (post_id,))
-    cursor.execute("DELETE FROM Posts WHERE post_id = ?", (post_id,))
-    conn.commit()
-    conn.close()
+    """
+    Delete a post. Its analytics and attachments cascade with it, and
+    stored files that are no longer referenced are removed. It is also
+    taken out of the followers' timelines, which may be in any shard.
+    """
+    shard = shard_for_post(post_id)
+    with transaction(shard) as cursor:
+        cursor.execute("DELETE FROM Posts WHERE post_id = ?", (post_id,))
+        final_blobs.collect_garbage(cursor, _blob_in_other_shards(shard))
+    invalidate_post_cache(post_id)
+    fan_out(_remove_from_timelines, post_id)
+
+@final_trace.timed
+def migrate_inline_attachments(batch_size=50, stop=None):
+    """
+    Move file contents still stored inline in Posts into the blob store.
+    Each file is streamed out of its column in chunks, so only one chunk is
+    in memory at a time, and written to the blob store before the shard's
+    write lock is taken. Every post is committed on its own, so an
+    interrupted run carries on where it stopped; it stops early once the
+    stop event (a threading.Event) is set.
+    Run backfill_thumbnails() afterwards to build their thumbnails.
+    Returns:
+        int: Number of posts migrated.
+    """
+    return sum(fan_out(_migrate_shard_inline, batch_size, stop))
+
+def _migrate_shard_inline(shard, batch_size, stop):
+    migrated = 0
+    while stop is None or not stop.is_set():
+        cursor = get_connection(shard).execute("""
+            SELECT post_id FROM Posts
+            WHERE file_content_1 IS NOT NULL OR file_content_2 IS NOT NULL OR file_content_3 IS NOT NULL
+            LIMIT ?
+        """, (batch_size,))
+        post_ids = [row[0] for row in cursor.fetchall()]
+        if not post_ids:
+            break
+        for pid in post_ids:
+            if stop is not None and stop.is_set():
+                break
+            _migrate_post_inline(shard, pid)
+            migrated += 1
+    return migrated
+
+def _migrate_post_inline(shard, post_id):
+    """Move one post's inline files into the blob store."""
+    row = get_connection(shard).execute("""
+        SELECT file_type, file_name_1, length(file_content_1),
+               file_name_2, length(file_content_2),
+               file_name_3, length(file_content_3)
+        FROM Posts WHERE post_id = ?
+    """, (post_id,)).fetchone()
+    if row is None:
+        return
+    stored = {}
+    for slot in range(1, 4):
+        name, length = row[slot * 2 - 1], row[slot * 2]
+        if name and length:
+            with _inline_opener(post_id, slot)() as reader:
+                stored[slot] = (name, final_blobs.write_blob(
+                    reader, codec=final_codecs.choose_codec(name, row[0])))
+
+    # The inline copy is kept until the blob references are committed, so
+    # a file removed by a concurrent garbage collection can be written again
+    with transaction(shard) as cursor:
+        if not cursor.execute("SELECT 1 FROM Posts WHERE post_id = ?", (post_id,)).fetchone():
+            return
+        for slot, (name, blob) in stored.items():
+            final_blobs.register_blob(cursor, *blob)
+            cursor.execute("DELETE FROM Attachments WHERE post_id = ? AND slot = ?", (post_id, slot))
+            cursor.execute(
+                "INSERT INTO Attachments (post_id, slot, file_name, blob_hash) VALUES (?, ?, ?, ?)",
+                (post_id, slot, name, blob[0]))
+    for slot, (_, (blob_hash, _, codec, _)) in stored.items():
+        final_blobs.ensure_blob(blob_hash, codec, _inline_opener(post_id, slot))
+    with transaction(shard) as cursor:
+        cursor.execute("""
+            UPDATE Posts SET file_content_1 = NULL, file_content_2 = NULL, file_content_3 = NULL
+            WHERE post_id = ?
+        """, (post_id,))
+    _attachment_cache.invalidate(_cache_key(post_id))
+
+# ================== ENGAGEMENT EVENTS ==================
+
+# Event kinds stored in Events.kind
+EVENT_VIEW = 1
+EVENT_LIKE = 2
+EVENT_COMMENT = 3
+
+# Rollup table and bucket width in seconds for each granularity
+ROLLUPS = {
+    "hour": ("EngagementHourly", 3600),
+    "day": ("EngagementDaily", 86400),
+}
+
+# Events folded into the rollups per compaction transaction
+COMPACT_BATCH_SIZE = 50000
+
+@final_trace.timed
+def compact_events(batch_size=COMPACT_BATCH_SIZE):
+    """
+    Fold events that arrived since the last run into the hourly and daily
+    rollups. Each batch updates both rollups and the compaction checkpoint
+    in one transaction, so every event is counted exactly once.
+    Shards are compacted in parallel.
+    Returns:
+        int: Number of event rows compacted.
+    """
+    return sum(fan_out(_compact_shard, batch_size))
+
+def _compact_shard(shard, batch_size):
+    last, newest = get_connection(shard).execute(
+        "SELECT last_event_id, (SELECT MAX(event_id) FROM Events) FROM EventRollupState WHERE id = 1"
+    ).fetchone()
+    if newest is None or newest <= last:
+        return 0
+
+    compacted = 0
+    while True:
+        with transaction(shard) as cursor:
+            # Read the checkpoint again now that we hold the write lock
+            cursor.execute("SELECT last_event_id FROM EventRollupState WHERE id = 1")
+            last = cursor.fetchone()[0]
+            cursor.execute("""
+                SELECT MAX(event_id), COUNT(*) FROM (
+                    SELECT event_id FROM Events WHERE event_id > ? ORDER BY event_id LIMIT ?
+                )
+            """, (last, batch_size))
+            upto, count = cursor.fetchone()
+            if upto is None:
+                return compacted
+            for table, width in ROLLUPS.values():
+                cursor.execute(f"""
+                    INSERT INTO {table} (post_id, bucket, views, likes, comments)
+                    SELECT post_id, ts - ts % {width},
+                           SUM(CASE kind WHEN {EVENT_VIEW} THEN n ELSE 0 END),
+                           SUM(CASE kind WHEN {EVENT_LIKE} THEN n ELSE 0 END),
+                           SUM(CASE kind WHEN {EVENT_COMMENT} THEN n ELSE 0 END)
+                    FROM Events WHERE event_id > ? AND event_id <= ?
+                    GROUP BY post_id, ts - ts % {width}
+                    ON CONFLICT (post_id, bucket) DO UPDATE SET
+                        views = views + excluded.views,
+                        likes = likes + excluded.likes,
+                        comments = comments + excluded.comments
+                """, (last, upto))
+            cursor.execute("UPDATE EventRollupState SET last_event_id = ? WHERE id = 1", (upto,))
+        compacted += count
+
+@final_trace.timed
+def get_engagement(start, end, post_id=None, granularity="hour"):
+    """
+    Count views, likes and comments per hour or day between two datetimes.
+    Reads only the rollup tables; buffered increments are flushed and new
+    events compacted first. Buckets with no activity are left out, and day
+    buckets follow UTC days.
+    Args:
+        start (datetime): First moment to include (rounded down to its bucket).
+        end (datetime): Stop before this moment.
+        post_id (int): One post, or None for all posts together.
+        granularity (str): "hour" or "day".
+    Returns:
+        list: EngagementBucket objects, oldest first.
+    """
+    table, width = ROLLUPS[granularity]
+    flush_counters()
+    compact_events()
+
+    start_ts = int(start.timestamp()) // width * width
+    end_ts = int(end.timestamp())
+    if post_id is None:
+        totals = {}
+        for rows in fan_out(_fetch_all, f"""
+            SELECT bucket, SUM(views), SUM(likes), SUM(comments) FROM {table}
+            WHERE bucket >= ? AND bucket < ?
+            GROUP BY bucket
+        """, (start_ts, end_ts)):
+            for bucket, views, likes, comments in rows:
+                total = totals.setdefault(bucket, [0, 0, 0])
+                total[0] += views
+                total[1] += likes
+                total[2] += comments
+        rows = [(bucket,) + tuple(total) for bucket, total in sorted(totals.items())]
+    else:
+        rows = _fetch_all(shard_for_post(post_id), f"""
+            SELECT bucket, views, likes, comments FROM {table}
+            WHERE post_id = ? AND bucket >= ? AND bucket < ?
+            ORDER BY bucket
+        """, (post_id, start_ts, end_ts))
+    return [EngagementBucket(start=datetime.fromtimestamp(row[0]), views=row[1], likes=row[2], comments=row[3])
+            for row in rows]
+
+# ================== WRITE-BEHIND COUNTERS ==================
+
+# Flush once this many increments are pending...
+FLUSH_THRESHOLD = 500
+# ...or after this many seconds, whichever comes first
+FLUSH_INTERVAL = 2.0
+
+class CounterBuffer:
+    """
+    Accumulates view/like increments in memory, coalesced per post_id, and
+    writes them to Analytics in one executemany transaction from a
+    background thread. Pending deltas are visible through pending_for().
+    The same transaction appends the increments to the Events log, with
+    identical events in the same second stored as one row. Likes and
+    unlikes are kept per user, and the same transaction applies them to
+    each post's PostLikes bitmap. With several shards each shard gets its
+    own transaction.
+    """
+
+    def __init__(self, flush_threshold=FLUSH_THRESHOLD, flush_interval=FLUSH_INTERVAL):
+        self.flush_threshold = flush_threshold
+        self.flush_interval = flush_interval
+        self.__lock = threading.RLock()
+        self.__pending = {}  # post_id -> [views, likes]
+        self.__events = {}   # (post_id, kind, ts) -> n
+        self.__likes = {}    # post_id -> {user_id: liked}
+        self.__in_flight = []  # (pending, events, likes) being written by flush()
+        self.__flush_lock = threading.Lock()
+        self.__count = 0
+        self.__wake = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+
+    def add(self, post_id, views=0, likes=0):
+        """Queue an increment for a post."""
+        with self.__lock:
+            entry = self.__pending.setdefault(post_id, [0, 0])
+            entry[0] += views
+            entry[1] += likes
+            now = int(time.time())
+            if views:
+                key = (post_id, EVENT_VIEW, now)
+                self.__events[key] = self.__events.get(key, 0) + views
+            if likes:
+                key = (post_id, EVENT_LIKE, now)
+                self.__events[key] = self.__events.get(key, 0) + likes
+            self.__count += 1
+            full = self.__count >= self.flush_threshold
+            if self.__thread is None and not self.__stopped:
+                self.__thread = threading.Thread(target=self.__run, name="counter-flusher", daemon=True)
+                self.__thread.start()
+        if full:
+            self.__wake.set()
+
+    def set_liked(self, post_id, user_id, liked):
+        """
+        Queue a like (or unlike) by a user, counted as a like delta of +1
+        (or -1). Only call it when this changes whether the user likes the post.
+        """
+        with self.__lock:
+            self.__likes.setdefault(post_id, {})[user_id] = liked
+            self.add(post_id, likes=1 if liked else -1)
+
+    def pending_like(self, post_id, user_id):
+        """Return whether a queued change makes the user like the post, or None if there is none."""
+        with self.__lock:
+            for likes in [self.__likes] + [batch[2] for batch in reversed(self.__in_flight)]:
+                liked = likes.get(post_id, {}).get(user_id)
+                if liked is not None:
+                    return liked
+            return None
+
+    def pending_for(self, post_id):
+        """Return the (views, likes) deltas not yet written for a post, including those being flushed."""
+        with self.__lock:
+            views, likes = self.__pending.get(post_id, (0, 0))
+            for pending, _, _ in self.__in_flight:
+                in_flight = pending.get(post_id, (0, 0))
+                views += in_flight[0]
+                likes += in_flight[1]
+        return views, likes
+
+    def read_through(self, read):
+        """
+        Call read() while no flush can commit, so its result and
+        pending_for() describe the same moment and no delta is counted
+        twice or missed.
+        """
+        with self.__lock:
+            return read()
+
+    def flush(self):
+        """
+        Write all pending increments, one transaction per shard.
+        The pending deltas are taken out under the lock and kept as an
+        in-flight batch, which pending_for() and pending_like() still
+        include, so increments and reads never wait for SQLite to take
+        its write lock. Only the COMMIT runs under the lock, so readers
+        never see a shard's deltas both in the database and in flight.
+        If a shard fails, whatever was not written is merged back.
+        Returns:
+            int: Number of posts updated.
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                if not self.__pending:
+                    return 0
+                batch = (self.__pending, self.__events, self.__likes)
+                self.__pending, self.__events, self.__likes = {}, {}, {}
+                self.__count = 0
+                self.__in_flight.append(batch)
+
+            pending, events, likes = batch
+            by_shard = {}
+            for pid, (views, like_delta) in pending.items():
+                by_shard.setdefault(shard_for_post(pid), ([], []))[0].append((views, like_delta, pid))
+            for key, n in events.items():
+                by_shard[shard_for_post(key[0])][1].append(key + (n,))
+
+            updated = 0
+            try:
+                for shard, (rows, shard_events) in sorted(by_shard.items()):
+                    pids = [pid for _, _, pid in rows]
+                    locked = False
+                    try:
+                        with transaction(shard) as cursor:
+                            cursor.executemany(
+                                "UPDATE Analytics SET views = views + ?, likes = likes + ? WHERE post_id = ?", rows)
+                            cursor.executemany(
+                                "INSERT INTO Events (post_id, kind, ts, n) VALUES (?, ?, ?, ?)", shard_events)
+                            for pid in pids:
+                                if pid in likes:
+                                    _save_likes(cursor, pid, likes[pid])
+                            # Held until the commit below is done
+                            self.__lock.acquire()
+                            locked = True
+                        # Forget each shard's deltas as soon as they are written, so a
+                        # failure on a later shard never writes them twice
+                        keys = [_cache_key(pid) for pid in pids]
+                        _analytics_cache.invalidate(*keys)
+                        _likes_cache.invalidate(*keys)
+                        for pid in pids:
+                            del pending[pid]
+                            likes.pop(pid, None)
+                        for event in shard_events:
+                            del events[event[:3]]
+                    finally:
+                        if locked:
+                            self.__lock.release()
+                    updated += len(rows)
+            except BaseException:
+                with self.__lock:
+                    self.__merge_back(batch)
+                raise
+            finally:
+                with self.__lock:
+                    self.__in_flight.remove(batch)
+            return updated
+
+    def __merge_back(self, batch):
+        # Put unwritten deltas back in front of the ones queued since
+        pending, events, likes = batch
+        for pid, (views, like_delta) in pending.items():
+            entry = self.__pending.setdefault(pid, [0, 0])
+            entry[0] += views
+            entry[1] += like_delta
+        for key, n in events.items():
+            self.__events[key] = self.__events.get(key, 0) + n
+        for pid, changes in likes.items():
+            newer = self.__likes.setdefault(pid, {})
+            for user_id, liked in changes.items():
+                newer.setdefault(user_id, liked)
+        self.__count += len(pending)
+
+    def stop(self):
+        """Stop the background thread and flush whatever is left."""
+        self.__stopped = True
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.flush()
+
+    def __run(self):
+        while not self.__stopped:
+            self.__wake.wait(self.flush_interval)
+            self.__wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                # Keep the deltas and try again on the next tick
+                print("Error flushing counters:", e)
+                continue
+            try:
+                compact_events()
+            except sqlite3.Error as e:
+                print("Error compacting events:", e)
+
+_counters = CounterBuffer()
+
+@final_trace.timed
+def flush_counters():
+    """Write any buffered view/like increments to the database now."""
+    return _counters.flush()
+
+def shutdown():
+    """Flush buffered counters, roll up new events and close the connection pool."""
+    _counters.stop()
+    if _open_connections:
+        try:
+            compact_events()
+        except sqlite3.Error as e:
+            print("Error compacting events:", e)
+    close_all()
+
+atexit.register(shutdown)
 
 # ================== ANALYTICS FUNCTIONS ==================
 
+@final_trace.timed
 def get_analytics_by_post_id(post_id):
-    """Retrieve analytics by post_id."""
-    conn, cursor = connect()
-    cursor.execute("SELECT * FROM Analytics WHERE post_id = ?", (post_id,))
-    row = cursor.fetchone()
-    conn.close()
+    """
+    Retrieve analytics by post_id, including increments not yet flushed.
+    The stored row is cached until a flush or comment changes it; pending
+    increments are added on every call.
+    """
+    def load():
+        cursor = get_connection(shard_for_post(post_id)).execute(
+            "SELECT post_id, likes, views, comment_count FROM Analytics WHERE post_id = ?", (post_id,))
+        return cursor.fetchone()
+
+    def read():
+        return _analytics_cache.get_or_load(_cache_key(post_id), load), _counters.pending_for(post_id)
+
+    row, (views, likes) = _counters.read_through(read)
 
     if row:
-        return Analytics(post_id=row[0], likes=row[1], views=row[2], comments=row[3])
+        return Analytics(post_id=row[0], likes=row[1] + likes, views=row[2] + views, comment_count=row[3])
     return None
 
+@final_trace.timed
 def increment_view(post_id):
-    """Increment the view count for a post."""
-    conn, cursor = connect()
-    cursor.execute("UPDATE Analytics SET views = views + 1 WHERE post_id = ?", (post_id,))
-    conn.commit()
-    conn.close()
-
-def increment_like(post_id):
-    """Increment the like count for a post."""
-    conn, cursor = connect()
-    cursor.execute("UPDATE Analytics SET likes = likes + 1 WHERE post_id = ?", (post_id,))
-    conn.commit()
-    conn.close()
+    """Increment the view count for a post (buffered, see CounterBuffer)."""
+    _counters.add(post_id, views=1)
 
-def ensure_analytics_for_all_posts():
-    """Ensure that all posts have a corresponding analytics row."""
-    conn, cursor = connect()
-    cursor.execute("SELECT post_id FROM Posts")
-    post_ids = [row[0] for row in cursor.fetchall()]
+@final_trace.timed
+def increment_like(post_id, user_id):
+    """
+    Like a post as a user (buffered, see CounterBuffer). A user can like a
+    post only once; liking it again changes nothing.
+    Returns:
+        bool: True if this is a new like.
+    """
+    return _change_like(post_id, user_id, True)
 
-    for pid in post_ids:
-        cursor.execute("SELECT 1 FROM Analytics WHERE post_id = ?", (pid,))
-        if not cursor.fetchone():
-            cursor.execute("INSERT INTO Analytics (post_id, views, likes) VALUES (?, 0, 0)", (pid,))
-    conn.commit()
-    conn.close()
+@final_trace.timed
+def remove_like(post_id, user_id):
+    """
+    Take back a user's like of a post.
+    Returns:
+        bool: True if the user had liked the post.
+    """
+    return _change_like(post_id, user_id, False)
 
-def get_attached_files(post_id):
-    """Retrieve all attached file name/content pairs for a post."""
-    conn, cursor = connect()
+@final_trace.timed
+def has_liked(post_id, user_id):
+    """Return True if a user likes a post, including changes not yet flushed."""
+    return _counters.read_through(lambda: _likes(post_id, user_id))
+
+@final_trace.timed
+def get_like_count(post_id):
+    """
+    Return the exact number of distinct users who like a post, including
+    changes not yet flushed. Unlike Analytics.likes, this leaves out likes
+    made before likes were tracked per user.
+    """
+    return _counters.read_through(lambda: len(_load_likers(post_id)) + _counters.pending_for(post_id)[1])
+
+@final_trace.timed
+def get_likers(post_id):
+    """Return a Bitmap of the ids of the users who like a post (flushed likes only)."""
+    return _load_likers(post_id).copy()
+
+def _load_likers(post_id):
+    """Return the stored likers Bitmap of a post, from the likes cache. Never modify it."""
+    def load():
+        rows = _fetch_all(shard_for_post(post_id), "SELECT likers FROM PostLikes WHERE post_id = ?", (post_id,))
+        return Bitmap.from_bytes(rows[0][0]) if rows else Bitmap()
+
+    return _likes_cache.get_or_load(_cache_key(post_id), load)
+
+def _likes(post_id, user_id):
+    pending = _counters.pending_like(post_id, user_id)
+    if pending is not None:
+        return pending
+    return user_id in _load_likers(post_id)
+
+def _change_like(post_id, user_id, liked):
+    if not 0 < user_id < 2 ** 32:
+        raise ValueError(f"Invalid user ID: {user_id}")
+
+    def change():
+        # Read and queue under the buffer's lock, so two calls cannot both see the old state
+        if _likes(post_id, user_id) == liked:
+            return False
+        _counters.set_liked(post_id, user_id, liked)
+        return True
+
+    return _counters.read_through(change)
+
+def _save_likes(cursor, post_id, changes):
+    """Apply queued {user_id: liked} changes to a post's likers bitmap."""
+    cursor.execute("SELECT likers FROM PostLikes WHERE post_id = ?", (post_id,))
+    row = cursor.fetchone()
+    likers = Bitmap.from_bytes(row[0]) if row else Bitmap()
+    for user_id, liked in changes.items():
+        if liked:
+            likers.add(user_id)
+        else:
+            likers.discard(user_id)
+    # Skipped if the post was deleted while the changes were queued
     cursor.execute("""
-        SELECT file_name_1, file_content_1, 
-               file_name_2, file_content_2, 
-               file_name_3, file_content_3 
+        INSERT INTO PostLikes (post_id, likers, like_count)
+        SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM Posts WHERE post_id = ?)
+        ON CONFLICT (post_id) DO UPDATE SET likers = excluded.likers, like_count = excluded.like_count
+    """, (post_id, likers.to_bytes(), len(likers), post_id))
+
+@final_trace.timed
+def ensure_analytics_for_all_posts():
+    """Ensure that all posts have a corresponding analytics row (every shard, in parallel)."""
+    fan_out(lambda shard: get_connection(shard).execute("""
+        INSERT INTO Analytics (post_id, views, likes)
+        SELECT p.post_id, 0, 0 FROM Posts p
+        WHERE NOT EXISTS (SELECT 1 FROM Analytics a WHERE a.post_id = p.post_id)
+    """))
+
+# ================== BATCH FUNCTIONS ==================
+
+# Rows fetched per round trip when filling a batch
+BATCH_FETCH_SIZE = 10000
+
+@final_trace.timed
+def load_post_batch(with_content=False, after_id=0, limit=-1):
+    """
+    Load posts into a columnar PostBatch without building a Post per row.
+    Timestamps come from the indexed post_ts column (Unix seconds), the
+    same values the feeds sort by.
+    Args:
+        with_content (bool): Also load each post's description.
+        after_id (int): Start after this post_id.
+        limit (int): Maximum number of posts, or -1 for all.
+    """
+    columns = "post_id, user_id, post_ts"
+    if with_content:
+        columns += ", content"
+    rows = _query_in_order(
+        f"SELECT {columns} FROM Posts WHERE post_id > ? ORDER BY post_id ASC LIMIT ?", (after_id, limit), limit)
+    return _fill_batch(PostBatch(with_content), rows)
+
+@final_trace.timed
+def load_analytics_batch():
+    """
+    Load every Analytics row into a columnar AnalyticsBatch, ordered by post_id.
+    Buffered view/like increments are flushed first so the counts are current.
+    """
+    flush_counters()
+    rows = _query_in_order("SELECT post_id, likes, views, comment_count FROM Analytics ORDER BY post_id ASC")
+    return _fill_batch(AnalyticsBatch(), rows)
+
+def _fill_batch(batch, rows):
+    """Extend a batch from a cursor or row iterator, BATCH_FETCH_SIZE rows at a time."""
+    while True:
+        chunk = list(islice(rows, BATCH_FETCH_SIZE))
+        if not chunk:
+            return batch
+        batch.extend(chunk)
+
+# ================== COMMENT FUNCTIONS ==================
+
+# Number of comments shown per page on the post screen
+COMMENT_PAGE_SIZE = 20
+
+def _row_to_comment(row):
+    """Build a Comment from a Comments row."""
+    return Comment(comment_id=row[0], post_id=row[1], user_id=row[2], created_at=row[3], body=row[4])
+
+@final_trace.timed
+def add_comment(post_id, user_id, body):
+    """
+    Append a comment to a post. The post's comment count in Analytics is
+    kept in step by a trigger.
+    Returns:
+        Comment: The stored comment.
+    """
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    shard = shard_for_post(post_id)
+    with transaction(shard) as cursor:
+        # Comment ids are kept unique across shards the same way as post ids
+        comment_id = next_row_id(cursor, "Comments", "comment_id", shard)
+        cursor.execute(
+            "INSERT INTO Comments (comment_id, post_id, user_id, created_at, body) VALUES (?, ?, ?, ?, ?)",
+            (comment_id, post_id, user_id, created_at, body))
+    # The comment count trigger changed the Analytics row
+    _analytics_cache.invalidate(_cache_key(post_id))
+    return Comment(comment_id=comment_id, post_id=post_id, user_id=user_id,
+                   created_at=created_at, body=body)
+
+@final_trace.timed
+def get_comments(post_id, after_id=0, limit=COMMENT_PAGE_SIZE):
+    """
+    Retrieve one page of a post's comments, oldest first.
+    Pass the last comment_id of the previous page as after_id to continue.
+    """
+    cursor = get_connection(shard_for_post(post_id)).execute("""
+        SELECT comment_id, post_id, user_id, created_at, body FROM Comments
+        WHERE post_id = ? AND comment_id > ?
+        ORDER BY comment_id ASC LIMIT ?
+    """, (post_id, after_id, limit))
+    return [_row_to_comment(row) for row in cursor.fetchall()]
+
+# ================== FEED FUNCTIONS ==================
+#
+# A user's posts are read newest first from the (user_id, post_ts) index,
+# where post_ts is the post time in Unix seconds. Follows rows live in the
+# followed user's shard. With TIMELINE_FANOUT on, every new post is also
+# written to the Timelines rows of each follower (fan-out on write, in the
+# follower's shard), so a home feed page is one index range however many
+# users are followed. With it off, the followed users' posts are merged
+# when the home feed is read.
+
+# Posts per feed page
+FEED_PAGE_SIZE = 20
+
+# Push new posts to followers' timelines. Switching it on later only
+# covers the posts and follows made from then on.
+TIMELINE_FANOUT = True
+
+# Latest posts of a newly followed user copied into the follower's timeline
+TIMELINE_BACKFILL = 200
+
+# Sorts after any real post_ts
+_LATEST_TS = 2 ** 62
+
+def _feed_bounds(before, since):
+    """
+    Turn feed arguments into the (post_ts, post_id) to read below and the
+    lowest post_ts to include.
+    """
+    if before is None:
+        bound = (_LATEST_TS, 0)
+    elif isinstance(before, Post):
+        # Same conversion as the post_ts triggers, so the next page starts right after it
+        ts = get_connection().execute(
+            "SELECT COALESCE(CAST(strftime('%s', ?, 'utc') AS INTEGER), 0)", (before.get_date_time(),)
+        ).fetchone()[0]
+        bound = (ts, before.get_post_id())
+    else:
+        bound = (math.ceil(before.timestamp()), 0)
+    return bound, (-1 if since is None else math.ceil(since.timestamp()))
+
+def _feed_rows(user_ids, before, limit, since):
+    """
+    Read (post_ts, post_id, user_id, content, post_DateTime) rows, newest
+    first, of some users (None for all users) from every shard.
+    """
+    (ts, after_id), lowest = _feed_bounds(before, since)
+    if user_ids is None:
+        filters = [("", ())]
+    else:
+        user_ids = list(user_ids)
+        filters = [(f"user_id IN ({', '.join('?' * len(chunk))}) AND ", tuple(chunk))
+                   for chunk in (user_ids[i:i + MAX_IDS_PER_QUERY]
+                                 for i in range(0, len(user_ids), MAX_IDS_PER_QUERY))]
+    newest = itemgetter(0, 1)
+    results = [_query_in_order(f"""
+        SELECT post_ts, {POST_COLUMNS} FROM Posts
+        WHERE {where}(post_ts, post_id) < (?, ?) AND post_ts >= ?
+        ORDER BY post_ts DESC, post_id DESC LIMIT ?
+    """, ids + (ts, after_id, lowest, limit), limit, key=newest, reverse=True) for where, ids in filters]
+    return list(islice(heapq.merge(*results, key=newest, reverse=True), limit))
+
+@final_trace.timed
+def get_feed(user_id, before=None, limit=FEED_PAGE_SIZE, since=None):
+    """
+    Retrieve a user's posts, newest first.
+    Args:
+        user_id (int): The author, or None for the posts of every user.
+        before: Only posts older than this datetime. Pass the last Post of
+            the previous page to continue after it; None starts at the newest.
+        limit (int): Maximum number of posts.
+        since (datetime): Only posts from this moment on.
+    Returns:
+        list: Posts, newest first.
+    """
+    user_ids = None if user_id is None else [user_id]
+    return [_row_to_post(row[1:]) for row in _feed_rows(user_ids, before, limit, since)]
+
+@final_trace.timed
+def get_home_feed(user_id, before=None, limit=FEED_PAGE_SIZE, since=None):
+    """
+    Retrieve the posts of the users someone follows, newest first.
+    Read from the user's timeline when TIMELINE_FANOUT is on. The
+    arguments are the same as for get_feed().
+    """
+    if not TIMELINE_FANOUT:
+        return [_row_to_post(row[1:]) for row in _feed_rows(get_following(user_id), before, limit, since)]
+    (ts, after_id), lowest = _feed_bounds(before, since)
+    rows = _fetch_all(shard_for_user(user_id), """
+        SELECT post_id FROM Timelines
+        WHERE user_id = ? AND (post_ts, post_id) < (?, ?) AND post_ts >= ?
+        ORDER BY post_ts DESC, post_id DESC LIMIT ?
+    """, (user_id, ts, after_id, lowest, limit))
+    return get_posts_by_ids([row[0] for row in rows])
+
+@final_trace.timed
+def follow(follower_id, followee_id):
+    """
+    Make one user follow another. With TIMELINE_FANOUT on, the followed
+    user's latest TIMELINE_BACKFILL posts are added to the follower's timeline.
+    Returns:
+        bool: True if the follow is new.
+    """
+    if follower_id == followee_id:
+        raise ValueError("A user cannot follow themselves.")
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with transaction(shard_for_user(followee_id)) as cursor:
+        cursor.execute("INSERT OR IGNORE INTO Follows (followee_id, follower_id, created_at) VALUES (?, ?, ?)",
+                       (followee_id, follower_id, created_at))
+        added = cursor.rowcount > 0
+    if added and TIMELINE_FANOUT:
+        rows = _feed_rows([followee_id], None, TIMELINE_BACKFILL, None)
+        with transaction(shard_for_user(follower_id)) as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO Timelines (user_id, post_ts, post_id, author_id) VALUES (?, ?, ?, ?)",
+                [(follower_id, row[0], row[1], followee_id) for row in rows])
+    return added
+
+@final_trace.timed
+def unfollow(follower_id, followee_id):
+    """
+    Stop following a user and take their posts out of the follower's timeline.
+    Returns:
+        bool: True if the user was being followed.
+    """
+    with transaction(shard_for_user(followee_id)) as cursor:
+        cursor.execute("DELETE FROM Follows WHERE followee_id = ? AND follower_id = ?", (followee_id, follower_id))
+        removed = cursor.rowcount > 0
+    with transaction(shard_for_user(follower_id)) as cursor:
+        cursor.execute("DELETE FROM Timelines WHERE user_id = ? AND author_id = ?", (follower_id, followee_id))
+    return removed
+
+@final_trace.timed
+def is_following(follower_id, followee_id):
+    """Return True if one user follows another."""
+    return bool(_fetch_all(shard_for_user(followee_id),
+                           "SELECT 1 FROM Follows WHERE followee_id = ? AND follower_id = ?",
+                           (followee_id, follower_id)))
+
+@final_trace.timed
+def get_followers(user_id):
+    """Return the ids of the users following a user, in ascending order."""
+    rows = _fetch_all(shard_for_user(user_id),
+                      "SELECT follower_id FROM Follows WHERE followee_id = ? ORDER BY follower_id", (user_id,))
+    return [row[0] for row in rows]
+
+@final_trace.timed
+def get_following(user_id):
+    """Return the ids of the users a user follows, in ascending order (every shard is searched)."""
+    return [row[0] for row in _query_in_order(
+        "SELECT followee_id FROM Follows WHERE follower_id = ? ORDER BY followee_id", (user_id,))]
+
+def _push_to_timelines(post_id, author_id, post_ts):
+    """Add a new post to the timeline of each of its author's followers."""
+    by_shard = {}
+    for follower_id in get_followers(author_id):
+        by_shard.setdefault(shard_for_user(follower_id), []).append((follower_id, post_ts, post_id, author_id))
+
+    def push(shard):
+        if shard in by_shard:
+            with transaction(shard) as cursor:
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO Timelines (user_id, post_ts, post_id, author_id) VALUES (?, ?, ?, ?)",
+                    by_shard[shard])
+
+    fan_out(push)
+
+def _remove_from_timelines(shard, post_id):
+    if _fetch_all(shard, "SELECT 1 FROM Timelines WHERE post_id = ? LIMIT 1", (post_id,)):
+        with transaction(shard) as cursor:
+            cursor.execute("DELETE FROM Timelines WHERE post_id = ?", (post_id,))
+
+# ================== SEARCH FUNCTIONS ==================
+
+# Number of search results fetched per page
+SEARCH_PAGE_SIZE = 50
+
+# A match in a comment counts for less than the same match in the description
+COMMENT_MATCH_WEIGHT = 0.5
+
+def _fts_query(text):
+    """
+    Turn text typed by a user into an FTS5 query: every word must appear,
+    each word also matches as a prefix, and FTS5 operators are treated as
+    plain words.
+    """
+    terms = ['"' + word.replace('"', '""') + '"*' for word in text.split()]
+    return " AND ".join(terms)
+
+@final_trace.timed
+def search_posts(query, limit=SEARCH_PAGE_SIZE, offset=0):
+    """
+    Find posts whose description or comments match the query, best match first.
+    Uses the PostSearch and CommentSearch FTS5 indexes and BM25 ranking.
+    Args:
+        query (str): Words to look for, as typed by the user.
+        limit (int): Number of posts to return.
+        offset (int): Number of ranked results to skip (for paging).
+    Returns:
+        list: Matching Post objects.
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+    if SHARD_COUNT == 1:
+        rows = _search_shard(0, match, limit, offset)
+    else:
+        # The best offset + limit hits of every shard are enough to rank the
+        # page. BM25 weighs terms by each shard's own statistics, which for
+        # evenly spread posts gives nearly the same order as one file would.
+        hits = [row for rows in fan_out(_search_shard, match, offset + limit, 0) for row in rows]
+        hits.sort(key=lambda row: (row[4], -row[0]))
+        rows = hits[offset:offset + limit]
+    return [_row_to_post(row) for row in rows]
+
+def _search_shard(shard, match, limit, offset):
+    # bm25() is negative and lower means a better match
+    cursor = get_connection(shard).execute(f"""
+        SELECT p.post_id, p.user_id, p.content, p.post_DateTime, hits.score FROM (
+            SELECT post_id, MIN(score) AS score FROM (
+                SELECT rowid AS post_id, bm25(PostSearch) AS score
+                FROM PostSearch WHERE PostSearch MATCH ?
+                UNION ALL
+                SELECT c.post_id, bm25(CommentSearch) * {COMMENT_MATCH_WEIGHT}
+                FROM CommentSearch JOIN Comments c ON c.comment_id = CommentSearch.rowid
+                WHERE CommentSearch MATCH ?
+            ) GROUP BY post_id
+        ) hits JOIN Posts p ON p.post_id = hits.post_id
+        ORDER BY hits.score ASC, p.post_id DESC
+        LIMIT ? OFFSET ?
+    """, (match, match, limit, offset))
+    return cursor.fetchall()
+
+# ================== ATTACHMENT FUNCTIONS ==================
+
+# Threads compressing a post's files while it is being stored
+INGEST_WORKERS = 3
+
+_ingest_pool = None
+
+def _store_files(files, file_type=None):
+    """
+    Write (file_name, content) pairs to the blob store, each with the codec
+    chosen for its type. Several files are compressed at the same time;
+    zlib, lzma and hashlib release the GIL while they work.
+    Returns:
+        list: (file_name, (blob_hash, size, codec, stored_size)) per file.
+    """
+    global _ingest_pool
+    codecs = [final_codecs.choose_codec(name, file_type) for name, _ in files]
+    contents = [content for _, content in files]
+    if len(files) <= 1:
+        results = map(lambda content, codec: final_blobs.write_blob(content, codec=codec), contents, codecs)
+    else:
+        with _pool_lock:
+            if _ingest_pool is None:
+                _ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="db-ingest")
+        results = _ingest_pool.map(lambda content, codec: final_blobs.write_blob(content, codec=codec),
+                                   contents, codecs)
+    return [(name, stored) for (name, _), stored in zip(files, results)]
+
+@final_trace.timed
+def storage_stats():
+    """
+    Report how much space compression saves, per codec.
+    A blob shared by several shards is counted once per shard.
+    Returns:
+        dict: codec -> {"blobs", "raw_bytes", "stored_bytes", "saved_bytes", "ratio"}
+    """
+    totals = {}
+    for rows in fan_out(_fetch_all, """
+        SELECT codec, COUNT(*), SUM(size), SUM(COALESCE(stored_size, size)) FROM Blobs GROUP BY codec
+    """):
+        for codec, blobs, raw_bytes, stored_bytes in rows:
+            total = totals.setdefault(codec, [0, 0, 0])
+            total[0] += blobs
+            total[1] += raw_bytes
+            total[2] += stored_bytes
+    return {
+        codec: {"blobs": blobs, "raw_bytes": raw_bytes, "stored_bytes": stored_bytes,
+                "saved_bytes": raw_bytes - stored_bytes,
+                "ratio": round(stored_bytes / raw_bytes, 4) if raw_bytes else 1.0}
+        for codec, (blobs, raw_bytes, stored_bytes) in sorted(totals.items())
+    }
+
+def _inline_opener(post_id, slot):
+    """Return a callable that opens one legacy inline file column for reading."""
+    def open_column():
+        conn = get_connection(shard_for_post(post_id))
+        column = f"file_content_{slot}"
+        if hasattr(conn, "blobopen"):
+            # Incremental blob I/O reads the column in chunks (Python 3.11+)
+            return conn.blobopen("Posts", column, post_id, readonly=True)
+        row = conn.execute(f"SELECT {column} FROM Posts WHERE post_id = ?", (post_id,)).fetchone()
+        return io.BytesIO(row[0] if row and row[0] else b"")
+    return open_column
+
+def _load_attachment_rows(post_id):
+    """
+    Read a post's attachment metadata.
+    Returns:
+        tuple: (file_name, blob_hash, size, slot, codec) per file; blob_hash
+        is None for legacy files stored inline in the given Posts slot.
+    """
+    conn = get_connection(shard_for_post(post_id))
+    cursor = conn.execute("""
+        SELECT a.file_name, a.blob_hash, b.size, a.slot, b.codec
+        FROM Attachments a JOIN Blobs b ON b.blob_hash = a.blob_hash
+        WHERE a.post_id = ? ORDER BY a.slot
+    """, (post_id,))
+    rows = cursor.fetchall()
+    if rows:
+        return tuple(rows)
+
+    # Posts written before the blob store keep their files inline
+    cursor = conn.execute("""
+        SELECT file_name_1, length(file_content_1),
+               file_name_2, length(file_content_2),
+               file_name_3, length(file_content_3)
         FROM Posts WHERE post_id = ?
     """, (post_id,))
     row = cursor.fetchone()
-    conn.close()
 
     if not row:
-        return []
+        return ()
 
     files = []
     for i in range(0, 6, 2):
         name = row[i]
-        content = row[i + 1]
-        if name and content:
-            files.append((name, content))
+        size = row[i + 1]
+        if name and size:
+            files.append((name, None, size, i // 2 + 1, final_codecs.RAW))
+    return tuple(files)
+
+@final_trace.timed
+def get_attached_files(post_id):
+    """
+    Retrieve the attached files for a post as (file_name, BlobHandle) pairs.
+    Handles are lazy: no file content is read until the caller asks for it,
+    and compressed files are decompressed as a stream while they are read.
+    The metadata comes from the attachment cache; handles are new on every call.
+    """
+    rows = _attachment_cache.get_or_load(_cache_key(post_id), lambda: _load_attachment_rows(post_id))
+    files = []
+    for name, blob_hash, size, slot, codec in rows:
+        if blob_hash is None:
+            handle = final_blobs.BlobHandle(size=size, opener=_inline_opener(post_id, slot))
+        else:
+            handle = final_blobs.open_blob(blob_hash, size, codec)
+        files.append((name, handle))
     return files
+
+# ================== THUMBNAIL FUNCTIONS ==================
+
+@final_trace.timed
+def get_thumbnail(blob_hash):
+    """Return the stored PNG thumbnail for a blob, or None."""
+    for shard in shards():
+        cursor = get_connection(shard).execute("SELECT thumb FROM Thumbnails WHERE blob_hash = ?", (blob_hash,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+    return None
+
+@final_trace.timed
+def backfill_thumbnails(workers=None, batch_size=64, stop=None):
+    """
+    Build thumbnails for stored images that do not have one yet.
+    Images are decoded in a process pool so large photos use every core.
+    Each batch is committed on its own; the backfill stops after the
+    current batch once the stop event is set.
+    Returns:
+        int: Number of thumbnails created.
+    """
+    # multiprocessing is slow to import and only needed here
+    from concurrent.futures import ProcessPoolExecutor
+
+    image_filter = " OR ".join(f"lower(a.file_name) LIKE '%{ext}'" for ext in final_thumbs.IMAGE_EXTENSIONS)
+    created = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard in shards():
+            created += _backfill_shard_thumbnails(shard, pool, image_filter, batch_size, stop)
+    return created
+
+def _backfill_shard_thumbnails(shard, pool, image_filter, batch_size, stop):
+    created = 0
+    last_hash = ""
+    while stop is None or not stop.is_set():
+        cursor = get_connection(shard).execute(f"""
+            SELECT DISTINCT a.blob_hash FROM Attachments a
+            WHERE a.blob_hash > ? AND ({image_filter})
+              AND NOT EXISTS (SELECT 1 FROM Thumbnails t WHERE t.blob_hash = a.blob_hash)
+            ORDER BY a.blob_hash LIMIT ?
+        """, (last_hash, batch_size))
+        pending = [row[0] for row in cursor.fetchall()]
+        if not pending:
+            return created
+        last_hash = pending[-1]
+
+        # Images are always stored uncompressed (see final_codecs.STORED_EXTENSIONS)
+        paths = [final_blobs.blob_path(blob_hash) for blob_hash in pending]
+        results = list(pool.map(final_thumbs.thumbnail_file, paths))
+        with transaction(shard) as cursor:
+            for blob_hash, thumb in zip(pending, results):
+                if thumb is not None:
+                    cursor.execute("INSERT OR IGNORE INTO Thumbnails (blob_hash, thumb) VALUES (?, ?)",
+                                   (blob_hash, thumb))
+                    created += 1
+    return created
+
+# Small batches and few processes, so the upgrade run at startup leaves
+# the shards' write locks and the CPU to the app most of the time
+UPGRADE_BATCH_SIZE = 8
+UPGRADE_WORKERS = 2
+
+def upgrade_attachments(stop=None):
+    """
+    Bring attachments saved by older versions up to date: move inline file
+    contents into the blob store, then build the thumbnails they are missing.
+    Both steps only touch rows that still need them and commit in small
+    batches, so this can run in a thread of its own on every start and be
+    stopped (by setting the stop event) at any point.
+    Returns:
+        tuple: (posts migrated, thumbnails created).
+    """
+    migrated = migrate_inline_attachments(UPGRADE_BATCH_SIZE, stop)
+    if stop is not None and stop.is_set():
+        return migrated, 0
+    return migrated, backfill_thumbnails(UPGRADE_WORKERS, UPGRADE_BATCH_SIZE, stop)
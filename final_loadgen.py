@@ -0,0 +1,205 @@
+# final_loadgen.py - Load generator for final_server.py
+#
+# Usage: python final_loadgen.py [--host 127.0.0.1] [--port 8080]
+#                                [--concurrency 50] [--duration 10] [--output results.json]
+#
+# Opens --concurrency keep-alive connections and sends a mix of requests
+# (post details, feed pages, comment pages, views, likes and file downloads)
+# as fast as the server answers, for --duration seconds. Prints requests per
+# second and p50/p99 latency for each kind of request.
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# Share of each request kind in the mix
+REQUEST_MIX = (
+    ("post", 0.40),
+    ("feed", 0.15),
+    ("comments", 0.15),
+    ("view", 0.20),
+    ("like", 0.05),
+    ("file", 0.05),
+)
+
+# Post ids sampled from the feed before the run starts
+SAMPLE_POSTS = 2000
+
+# Likes are sent as a random user between 1 and this
+LIKE_USERS = 1000
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 client connection."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path):
+        """Send a request and return (status, body bytes)."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: 0\r\n\r\n"
+                          .encode("latin-1"))
+        await self.writer.drain()
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split(" ")[1])
+        length = 0
+        for line in lines[1:]:
+            if line.lower().startswith("content-length:"):
+                length = int(line.split(":", 1)[1])
+        body = await self.reader.readexactly(length)
+        return status, body
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def sample_posts(host, port):
+    """Walk the feed to collect post ids (and which ones have files)."""
+    conn = Connection(host, port)
+    post_ids, after_id = [], 0
+    try:
+        while len(post_ids) < SAMPLE_POSTS:
+            status, body = await conn.request("GET", f"/posts?after_id={after_id}&limit=200")
+            page = json.loads(body)
+            post_ids.extend(p["post_id"] for p in page["posts"])
+            if page["next_after_id"] is None:
+                break
+            after_id = page["next_after_id"]
+        with_files = []
+        for post_id in post_ids[:200]:
+            status, body = await conn.request("GET", f"/posts/{post_id}")
+            if status == 200 and json.loads(body)["files"]:
+                with_files.append(post_id)
+    finally:
+        await conn.close()
+    return post_ids, with_files
+
+
+def make_path(kind, rng, post_ids, with_files):
+    post_id = rng.choice(post_ids)
+    if kind == "post":
+        return "GET", f"/posts/{post_id}"
+    if kind == "feed":
+        return "GET", f"/posts?after_id={post_id}&limit=20"
+    if kind == "comments":
+        return "GET", f"/posts/{post_id}/comments"
+    if kind == "view":
+        return "POST", f"/posts/{post_id}/view"
+    if kind == "like":
+        return "POST", f"/posts/{post_id}/like?user_id={rng.randint(1, LIKE_USERS)}"
+    if with_files:
+        return "GET", f"/posts/{rng.choice(with_files)}/files/1"
+    return "GET", f"/posts/{post_id}"
+
+
+async def client(host, port, deadline, seed, post_ids, with_files, results):
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in REQUEST_MIX]
+    weights = [weight for _, weight in REQUEST_MIX]
+    conn = Connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            method, path = make_path(kind, rng, post_ids, with_files)
+            started = time.perf_counter()
+            try:
+                status, body = await conn.request(method, path)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                results["errors"].append(str(e))
+                await conn.close()
+                conn = Connection(host, port)
+                continue
+            entry = results["kinds"].setdefault(kind, {"latencies": [], "bytes": 0, "errors": 0})
+            entry["latencies"].append(time.perf_counter() - started)
+            entry["bytes"] += len(body)
+            if status != 200:
+                entry["errors"] += 1
+    finally:
+        await conn.close()
+
+
+def summarize(kind_results, elapsed):
+    """Turn raw latencies into requests/second and percentiles."""
+    summary = {}
+    all_latencies = []
+    for kind, entry in sorted(kind_results.items()):
+        ordered = sorted(entry["latencies"])
+        all_latencies.extend(ordered)
+        summary[kind] = _stats(ordered, elapsed)
+        summary[kind]["mb"] = round(entry["bytes"] / 1e6, 2)
+        summary[kind]["errors"] = entry["errors"]
+    summary["total"] = _stats(sorted(all_latencies), elapsed)
+    return summary
+
+
+def _stats(ordered, elapsed):
+    if not ordered:
+        return {"requests": 0, "rps": 0.0, "p50_ms": 0.0, "p99_ms": 0.0}
+    return {
+        "requests": len(ordered),
+        "rps": round(len(ordered) / elapsed, 1),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+    }
+
+
+async def run(host, port, concurrency, duration, seed=0):
+    post_ids, with_files = await sample_posts(host, port)
+    if not post_ids:
+        raise SystemExit("The server has no posts to request.")
+    results = {"kinds": {}, "errors": []}
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client(host, port, deadline, seed + i, post_ids, with_files, results)
+                           for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 2),
+        "connection_errors": len(results["errors"]),
+        "results": summarize(results["kinds"], elapsed),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure requests per second against final_server.py.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--concurrency", type=int, default=50, help="simultaneous connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args.host, args.port, args.concurrency, args.duration, args.seed))
+
+    print(f"{args.concurrency} connections for {report['duration_s']}s, "
+          f"{report['connection_errors']} connection errors")
+    print(f"  {'request':10} {'count':>8} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for kind, stats in report["results"].items():
+        print(f"  {kind:10} {stats['requests']:8} {stats['rps']:10.1f} {stats['p50_ms']:10.3f} {stats['p99_ms']:10.3f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
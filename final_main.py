@@ -1,93 +1,293 @@
 
+import time
+_startup_began = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from final_objects import Post, Analytics
-from final_db import get_attached_files
-from datetime import datetime
-from PIL import Image, ImageTk
+from final_db import (get_attached_files, get_post_by_id, get_post_ids, insert_post,
+                      get_analytics_by_post_id, increment_view, increment_like, remove_like,
+                      has_liked, delete_post,
+                      ensure_analytics_for_all_posts, add_comment, get_comments,
+                      get_thumbnail, get_engagement, search_posts, cache_stats, storage_stats,
+                      get_feed, get_home_feed, follow, unfollow, is_following,
+                      enable_tracing, disable_tracing, upgrade_attachments, remove_orphan_blobs,
+                      COMMENT_PAGE_SIZE, DB_PATH, shutdown)
+from final_thumbs import ImageCache, is_image, THUMB_SIZE
+from final_worker import DBWorker
+from final_prefetch import Prefetcher, PostBundle
+from final_tempcache import TempFileCache
+import final_trace
+from datetime import datetime, timedelta
 import io
-import sqlite3
 import os
+import sys
+import threading
+
+# PIL is imported the first time an image is shown, and the database is
+# opened by the first worker job, so the window appears without waiting for either.
 
 
-# Custom temp folder for opened files
+# Custom temp folder for opened files (created when the first file is opened).
+# Files are kept by content hash and the oldest are removed above this many bytes.
 temp_dir = os.path.join(os.getcwd(), "temp_files")
-os.makedirs(temp_dir, exist_ok=True)
+TEMP_FILES_MAX_BYTES = 256 * 1024 * 1024
+temp_cache = TempFileCache(temp_dir, TEMP_FILES_MAX_BYTES)
+
+# The main window and the worker thread are created by main()
+root = None
+db_worker = None
+prefetcher = None
 
-# SQLite database connection
-conn = sqlite3.connect("final.db")
-print("Using database at:", os.path.abspath("final.db"))
-cursor = conn.cursor()
+# The user posting, commenting and following, set from the main screen
+current_user_id = 1
+
+# Most posts loaded when a feed is opened
+FEED_POSTS_SHOWN = 100
 
 
 # Create the main application window
-root = tk.Tk()
-style = ttk.Style()
-style.theme_use("clam")  # 'clam' allows more styling control
-style.configure("TSpinbox", arrowsize=15, foreground="white", fieldbackground="#013220", background="#013220")
-style.configure("TCombobox", foreground="white", fieldbackground="#013220", background="#013220")
-style.map("TCombobox", fieldbackground=[("readonly", "#013220")])
-root.title("Snoop Media Drop")
-root.geometry("600x500")
-root.configure(bg="#013220")  # Dark mode background
+def create_root():
+    window = tk.Tk()
+    window.title("Snoop Media Drop")
+    window.geometry("600x500")
+    window.configure(bg="#013220")  # Dark mode background
+    return window
 
 
 # Set the overall style for the app using ttk.
 # This applies a dark green background with white text and custom button colors.
-style = ttk.Style()
-style.theme_use("default")
-style.configure(".", background="#013220", foreground="white", font=("Segoe UI", 10))
-style.map("TButton", foreground=[("pressed", "white"), ("active", "white")],
-          background=[("pressed", "#3e3e3e"), ("active", "#3e3e3e")])
+def setup_style():
+    style = ttk.Style()
+    style.theme_use("default")
+    style.configure(".", background="#013220", foreground="white", font=("Segoe UI", 10))
+    style.map("TButton", foreground=[("pressed", "white"), ("active", "white")],
+              background=[("pressed", "#3e3e3e"), ("active", "#3e3e3e")])
 
 
 # Track attached file
 attached_file_path = None
 attached_files = []
 
+# Decoded thumbnails, kept across screens so paging back and forth never re-decodes
+image_cache = ImageCache()
+
+# Bumped every time the window is rebuilt, so results that arrive after the
+# user has moved to another screen are ignored
+screen_counter = [0]
 
+# Clear the window for a new screen and return the new screen's number
+def clear_screen():
+    screen_counter[0] += 1
+    for widget in root.winfo_children():
+        widget.destroy()
+    return screen_counter[0]
+
+# ---- Worker thread jobs (no Tk calls in these) ----
+
+# Everything the post screen needs from the database, counting the view first
+def load_post_screen_data(post_id):
+    analytics = count_view(post_id)
+    files = get_attached_files(post_id)
+    comments = get_comments(post_id)
+    return analytics, files, comments
+
+# Count a view and return the post's up-to-date analytics
+def count_view(post_id):
+    increment_view(post_id)
+    return get_analytics_by_post_id(post_id) or Analytics(post_id=post_id)
+
+# Load a post ahead of time for the prefetcher: its files, first page of
+# comments and decoded previews. Does not count a view.
+def load_post_bundle(post_id):
+    post = get_post_by_id(post_id)
+    if post is None:
+        return None
+    files = get_attached_files(post_id)
+    comments = get_comments(post_id)
+    previews = {}
+    for name, handle in files:
+        key = handle.get_hash()
+        if key and is_image(name) and key not in previews:
+            try:
+                previews[key] = load_preview_image(handle)
+            except Exception:
+                pass
+    return PostBundle(post, files, comments, previews)
+
+# Decode a thumbnail for an attached file.
+# Uses the thumbnail stored at upload time and only decodes the full file
+# for older posts that do not have one.
+def load_preview_image(handle):
+    from PIL import Image
+    key = handle.get_hash()
+    thumb = get_thumbnail(key) if key else None
+    if thumb:
+        image = Image.open(io.BytesIO(thumb))
+        image.thumbnail(THUMB_SIZE)
+        image.load()
+        return image
+    # The stream may be a memory map of the blob file; close it once the
+    # image is decoded, or the file cannot be removed on Windows
+    with handle.stream() as stream:
+        image = Image.open(stream)
+        image.thumbnail(THUMB_SIZE)
+        image.load()
+    return image
+
+# Return a temp-folder copy of an attachment, written only the first time
+# its content is opened
+def write_temp_file(handle, fname):
+    return temp_cache.get_path(handle, fname)
+
+# Like a post as a user, or take the like back if they already like it.
+# Returns whether they like it now and the new like count.
+def toggle_like(post_id, user_id):
+    liked = increment_like(post_id, user_id)
+    if not liked:
+        remove_like(post_id, user_id)
+    analytics = get_analytics_by_post_id(post_id) or Analytics(post_id=post_id)
+    return liked, analytics.get_likes()
+
+# Store a new post, streaming the attached files from disk in chunks.
+# Returns the saved post and the post IDs used for navigation.
+def save_new_post(post, paths, file_type_name):
+    file_data = []
+    try:
+        for path in paths[:3]:
+            file_data.append((os.path.basename(path), open(path, "rb")))
+        post_id = insert_post(post, file_data, file_type_name)
+    finally:
+        for _, f in file_data:
+            f.close()
+
+    if post_id is None:
+        raise RuntimeError("The post could not be saved.")
+    post.set_post_id(post_id)
+    return post, get_post_ids()
+
+# Find the first viewable post. Returns (post, post_ids, index) or None.
+def load_first_post():
+    # Make sure every post has analytics data
+    ensure_analytics_for_all_posts()
+
+    post_ids = get_post_ids()
+    for index, post_id in enumerate(post_ids):
+        post = get_post_by_id(post_id)
+        if post:
+            return post, post_ids, index
+    return None, post_ids, None
+
+# Search posts and comments. Returns the best match and the ranked post IDs.
+def find_posts(query):
+    posts = search_posts(query)
+    return (posts[0] if posts else None), [p.get_post_id() for p in posts]
+
+# Load a user's own posts (or, for home=True, the posts of the users they
+# follow), newest first. Returns the newest post and the post IDs.
+def load_feed(user_id, home=False):
+    posts = (get_home_feed if home else get_feed)(user_id, limit=FEED_POSTS_SHOWN)
+    return (posts[0] if posts else None), [p.get_post_id() for p in posts]
+
+# Follow or unfollow a user. Returns whether they are followed now.
+def toggle_follow(follower_id, followee_id):
+    if is_following(follower_id, followee_id):
+        unfollow(follower_id, followee_id)
+        return False
+    follow(follower_id, followee_id)
+    return True
+
+# Build the analytics report text (NumPy is only needed once a report is opened)
+# followed by the hour-by-hour activity of the last day
+def load_report():
+    import final_reports
+    lines = [final_reports.format_report(final_reports.build_report()), "", "Activity in the last 24 hours:"]
+    now = datetime.now()
+    buckets = get_engagement(now - timedelta(hours=24), now)
+    for bucket in buckets:
+        lines.append(f"  {bucket.get_start():%Y-%m-%d %H:00}  {bucket.get_views()} views, "
+                     f"{bucket.get_likes()} likes, {bucket.get_comments()} comments")
+    if not buckets:
+        lines.append("  No activity.")
+    return "\n".join(lines)
+
+# Move files stored inline by older versions into the blob store and give
+# them thumbnails, then delete stored files that could not be removed when
+# their post was (e.g. a preview still had them open). Runs on a thread of
+# its own so a large upgrade never holds up the database worker; it stops
+# between small batches once stop is set.
+def upgrade_old_attachments(stop):
+    try:
+        migrated, thumbnails = upgrade_attachments(stop)
+        removed = remove_orphan_blobs(stop)
+    except Exception as e:
+        print("Error upgrading attachments:", e)
+        return
+    if migrated or thumbnails:
+        print(f"Upgraded attachments: {migrated} posts moved to the blob store, {thumbnails} thumbnails built")
+    if removed:
+        print(f"Removed {removed} unused attachment files")
 
 
 # Function to reset to the initial post creation UI
 def reset_to_main():
-    for widget in root.winfo_children():
-        widget.destroy()
     create_main_ui()
 
 # This function displays a post's content along with its analytics, attached files, and comments.
 # It also allows the user to like the post, add a comment, and navigate between other posts.
+# The screen is drawn right away with placeholders; the data is loaded on the
+# worker thread and filled in when it arrives.
 def show_post_screen(post, post_list=None, current_index=0):
     # Clear the window to prepare for the post display screen
-    for widget in root.winfo_children():
-        widget.destroy()
+    screen = clear_screen()
 
     post_id = post.get_post_id()
 
-    # Increase view count each time the post is shown
-    cursor.execute("UPDATE Analytics SET views = views + 1 WHERE post_id = ?", (post_id,))
-    conn.commit()
-
-    # Fetch the latest analytics data (likes, views, and comments)
-    cursor.execute("SELECT likes, views, comments FROM Analytics WHERE post_id = ?", (post_id,))
-    row = cursor.fetchone()
-    likes, views, comments = row if row else (0, 0, "")
-    analytics = Analytics(post_id=post_id, likes=likes, views=views, comments=comments)
+    # Use data loaded ahead of time by the prefetcher, if there is any
+    bundle = prefetcher.get(post_id)
 
     # Display the post description as the main title
     ttk.Label(root, text=f"File: {post.get_content()}", font=("Helvetica", 14)).pack(pady=10)
 
-    # Load all files attached to this post and prepare to navigate them
-    attached_files = get_attached_files(post_id)
+    # Attached files are filled in once they load
+    attached_files = []
+    previews = {}  # Decoded previews that came with prefetched data
     file_index = [0]  # Use a list to make this index mutable in nested functions
 
     # Container to display files
     file_display_frame = ttk.Frame(root)
     file_display_frame.pack(pady=10)
+    ttk.Label(file_display_frame, text="Loading files...").pack()
 
     # Shows which file out of total is being displayed
     file_counter_label = ttk.Label(root)
     file_counter_label.pack()
 
+    # Holds the next/previous file buttons if there are multiple files
+    file_nav = ttk.Frame(root)
+    file_nav.pack()
+
+    # Put a decoded preview on screen, if that file is still the one shown
+    def show_preview(image, key, shown_index):
+        if screen != screen_counter[0] or file_index[0] != shown_index:
+            return
+        from PIL import ImageTk
+        photo = ImageTk.PhotoImage(image)
+        if key:
+            image_cache.put(key, photo, photo.width(), photo.height())
+        for widget in file_display_frame.winfo_children()[1:]:
+            widget.destroy()
+        img_label = ttk.Label(file_display_frame, image=photo)
+        img_label.image = photo
+        img_label.pack()
+
+    def preview_failed(error, shown_index):
+        if screen != screen_counter[0] or file_index[0] != shown_index:
+            return
+        for widget in file_display_frame.winfo_children()[1:]:
+            widget.destroy()
+        ttk.Label(file_display_frame, text="❌ Couldn't preview that image").pack()
+
     # Display the currently selected attached file (image or non-image)
     def display_file():
         for widget in file_display_frame.winfo_children():
@@ -103,23 +303,25 @@ def show_post_screen(post, post_list=None, current_index=0):
         ttk.Label(file_display_frame, text=f"Attached File: {name}").pack()
 
         # Show image thumbnails
-        if name.lower().endswith((".png", ".jpg", ".jpeg")):
-            try:
-                image = Image.open(io.BytesIO(content))
-                image.thumbnail((200, 200))
-                photo = ImageTk.PhotoImage(image)
+        if is_image(name):
+            key = content.get_hash()
+            photo = image_cache.get(key) if key else None
+            if photo is not None:
                 img_label = ttk.Label(file_display_frame, image=photo)
                 img_label.image = photo
                 img_label.pack()
-            except:
-                ttk.Label(file_display_frame, text="❌ Couldn't preview that image").pack()
+            elif key in previews:
+                show_preview(previews.pop(key), key, file_index[0])
+            else:
+                ttk.Label(file_display_frame, text="Loading preview...").pack()
+                shown_index = file_index[0]
+                db_worker.submit(load_preview_image, content,
+                                 callback=lambda image: show_preview(image, key, shown_index),
+                                 errback=lambda error: preview_failed(error, shown_index))
         else:
             # Non-image: offer to open file using system viewer
             def open_file(data=content, fname=name):
-                temp_path = os.path.join(temp_dir, f"temp_{fname}")
-                with open(temp_path, "wb") as f:
-                    f.write(data)
-                os.startfile(temp_path)
+                db_worker.submit(write_temp_file, data, fname, callback=os.startfile)
 
             ttk.Button(file_display_frame, text=f"Open {name}", command=open_file).pack(pady=2)
 
@@ -135,43 +337,65 @@ def show_post_screen(post, post_list=None, current_index=0):
             file_index[0] = (file_index[0] - 1) % len(attached_files)
             display_file()
 
-    # Show next/previous file buttons if there are multiple files
-    if len(attached_files) > 1:
-        file_nav = ttk.Frame(root)
-        file_nav.pack()
-        ttk.Button(file_nav, text="⬅️", command=prev_file).pack(side="left", padx=10)
-        ttk.Button(file_nav, text="➡️", command=next_file).pack(side="right", padx=10)
-
-    # Show the first file
-    display_file()
-
     # Option to delete the post
     delete_var = tk.BooleanVar()
     delete_checkbox = ttk.Checkbutton(root, text="🗑️ Delete Post", variable=delete_var)
     delete_checkbox.pack(anchor="ne", padx=10)
 
-    # Like the post and update analytics
+    # Like the post and update analytics. Each user can like a post once;
+    # pressing the button again takes the like back
+    def show_liked(liked):
+        if screen == screen_counter[0]:
+            like_button.config(state="normal", text="💔 Unlike" if liked else "❤️ Like This")
+
     def like_post():
-        cursor.execute("UPDATE Analytics SET likes = likes + 1 WHERE post_id = ?", (post_id,))
-        conn.commit()
-        cursor.execute("SELECT likes FROM Analytics WHERE post_id = ?", (post_id,))
-        new_likes = cursor.fetchone()[0]
-        like_label.config(text=f"Likes: {new_likes}")
-        like_button.config(state="disabled", text="❤️ Liked")
+        like_button.config(state="disabled")
+
+        def show_likes(result):
+            liked, new_likes = result
+            if screen == screen_counter[0]:
+                like_label.config(text=f"Likes: {new_likes}")
+                show_liked(liked)
+
+        # Let the user try again if the like could not be saved
+        def like_failed(e):
+            if screen == screen_counter[0]:
+                like_button.config(state="normal")
+            messagebox.showerror("Database Error", str(e))
+
+        db_worker.submit(toggle_like, post_id, current_user_id, callback=show_likes, errback=like_failed)
 
     # Show current likes and views
-    like_label = ttk.Label(root, text=f"Likes: {analytics.get_likes()}")
+    like_label = ttk.Label(root, text="Likes: ...")
     like_label.pack(side="left", padx=10)
 
-    like_button = ttk.Button(root, text="❤️ Like This", command=like_post)
+    like_button = ttk.Button(root, text="❤️ Like This", state="disabled", command=like_post)
     like_button.pack()
+    db_worker.submit(has_liked, post_id, current_user_id, callback=show_liked,
+                     errback=lambda e: show_liked(False))
 
-    view_label = ttk.Label(root, text=f"Views: {analytics.get_views()}")
+    view_label = ttk.Label(root, text="Views: ...")
     view_label.pack(side="right", padx=10)
 
     # Display the post ID and user ID
     ttk.Label(root, text=f"Post ID: {post_id} | User ID: {post.get_user_id()}").pack()
 
+    # Follow the post's author, unless it is the current user
+    author_id = post.get_user_id()
+    if author_id != current_user_id:
+        def show_following(following):
+            if screen == screen_counter[0]:
+                follow_button.config(state="normal",
+                                     text=f"➖ Unfollow User {author_id}" if following else f"➕ Follow User {author_id}")
+
+        def follow_author():
+            follow_button.config(state="disabled")
+            db_worker.submit(toggle_follow, current_user_id, author_id, callback=show_following)
+
+        follow_button = ttk.Button(root, text="Following...", state="disabled", command=follow_author)
+        follow_button.pack()
+        db_worker.submit(is_following, current_user_id, author_id, callback=show_following)
+
     # Show the post description (read-only)
     ttk.Label(root, text="Description:").pack()
     desc_box = tk.Text(root, height=4, width=40)
@@ -179,41 +403,115 @@ def show_post_screen(post, post_list=None, current_index=0):
     desc_box.configure(state="disabled")
     desc_box.pack()
 
-    # Display all comments from the database
-    cursor.execute("SELECT comments FROM Posts WHERE post_id = ?", (post_id,))
-    comment_text = cursor.fetchone()[0] or ""
-    ttk.Label(root, text="Comments:").pack()
+    # Display the post's comments, one page at a time
+    comments_label = ttk.Label(root, text="Comments:")
+    comments_label.pack()
     comment_display = tk.Text(root, height=4, width=50)
-    comment_display.insert(tk.END, comment_text)
+    comment_display.insert(tk.END, "Loading comments...")
     comment_display.configure(state='disabled')
     comment_display.pack()
 
+    last_comment_id = [0]  # Use a list to make this value mutable in nested functions
+    all_comments_loaded = [False]
+
+    def show_comment(body):
+        comment_display.configure(state='normal')
+        if comment_display.get("1.0", "end-1c"):
+            comment_display.insert(tk.END, "\n")
+        comment_display.insert(tk.END, body)
+        comment_display.configure(state='disabled')
+
+    def show_comment_page(page):
+        if screen != screen_counter[0]:
+            return
+        for comment in page:
+            show_comment(comment.get_body())
+            last_comment_id[0] = comment.get_comment_id()
+        if len(page) < COMMENT_PAGE_SIZE:
+            all_comments_loaded[0] = True
+            more_comments_button.config(state="disabled")
+        else:
+            more_comments_button.config(state="normal")
+
+    def load_more_comments():
+        more_comments_button.config(state="disabled")
+        db_worker.submit(get_comments, post_id, after_id=last_comment_id[0], callback=show_comment_page)
+
+    more_comments_button = ttk.Button(root, text="Load More Comments", command=load_more_comments,
+                                      state="disabled")
+    more_comments_button.pack()
+
     # Allow the user to add a new comment
     ttk.Label(root, text="Add a Comment:").pack()
     comment_entry = tk.Entry(root, width=50)
     comment_entry.pack()
 
+    def show_saved_comment(comment):
+        # Only show it now if it belongs at the end of what is already loaded
+        if screen == screen_counter[0] and all_comments_loaded[0]:
+            show_comment(comment.get_body())
+            last_comment_id[0] = comment.get_comment_id()
+
     def save_comment():
         new_comment = comment_entry.get().strip()
         if new_comment:
-            updated = comment_text + "\n" + new_comment if comment_text else new_comment
-            cursor.execute("UPDATE Posts SET comments = ? WHERE post_id = ?", (updated, post_id))
-            conn.commit()
-            comment_display.configure(state='normal')
-            comment_display.insert(tk.END, f"\n{new_comment}")
-            comment_display.configure(state='disabled')
+            db_worker.submit(add_comment, post_id, current_user_id, new_comment, callback=show_saved_comment)
+            prefetcher.invalidate(post_id)
             comment_entry.delete(0, tk.END)
 
     ttk.Button(root, text="💬 Submit Comment", command=save_comment).pack(pady=5)
 
+    # Fill in the likes, views and comment count
+    def show_analytics(analytics):
+        if screen != screen_counter[0]:
+            return
+        like_label.config(text=f"Likes: {analytics.get_likes()}")
+        view_label.config(text=f"Views: {analytics.get_views()}")
+        comments_label.config(text=f"Comments ({analytics.get_comment_count()}):")
+
+    # Fill in the attached files and the first page of comments
+    def show_content(files, comments):
+        comment_display.configure(state='normal')
+        comment_display.delete("1.0", tk.END)
+        comment_display.configure(state='disabled')
+        show_comment_page(comments)
+
+        attached_files.extend(files)
+        if len(attached_files) > 1:
+            ttk.Button(file_nav, text="⬅️", command=prev_file).pack(side="left", padx=10)
+            ttk.Button(file_nav, text="➡️", command=next_file).pack(side="right", padx=10)
+
+        # Show the first file
+        display_file()
+
+    # Fill in the placeholders once the worker has loaded the post's data
+    def show_loaded_data(data):
+        analytics, files, comments = data
+        prefetcher.store(post_id, PostBundle(post, files, comments, {}))
+        if screen != screen_counter[0]:
+            return
+        show_analytics(analytics)
+        show_content(files, comments)
+
+    if bundle is not None:
+        # Served from the prefetch cache; only the view count needs the database
+        previews.update(bundle.get_previews())
+        show_content(bundle.get_files(), bundle.get_comments())
+        db_worker.submit(count_view, post_id, callback=show_analytics)
+    else:
+        db_worker.submit(load_post_screen_data, post_id, callback=show_loaded_data)
+
     # Button to return to post creation or delete the post
     def handle_back():
         if delete_var.get():
-            cursor.execute("DELETE FROM Analytics WHERE post_id = ?", (post_id,))
-            cursor.execute("DELETE FROM Posts WHERE post_id = ?", (post_id,))
-            conn.commit()
-            messagebox.showinfo("Deleted", f"Post {post_id} and its files were smoked.")
-        reset_to_main()
+            def deleted(_):
+                messagebox.showinfo("Deleted", f"Post {post_id} and its files were smoked.")
+                reset_to_main()
+
+            prefetcher.invalidate(post_id)
+            db_worker.submit(delete_post, post_id, callback=deleted)
+        else:
+            reset_to_main()
 
     ttk.Button(root, text="⏪ Back to Post Creation", command=handle_back).pack(pady=10)
 
@@ -222,45 +520,40 @@ def show_post_screen(post, post_list=None, current_index=0):
         nav_frame = ttk.Frame(root)
         nav_frame.pack(pady=10)
 
+        # Show the post at new_index, straight from the prefetch cache when it
+        # is there and otherwise after loading it in the background
+        def go_to(new_index):
+            def show_loaded_post(new_post):
+                if new_post and screen == screen_counter[0]:
+                    show_post_screen(new_post, post_list, new_index)
+
+            cached = prefetcher.get(post_list[new_index])
+            if cached is not None:
+                show_loaded_post(cached.get_post())
+            else:
+                db_worker.submit(get_post_by_id, post_list[new_index], callback=show_loaded_post)
+
         def go_first():
-            first_id = post_list[0]
-            cursor.execute("SELECT * FROM Posts WHERE post_id = ?", (first_id,))
-            row = cursor.fetchone()
-            if row:
-                new_post = Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
-                show_post_screen(new_post, post_list, 0)
+            go_to(0)
 
         def go_last():
-            last_index = len(post_list) - 1
-            last_id = post_list[last_index]
-            cursor.execute("SELECT * FROM Posts WHERE post_id = ?", (last_id,))
-            row = cursor.fetchone()
-            if row:
-                new_post = Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
-                show_post_screen(new_post, post_list, last_index)
+            go_to(len(post_list) - 1)
 
         def prev_post():
             if current_index > 0:
-                new_id = post_list[current_index - 1]
-                cursor.execute("SELECT * FROM Posts WHERE post_id = ?", (new_id,))
-                row = cursor.fetchone()
-                if row:
-                    new_post = Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
-                    show_post_screen(new_post, post_list, current_index - 1)
+                go_to(current_index - 1)
 
         def next_post():
             if current_index < len(post_list) - 1:
-                new_id = post_list[current_index + 1]
-                cursor.execute("SELECT * FROM Posts WHERE post_id = ?", (new_id,))
-                row = cursor.fetchone()
-                if row:
-                    new_post = Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
-                    show_post_screen(new_post, post_list, current_index + 1)
+                go_to(current_index + 1)
 
         ttk.Button(nav_frame, text="⏮️ First", command=go_first).pack(side="left", padx=5)
         ttk.Button(nav_frame, text="⬅️ Previous", command=prev_post).pack(side="left", padx=5)
         ttk.Button(nav_frame, text="Next ➡️", command=next_post).pack(side="left", padx=5)
         ttk.Button(nav_frame, text="⏭️ Last", command=go_last).pack(side="left", padx=5)
+
+        # Warm the cache with the neighbouring posts while this one is on screen
+        prefetcher.prefetch_around(post_list, current_index)
     
     
 
@@ -276,73 +569,52 @@ def submit_post():
     # Get the description from the entry field
     desc = desc_entry.get()
 
-    # Simulate a user ID for this example (can be expanded later)
-    user_id = 1
+    user_id = read_user_id()
+    if user_id is None:
+        return
 
     # Capture the current date and time for the post
     date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    try:
-        # Prepare placeholders in case fewer than 3 files are attached
-        file_data = [("none.txt", None)] * 3
-
-        # Load file content from the attached file paths
-        for i in range(min(len(attached_files), 3)):
-            path = attached_files[i]
-            with open(path, "rb") as f:
-                file_data[i] = (os.path.basename(path), f.read())
-
-        # Insert the post into the Posts table with up to 3 files
-        cursor.execute("""
-            INSERT INTO Posts (
-                user_id, file_type, content, post_DateTime,
-                file_name_1, file_content_1,
-                file_name_2, file_content_2,
-                file_name_3, file_content_3
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id, file_type.get(), desc, date_time,
-            file_data[0][0], file_data[0][1],
-            file_data[1][0], file_data[1][1],
-            file_data[2][0], file_data[2][1]
-        ))
-        conn.commit()
-
-        # Get the post ID of the newly inserted post
-        post_id = cursor.lastrowid
-
-        # Initialize analytics for the new post (0 views, 0 likes)
-        cursor.execute("""
-            INSERT INTO Analytics (post_id, views, likes)
-            VALUES (?, ?, ?)
-        """, (post_id, 0, 0))
-        conn.commit()
-
-        # Retrieve all post IDs for navigation
-        cursor.execute("SELECT post_id FROM Posts ORDER BY post_id ASC")
-        post_ids = [row[0] for row in cursor.fetchall()]
-        current_index = post_ids.index(post_id)
-
-        # Create a Post object and display it on screen
-        post = Post(post_id=post_id, user_id=user_id, date_time=date_time, content=desc)
-        show_post_screen(post, post_ids, current_index)
+    # Display the new post on screen once it is saved
+    def show_saved_post(result):
+        post, post_ids = result
+        show_post_screen(post, post_ids, post_ids.index(post.get_post_id()))
 
-    except Exception as e:
-        # Show an error message if something goes wrong with the database
+    # Show an error message if something goes wrong with the database
+    def show_error(e):
         messagebox.showerror("Database Error", str(e))
 
+    # Read the files, insert the post and initialize analytics on the worker thread
+    post = Post(user_id=user_id, date_time=date_time, content=desc)
+    db_worker.submit(save_new_post, post, list(attached_files), file_type.get(),
+                     callback=show_saved_post, errback=show_error)
+
+
+# Read the user ID field on the main screen and make it the current user.
+# Returns the ID, or None (after showing an error) if it is not a positive number.
+def read_user_id():
+    global current_user_id
+    try:
+        user_id = int(user_id_entry.get())
+    except ValueError:
+        user_id = 0
+    if user_id < 1:
+        messagebox.showerror("Error", "User ID must be a positive number.")
+        return None
+    current_user_id = user_id
+    return user_id
+
 
 # This function builds the main UI where users can create a new post.
 # It includes fields for description, file attachments, file type selection,
 # and buttons to submit the post or view previous posts.
 def create_main_ui():
-    global desc_entry, file_type, attached_files
+    global desc_entry, file_type, attached_files, user_id_entry
 
     # Clear out the current UI to reset the screen
     attached_files = []
-    for widget in root.winfo_children():
-        widget.destroy()
+    clear_screen()
 
     # Used to display labels for each attached file
     file_labels = []
@@ -375,9 +647,13 @@ def create_main_ui():
                 label.pack()
                 file_labels.append(label)
 
-    # Label showing the  user ID
-    user_id_label = ttk.Label(root, text="User ID (Auto): 1")
-    user_id_label.pack(pady=5)
+    # The user ID posts, comments and follows are made as
+    user_id_label = ttk.Label(root, text="User ID:")
+    user_id_label.pack(pady=(5, 0))
+    user_id_entry = ttk.Entry(root, width=10)
+    user_id_entry.configure(foreground="black")
+    user_id_entry.insert(0, str(current_user_id))
+    user_id_entry.pack(pady=(0, 5))
 
     # Spinbox to choose number of files to attach
     files_label = ttk.Label(root, text="Number of Files:")
@@ -410,40 +686,241 @@ def create_main_ui():
 
     # Button to view existing posts and navigate through them
     def open_analytics():
-        # Make sure every post has analytics data
-        cursor.execute("SELECT post_id FROM Posts")
-        all_post_ids = [row[0] for row in cursor.fetchall()]
-
-        for pid in all_post_ids:
-            cursor.execute("SELECT post_id FROM Analytics WHERE post_id = ?", (pid,))
-            if not cursor.fetchone():
-                cursor.execute("INSERT INTO Analytics (post_id, views, likes) VALUES (?, 0, 0)", (pid,))
-                conn.commit()
-
-        # Load posts and show the first one
-        cursor.execute("SELECT post_id FROM Posts ORDER BY post_id ASC")
-        post_ids = [row[0] for row in cursor.fetchall()]
-    
-        if not post_ids:
-            messagebox.showinfo("No Posts", "You haven't dropped any posts yet.")
-            return
-
-        for index, post_id in enumerate(post_ids):
-            cursor.execute("SELECT * FROM Posts WHERE post_id = ?", (post_id,))
-            row = cursor.fetchone()
-
-            if row:
-                post = Post(post_id=row[0], user_id=row[1], date_time=row[4], content=row[3])
+        # Load posts on the worker thread and show the first one
+        def show_first_post(result):
+            post, post_ids, index = result
+
+            if not post_ids:
+                messagebox.showinfo("No Posts", "You haven't dropped any posts yet.")
+            elif post is None:
+                messagebox.showinfo("No Viewable Posts", "No posts found in the database.")
+            else:
                 show_post_screen(post, post_ids, index)
-                return
 
-        messagebox.showinfo("No Viewable Posts", "No posts found in the database.")
+        db_worker.submit(load_first_post, callback=show_first_post)
 
     # Add the analytics navigation button to the main screen
     analytics_btn = ttk.Button(root, text="📊 View Posts", command=open_analytics)
     analytics_btn.pack(pady=10)
 
+    # Buttons to open the current user's posts or the posts of the users they follow
+    def open_feed(home):
+        user_id = read_user_id()
+        if user_id is None:
+            return
+
+        def show_feed(result):
+            post, post_ids = result
+            if post is None:
+                text = "Follow someone to fill your feed." if home else f"User {user_id} has no posts yet."
+                messagebox.showinfo("No Posts", text)
+            else:
+                show_post_screen(post, post_ids, 0)
+
+        db_worker.submit(load_feed, user_id, home, callback=show_feed)
+
+    feed_frame = ttk.Frame(root)
+    feed_frame.pack(pady=5)
+    ttk.Button(feed_frame, text="👤 My Posts", command=lambda: open_feed(False)).pack(side="left", padx=5)
+    ttk.Button(feed_frame, text="🏠 Following", command=lambda: open_feed(True)).pack(side="left", padx=5)
+
+    # Button to open the analytics reports
+    reports_btn = ttk.Button(root, text="📈 Reports", command=show_reports_screen)
+    reports_btn.pack(pady=10)
+
+    # Button to open the database debug screen
+    debug_btn = ttk.Button(root, text="🐞 Debug", command=show_debug_screen)
+    debug_btn.pack(pady=5)
+
+    # Search box: shows the matching posts, best match first
+    def run_search(event=None):
+        query = search_entry.get().strip()
+        if not query:
+            return
+
+        def show_results(result):
+            post, post_ids = result
+            if post is None:
+                messagebox.showinfo("No Results", f"No posts match \"{query}\".")
+            else:
+                show_post_screen(post, post_ids, 0)
+
+        def search_failed(e):
+            messagebox.showerror("Search Error", str(e))
+
+        db_worker.submit(find_posts, query, callback=show_results, errback=search_failed)
+
+    search_frame = ttk.Frame(root)
+    search_frame.pack(pady=10)
+    search_entry = ttk.Entry(search_frame, width=35)
+    search_entry.configure(foreground="black")
+    search_entry.pack(side="left", padx=5)
+    search_entry.bind("<Return>", run_search)
+    ttk.Button(search_frame, text="🔍 Search", command=run_search).pack(side="left", padx=5)
+
+
+# This function shows the analytics report for every post:
+# totals, top posts, percentiles and the most liked users.
+def show_reports_screen():
+    screen = clear_screen()
+
+    ttk.Label(root, text="📈 Reports", font=("Segoe UI", 14, "bold")).pack(pady=10)
+    status_label = ttk.Label(root, text="Building report...")
+    status_label.pack()
+
+    report_text = tk.Text(root, width=70, height=20, bg="#013220", fg="white", relief="flat")
+    report_text.pack(padx=10, pady=5, fill="both", expand=True)
+
+    # Fill in the report once the worker has built it
+    def show_report(text):
+        if screen != screen_counter[0]:
+            return
+        status_label.config(text="")
+        report_text.insert("1.0", text)
+        report_text.config(state="disabled")
+
+    def report_failed(e):
+        if screen != screen_counter[0]:
+            return
+        status_label.config(text="")
+        messagebox.showerror("Report Error", str(e))
+
+    db_worker.submit(load_report, callback=show_report, errback=report_failed)
+
+    ttk.Button(root, text="⏪ Back to Post Creation", command=reset_to_main).pack(pady=10)
+
+
+# This function shows the database debug screen: query and function
+# timings, slow queries, object cache statistics and the space saved by
+# compressing attachments.
+def show_debug_screen():
+    screen = clear_screen()
+
+    ttk.Label(root, text="🐞 Debug", font=("Segoe UI", 14, "bold")).pack(pady=10)
+
+    stats_text = tk.Text(root, width=90, height=20, bg="#013220", fg="white", relief="flat", wrap="none")
+    stats_text.pack(padx=10, pady=5, fill="both", expand=True)
+
+    def refresh():
+        lines = [final_trace.format_stats(), "", "Object caches:"]
+        for name, stats in cache_stats().items():
+            lines.append(f"  {name}: {stats['hits']} hits, {stats['misses']} misses "
+                         f"({stats['hit_rate']:.0%}), {stats['evictions']} evictions, "
+                         f"{stats['entries']} entries, {stats['bytes']} / {stats['max_bytes']} bytes")
+        stats_text.config(state="normal")
+        stats_text.delete("1.0", tk.END)
+        stats_text.insert("1.0", "\n".join(lines))
+        stats_text.config(state="disabled")
+        toggle_button.config(text="Stop Tracing" if final_trace.enabled else "Start Tracing")
+        db_worker.submit(storage_stats, callback=show_storage)
+
+    def show_storage(storage):
+        if screen != screen_counter[0]:
+            return
+        lines = ["", "", "Attachment storage:"]
+        for codec, stats in storage.items():
+            lines.append(f"  {codec}: {stats['blobs']} files, {stats['raw_bytes']} bytes stored as "
+                         f"{stats['stored_bytes']} ({stats['saved_bytes']} saved, ratio {stats['ratio']:.2f})")
+        stats_text.config(state="normal")
+        stats_text.insert(tk.END, "\n".join(lines))
+        stats_text.config(state="disabled")
+
+    def toggle_tracing():
+        if final_trace.enabled:
+            disable_tracing()
+        else:
+            enable_tracing()
+        refresh()
+
+    def reset_stats():
+        final_trace.reset()
+        refresh()
+
+    def save_json():
+        path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
+        if path:
+            final_trace.dump_json(path)
+
+    button_frame = ttk.Frame(root)
+    button_frame.pack(pady=5)
+    toggle_button = ttk.Button(button_frame, command=toggle_tracing)
+    toggle_button.pack(side="left", padx=5)
+    ttk.Button(button_frame, text="Refresh", command=refresh).pack(side="left", padx=5)
+    ttk.Button(button_frame, text="Reset", command=reset_stats).pack(side="left", padx=5)
+    ttk.Button(button_frame, text="Save JSON", command=save_json).pack(side="left", padx=5)
+
+    ttk.Button(root, text="⏪ Back to Post Creation", command=reset_to_main).pack(pady=10)
+    refresh()
+
+
+# ---- Startup ----
+
+# (label, time) for each startup step, used by --startup-time
+startup_marks = []
+
+def mark_startup(label):
+    startup_marks.append((label, time.perf_counter()))
+
+# Print how long each startup step took
+def report_startup():
+    print("Startup time:")
+    previous = _startup_began
+    for label, at in startup_marks:
+        print(f"  {label:<20} {(at - previous) * 1000:8.1f} ms")
+        previous = at
+    print(f"  {'total':<20} {(previous - _startup_began) * 1000:8.1f} ms")
+    print("(Run with python -X importtime for a per-module import breakdown.)")
+
+# Start the app. With --startup-time, the window is drawn once, the time
+# spent in each startup step is printed and the app exits.
+def main(argv=None):
+    global root, db_worker, prefetcher
+    argv = sys.argv[1:] if argv is None else argv
+    measure = "--startup-time" in argv
+    mark_startup("imports")
+
+    # SQLite database (opened by final_db on the worker thread)
+    print("Using database at:", os.path.abspath(DB_PATH))
+
+    root = create_root()
+    mark_startup("window")
+    setup_style()
+    mark_startup("style")
+
+    # Worker thread that runs every database call made from the UI
+    db_worker = DBWorker(root)
+    # Posts next to the one on screen, loaded in the background
+    prefetcher = Prefetcher(db_worker, load_post_bundle)
+    # Tidy the temp folder once the window is up
+    db_worker.submit_background(temp_cache.cleanup)
+    # Bring attachments saved by older versions up to date
+    upgrade_stop = threading.Event()
+    upgrade_thread = threading.Thread(target=upgrade_old_attachments, args=(upgrade_stop,),
+                                      name="attachment-upgrade", daemon=True)
+    upgrade_thread.start()
+    mark_startup("database worker")
+
+    create_main_ui()
+    mark_startup("main screen")
+
+    if measure:
+        root.update()
+        mark_startup("first frame")
+        report_startup()
+        root.destroy()
+    else:
+        root.mainloop()
+
+    # Finish queued database work and write any buffered view/like counts before exiting;
+    # the attachment upgrade stops after its current batch and carries on next time
+    upgrade_stop.set()
+    upgrade_thread.join()
+    db_worker.stop()
+    shutdown()
+    temp_cache.cleanup()
+    return 0
+
 
 # Launch UI
-create_main_ui()
-root.mainloop()
+if __name__ == "__main__":
+    sys.exit(main())
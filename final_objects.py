@@ -1,8 +1,14 @@
 # This module contains the class definitions for the social media analytics application.
-# Defines two classes: Post and Analytics 
+# Defines three classes: Post, Analytics and Comment 
 # data retrieved from the database.
+# Post and Analytics use __slots__ to keep per-object memory small, and
+# PostBatch/AnalyticsBatch hold many rows as typed columns for reporting.
+
+import time
+from array import array
 
 class Post:
+    __slots__ = ("__post_id", "__user_id", "__date_time", "__content")
 
     def __init__(self, post_id=0, user_id=0, date_time="", content=""):
         #initialize
@@ -55,11 +61,13 @@ class Post:
 
 
 class Analytics:
-    def __init__(self, post_id=0, likes=0, views=0, comments=""):
+    __slots__ = ("__post_id", "__likes", "__views", "__comment_count")
+
+    def __init__(self, post_id=0, likes=0, views=0, comment_count=0):
         self.__post_id = post_id
         self.__likes = likes
         self.__views = views
-        self.__comments = comments
+        self.__comment_count = comment_count
 
     def get_post_id(self):
         return self.__post_id
@@ -70,8 +78,8 @@ class Analytics:
     def get_views(self):
         return self.__views
 
-    def get_comments(self):
-        return self.__comments
+    def get_comment_count(self):
+        return self.__comment_count
 
     def set_post_id(self, post_id):
         self.__post_id = post_id
@@ -82,8 +90,165 @@ class Analytics:
     def set_views(self, views):
         self.__views = views
 
-    def set_comments(self, comments):
+    def set_comment_count(self, comment_count):
+        self.__comment_count = comment_count
+
+    def __str__(self):
+        return f"Analytics(Post ID: {self.__post_id}, Likes: {self.__likes}, Views: {self.__views}, Comments: {self.__comment_count})"
+
+
+
+class Comment:
+    def __init__(self, comment_id=0, post_id=0, user_id=0, created_at="", body=""):
+        self.__comment_id = comment_id
+        self.__post_id = post_id
+        self.__user_id = user_id
+        self.__created_at = created_at
+        self.__body = body
+
+    def get_comment_id(self):
+        return self.__comment_id
+
+    def get_post_id(self):
+        return self.__post_id
+
+    def get_user_id(self):
+        return self.__user_id
+
+    def get_created_at(self):
+        return self.__created_at
+
+    def get_body(self):
+        return self.__body
+
+    def set_comment_id(self, comment_id):
+        self.__comment_id = comment_id
+
+    def set_post_id(self, post_id):
+        self.__post_id = post_id
+
+    def set_user_id(self, user_id):
+        self.__user_id = user_id
+
+    def set_created_at(self, created_at):
+        self.__created_at = created_at
+
+    def set_body(self, body):
+        self.__body = body
+
+    def __str__(self):
+        return f"Comment(ID: {self.__comment_id}, Post ID: {self.__post_id}, User ID: {self.__user_id}, Date: {self.__created_at})"
+
+
+
+class EngagementBucket:
+    # Views, likes and comments counted in one hour or day.
+    # start is the bucket's start time as a local datetime.
+    __slots__ = ("__start", "__views", "__likes", "__comments")
+
+    def __init__(self, start=None, views=0, likes=0, comments=0):
+        self.__start = start
+        self.__views = views
+        self.__likes = likes
         self.__comments = comments
 
+    def get_start(self):
+        return self.__start
+
+    def get_views(self):
+        return self.__views
+
+    def get_likes(self):
+        return self.__likes
+
+    def get_comments(self):
+        return self.__comments
+
+    def __str__(self):
+        return f"EngagementBucket(Start: {self.__start}, Views: {self.__views}, Likes: {self.__likes}, Comments: {self.__comments})"
+
+
+
+class PostBatch:
+    # Columnar storage for many posts: ids and timestamps (Unix seconds,
+    # post_DateTime is local time) are packed into typed arrays instead of
+    # one Post object per row
+    def __init__(self, with_content=False):
+        self.post_ids = array("q")
+        self.user_ids = array("q")
+        self.timestamps = array("q")
+        self.contents = [] if with_content else None
+
+    def extend(self, rows):
+        # Add rows of (post_id, user_id, timestamp[, content])
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        self.post_ids.extend(columns[0])
+        self.user_ids.extend(0 if v is None else v for v in columns[1])
+        self.timestamps.extend(0 if v is None else v for v in columns[2])
+        if self.contents is not None:
+            self.contents.extend(columns[3])
+
+    def get_post(self, index):
+        # Build a Post for one row when a full object is needed
+        content = self.contents[index] if self.contents is not None else ""
+        date_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamps[index]))
+        return Post(post_id=self.post_ids[index], user_id=self.user_ids[index],
+                    date_time=date_time, content=content)
+
+    def to_numpy(self):
+        # Return the numeric columns as NumPy arrays sharing this batch's memory
+        import numpy as np
+        return {
+            "post_id": np.frombuffer(self.post_ids, dtype=np.int64),
+            "user_id": np.frombuffer(self.user_ids, dtype=np.int64),
+            "timestamp": np.frombuffer(self.timestamps, dtype=np.int64),
+        }
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def __str__(self):
+        return f"PostBatch(Posts: {len(self.post_ids)})"
+
+
+
+class AnalyticsBatch:
+    # Columnar storage for many Analytics rows
+    def __init__(self):
+        self.post_ids = array("q")
+        self.likes = array("q")
+        self.views = array("q")
+        self.comment_counts = array("q")
+
+    def extend(self, rows):
+        # Add rows of (post_id, likes, views, comment_count)
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        self.post_ids.extend(columns[0])
+        self.likes.extend(columns[1])
+        self.views.extend(columns[2])
+        self.comment_counts.extend(columns[3])
+
+    def get_analytics(self, index):
+        # Build an Analytics object for one row when a full object is needed
+        return Analytics(post_id=self.post_ids[index], likes=self.likes[index],
+                         views=self.views[index], comment_count=self.comment_counts[index])
+
+    def to_numpy(self):
+        # Return the columns as NumPy arrays sharing this batch's memory
+        import numpy as np
+        return {
+            "post_id": np.frombuffer(self.post_ids, dtype=np.int64),
+            "likes": np.frombuffer(self.likes, dtype=np.int64),
+            "views": np.frombuffer(self.views, dtype=np.int64),
+            "comment_count": np.frombuffer(self.comment_counts, dtype=np.int64),
+        }
+
+    def __len__(self):
+        return len(self.post_ids)
+
     def __str__(self):
-        return f"Analytics(Post ID: {self.__post_id}, Likes: {self.__likes}, Views: {self.__views}, Comments: {self.__comments})"
+        return f"AnalyticsBatch(Posts: {len(self.post_ids)})"
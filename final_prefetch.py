@@ -0,0 +1,98 @@
+# final_prefetch.py - Keeps the posts next to the current one loaded ahead of time
+# While a post is on screen, the data for the posts a few steps before and
+# after it is loaded by background worker jobs, so First/Previous/Next/Last
+# can draw the next screen straight from memory.
+
+from collections import OrderedDict
+
+# How many posts on each side of the current one to load ahead
+PREFETCH_RADIUS = 2
+
+# How many loaded posts to keep in memory
+PREFETCH_CAPACITY = 16
+
+
+class PostBundle:
+    """Everything the post screen shows for one post, except live analytics."""
+
+    def __init__(self, post, files, comments, previews):
+        self.__post = post
+        self.__files = files
+        self.__comments = comments
+        self.__previews = previews
+
+    def get_post(self):
+        return self.__post
+
+    def get_files(self):
+        return self.__files
+
+    def get_comments(self):
+        return self.__comments
+
+    def get_previews(self):
+        # Decoded preview images keyed by blob hash
+        return self.__previews
+
+
+class Prefetcher:
+    """
+    LRU cache of PostBundles filled by background jobs on a DBWorker.
+    Only used from the Tk thread; results arrive through worker callbacks.
+    loader(post_id) runs on the worker and returns a PostBundle or None.
+    """
+
+    def __init__(self, worker, loader, radius=PREFETCH_RADIUS, capacity=PREFETCH_CAPACITY):
+        self.__worker = worker
+        self.__loader = loader
+        self.radius = radius
+        self.capacity = capacity
+        self.__bundles = OrderedDict()  # post_id -> PostBundle
+        self.__loading = set()
+        self.__stale = set()  # loads that were invalidated while in flight
+
+    def get(self, post_id):
+        """Return the loaded bundle for a post, or None."""
+        bundle = self.__bundles.get(post_id)
+        if bundle is not None:
+            self.__bundles.move_to_end(post_id)
+        return bundle
+
+    def store(self, post_id, bundle):
+        """Add a bundle, dropping the least recently used ones over capacity."""
+        self.__bundles[post_id] = bundle
+        self.__bundles.move_to_end(post_id)
+        while len(self.__bundles) > self.capacity:
+            self.__bundles.popitem(last=False)
+
+    def invalidate(self, post_id):
+        """Forget a post, e.g. after it was changed or deleted."""
+        self.__bundles.pop(post_id, None)
+        if post_id in self.__loading:
+            self.__stale.add(post_id)
+
+    def clear(self):
+        self.__bundles.clear()
+
+    def prefetch_around(self, post_list, index):
+        """Queue loads for the posts within radius of post_list[index], nearest first."""
+        for offset in range(1, self.radius + 1):
+            for neighbour in (index + offset, index - offset):
+                if 0 <= neighbour < len(post_list):
+                    self.__request(post_list[neighbour])
+
+    def __request(self, post_id):
+        if post_id in self.__bundles or post_id in self.__loading:
+            return
+        self.__loading.add(post_id)
+        self.__worker.submit_background(
+            self.__loader, post_id,
+            callback=lambda bundle: self.__loaded(post_id, bundle),
+            errback=lambda error: self.__loaded(post_id, None))
+
+    def __loaded(self, post_id, bundle):
+        self.__loading.discard(post_id)
+        if post_id in self.__stale:
+            self.__stale.discard(post_id)
+        elif bundle is not None:
+            self.store(post_id, bundle)
@@ -0,0 +1,146 @@
+# final_reports.py - Vectorized analytics reports over every post
+# Loads the Posts and Analytics columns in bulk (see final_db.load_post_batch
+# and load_analytics_batch) into NumPy arrays and computes each report in a
+# single vectorized pass instead of looking posts up one at a time.
+#
+# Usage: python final_reports.py [--top N] [--db PATH]   (prints JSON)
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+import final_db
+
+METRICS = ("likes", "views", "comment_count", "like_rate")
+PERCENTILES = (50, 90, 99)
+
+
+def load_report_data():
+    """
+    Load all posts with their analytics as aligned NumPy columns.
+    Returns:
+        dict: Arrays keyed by post_id, user_id, timestamp, likes, views,
+        comment_count and like_rate, one element per post.
+    """
+    posts = final_db.load_post_batch().to_numpy()
+    analytics = final_db.load_analytics_batch().to_numpy()
+
+    # Both batches are sorted by post_id; match each post to its analytics row
+    post_ids = posts["post_id"]
+    positions = np.searchsorted(analytics["post_id"], post_ids)
+    positions = np.minimum(positions, max(len(analytics["post_id"]) - 1, 0))
+    found = (analytics["post_id"][positions] == post_ids) if len(analytics["post_id"]) else \
+        np.zeros(len(post_ids), dtype=bool)
+
+    data = dict(posts)
+    for column in ("likes", "views", "comment_count"):
+        values = np.zeros(len(post_ids), dtype=np.int64)
+        if len(analytics["post_id"]):
+            values[found] = analytics[column][positions[found]]
+        data[column] = values
+    data["like_rate"] = engagement_rates(data)
+    return data
+
+
+def engagement_rates(data):
+    """Return likes / views for every post (0 where a post has no views)."""
+    likes = data["likes"].astype(np.float64)
+    views = data["views"].astype(np.float64)
+    return np.divide(likes, views, out=np.zeros_like(likes), where=views > 0)
+
+
+def top_n(data, metric="likes", n=10):
+    """
+    Return the n posts with the highest value of a metric.
+    Returns:
+        list: (post_id, value) pairs, highest first.
+    """
+    values = data[metric]
+    n = min(n, len(values))
+    if n == 0:
+        return []
+    # argpartition finds the top n in linear time; only those n get sorted
+    top = np.argpartition(values, -n)[-n:]
+    top = top[np.argsort(values[top])[::-1]]
+    return [(int(data["post_id"][i]), values[i].item()) for i in top]
+
+
+def percentiles(data, metric, qs=PERCENTILES):
+    """Return {percentile: value} for a metric across all posts."""
+    if len(data[metric]) == 0:
+        return {q: 0 for q in qs}
+    return dict(zip(qs, (float(v) for v in np.percentile(data[metric], qs))))
+
+
+def per_user(data):
+    """
+    Aggregate posts, likes, views and comments per user.
+    Returns:
+        dict: Arrays keyed by user_id, posts, likes, views and comment_count.
+    """
+    users, inverse = np.unique(data["user_id"], return_inverse=True)
+    result = {
+        "user_id": users,
+        "posts": np.bincount(inverse, minlength=len(users)),
+    }
+    for column in ("likes", "views", "comment_count"):
+        result[column] = np.bincount(inverse, weights=data[column], minlength=len(users)).astype(np.int64)
+    return result
+
+
+def build_report(n=10):
+    """Build the full report as plain Python values (JSON-serializable)."""
+    data = load_report_data()
+    users = per_user(data)
+    top_users = np.argsort(users["likes"])[::-1][:n]
+    return {
+        "posts": int(len(data["post_id"])),
+        "totals": {column: int(data[column].sum()) for column in ("likes", "views", "comment_count")},
+        "top": {metric: top_n(data, metric, n) for metric in METRICS},
+        "percentiles": {metric: percentiles(data, metric) for metric in METRICS},
+        "top_users": [
+            {column: int(users[column][i]) for column in ("user_id", "posts", "likes", "views", "comment_count")}
+            for i in top_users
+        ],
+    }
+
+
+def format_report(report):
+    """Render a report from build_report() as readable text."""
+    lines = [f"Posts: {report['posts']}"]
+    totals = report["totals"]
+    lines.append(f"Total likes: {totals['likes']}  views: {totals['views']}  comments: {totals['comment_count']}")
+    for metric, rows in report["top"].items():
+        lines.append("")
+        lines.append(f"Top posts by {metric}:")
+        for post_id, value in rows:
+            shown = f"{value:.2%}" if metric == "like_rate" else value
+            lines.append(f"  Post {post_id}: {shown}")
+    lines.append("")
+    lines.append("Percentiles (p50 / p90 / p99):")
+    for metric, values in report["percentiles"].items():
+        lines.append(f"  {metric}: " + " / ".join(f"{v:.2f}" for v in values.values()))
+    lines.append("")
+    lines.append("Top users by likes:")
+    for user in report["top_users"]:
+        lines.append(f"  User {user['user_id']}: {user['posts']} posts, {user['likes']} likes, {user['views']} views")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print analytics reports as JSON.")
+    parser.add_argument("--top", type=int, default=10, help="rows in each top-N list")
+    parser.add_argument("--db", default=final_db.DB_PATH, help="database file to report on")
+    parser.add_argument("--shards", type=int, default=final_db.SHARD_COUNT, help="number of database shards")
+    args = parser.parse_args(argv)
+
+    final_db.DB_PATH = args.db
+    final_db.SHARD_COUNT = args.shards
+    print(json.dumps(build_report(args.top), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
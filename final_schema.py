@@ -0,0 +1,389 @@
+# final_schema.py - Creates and upgrades the database schema for the app
+# Each migration is applied once, in order, inside its own transaction.
+# The schema version is stored in SQLite's PRAGMA user_version and is read
+# again after the write lock is taken, so when several processes open the
+# database at once only the first applies a migration.
+
+import sqlite3
+import sys
+
+MIGRATIONS = [
+    (1, "Posts and Analytics tables", """
+        CREATE TABLE IF NOT EXISTS Posts (
+            post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            file_type TEXT,
+            content TEXT,
+            post_DateTime TEXT,
+            file_name_1 TEXT,
+            file_content_1 BLOB,
+            file_name_2 TEXT,
+            file_content_2 BLOB,
+            file_name_3 TEXT,
+            file_content_3 BLOB,
+            comments TEXT
+        );
+        CREATE TABLE IF NOT EXISTS Analytics (
+            post_id INTEGER,
+            likes INTEGER DEFAULT 0,
+            views INTEGER DEFAULT 0,
+            comments TEXT
+        );
+    """),
+
+    (2, "Content-addressed blob store tables", """
+        CREATE TABLE IF NOT EXISTS Blobs (
+            blob_hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS Attachments (
+            post_id INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            blob_hash TEXT NOT NULL REFERENCES Blobs (blob_hash),
+            PRIMARY KEY (post_id, slot)
+        );
+    """),
+
+    (3, "Foreign keys, cascading deletes, indexes and triggers", """
+        -- Drop rows left behind by posts deleted before cascades existed
+        DELETE FROM Analytics WHERE post_id NOT IN (SELECT post_id FROM Posts);
+        UPDATE Blobs SET ref_count = ref_count - (
+            SELECT COUNT(*) FROM Attachments a
+            WHERE a.blob_hash = Blobs.blob_hash
+              AND a.post_id NOT IN (SELECT post_id FROM Posts)
+        );
+        DELETE FROM Attachments WHERE post_id NOT IN (SELECT post_id FROM Posts);
+
+        -- One analytics row per post, removed together with the post
+        CREATE TABLE Analytics_new (
+            post_id INTEGER PRIMARY KEY REFERENCES Posts (post_id) ON DELETE CASCADE,
+            likes INTEGER NOT NULL DEFAULT 0,
+            views INTEGER NOT NULL DEFAULT 0,
+            comments TEXT
+        );
+        INSERT INTO Analytics_new (post_id, likes, views, comments)
+            SELECT post_id, MAX(COALESCE(likes, 0)), MAX(COALESCE(views, 0)), MAX(comments)
+            FROM Analytics GROUP BY post_id;
+        DROP TABLE Analytics;
+        ALTER TABLE Analytics_new RENAME TO Analytics;
+
+        CREATE TABLE Attachments_new (
+            post_id INTEGER NOT NULL REFERENCES Posts (post_id) ON DELETE CASCADE,
+            slot INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            blob_hash TEXT NOT NULL REFERENCES Blobs (blob_hash),
+            PRIMARY KEY (post_id, slot)
+        );
+        INSERT INTO Attachments_new SELECT post_id, slot, file_name, blob_hash FROM Attachments;
+        DROP TABLE Attachments;
+        ALTER TABLE Attachments_new RENAME TO Attachments;
+
+        CREATE INDEX IF NOT EXISTS idx_posts_user ON Posts (user_id);
+        CREATE INDEX IF NOT EXISTS idx_attachments_blob ON Attachments (blob_hash);
+        CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON Blobs (blob_hash) WHERE ref_count <= 0;
+
+        -- Every new post gets its analytics row
+        CREATE TRIGGER IF NOT EXISTS trg_posts_analytics AFTER INSERT ON Posts
+        BEGIN
+            INSERT OR IGNORE INTO Analytics (post_id, views, likes) VALUES (NEW.post_id, 0, 0);
+        END;
+
+        -- Blob reference counts follow the Attachments rows
+        CREATE TRIGGER IF NOT EXISTS trg_attachments_ref AFTER INSERT ON Attachments
+        BEGIN
+            UPDATE Blobs SET ref_count = ref_count + 1 WHERE blob_hash = NEW.blob_hash;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_attachments_unref AFTER DELETE ON Attachments
+        BEGIN
+            UPDATE Blobs SET ref_count = ref_count - 1 WHERE blob_hash = OLD.blob_hash;
+        END;
+
+        -- Backfill analytics rows for posts that never got one
+        INSERT INTO Analytics (post_id, views, likes)
+            SELECT p.post_id, 0, 0 FROM Posts p
+            WHERE NOT EXISTS (SELECT 1 FROM Analytics a WHERE a.post_id = p.post_id);
+    """),
+
+    (4, "Comments table with per-post comment counts", """
+        CREATE TABLE IF NOT EXISTS Comments (
+            comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL REFERENCES Posts (post_id) ON DELETE CASCADE,
+            user_id INTEGER,
+            created_at TEXT NOT NULL,
+            body TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_comments_post ON Comments (post_id, comment_id);
+
+        ALTER TABLE Analytics ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0;
+
+        -- Split the old newline-joined Posts.comments text into rows
+        WITH RECURSIVE split (post_id, pos, line, rest) AS (
+            SELECT post_id, 0, NULL, comments || char(10)
+            FROM Posts WHERE comments IS NOT NULL AND comments <> ''
+            UNION ALL
+            SELECT post_id, pos + 1,
+                   rtrim(substr(rest, 1, instr(rest, char(10)) - 1), char(13)),
+                   substr(rest, instr(rest, char(10)) + 1)
+            FROM split WHERE rest <> ''
+        )
+        INSERT INTO Comments (post_id, user_id, created_at, body)
+            SELECT s.post_id, NULL, COALESCE(p.post_DateTime, ''), s.line
+            FROM split s JOIN Posts p ON p.post_id = s.post_id
+            WHERE s.line IS NOT NULL AND trim(s.line) <> ''
+            ORDER BY s.post_id, s.pos;
+
+        UPDATE Analytics SET comment_count = (
+            SELECT COUNT(*) FROM Comments c WHERE c.post_id = Analytics.post_id
+        );
+        UPDATE Posts SET comments = NULL WHERE comments IS NOT NULL;
+        UPDATE Analytics SET comments = NULL WHERE comments IS NOT NULL;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_count AFTER INSERT ON Comments
+        BEGIN
+            UPDATE Analytics SET comment_count = comment_count + 1 WHERE post_id = NEW.post_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_comments_uncount AFTER DELETE ON Comments
+        BEGIN
+            UPDATE Analytics SET comment_count = comment_count - 1 WHERE post_id = OLD.post_id;
+        END;
+    """),
+
+    (5, "Thumbnails stored beside attachment blobs", """
+        CREATE TABLE IF NOT EXISTS Thumbnails (
+            blob_hash TEXT PRIMARY KEY REFERENCES Blobs (blob_hash) ON DELETE CASCADE,
+            thumb BLOB NOT NULL
+        );
+    """),
+
+    (6, "Checkpoints for the bulk import tool", """
+        CREATE TABLE IF NOT EXISTS ImportProgress (
+            manifest TEXT PRIMARY KEY,
+            next_line INTEGER NOT NULL DEFAULT 0,
+            posts INTEGER NOT NULL DEFAULT 0,
+            deferred_indexes TEXT
+        );
+    """),
+
+    (7, "Engagement event log with hourly and daily rollups", """
+        -- Append-only log; kind is 1 = view, 2 = like, 3 = comment and n
+        -- counts identical events (same post, kind and second) stored as one row
+        CREATE TABLE IF NOT EXISTS Events (
+            event_id INTEGER PRIMARY KEY,
+            post_id INTEGER NOT NULL,
+            kind INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            n INTEGER NOT NULL DEFAULT 1
+        );
+
+        -- Rollups keyed by the bucket's start time in Unix seconds (UTC).
+        -- No foreign keys: a deleted post's history stays in the totals.
+        CREATE TABLE IF NOT EXISTS EngagementHourly (
+            post_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            views INTEGER NOT NULL DEFAULT 0,
+            likes INTEGER NOT NULL DEFAULT 0,
+            comments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (post_id, bucket)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_engagement_hourly_bucket ON EngagementHourly (bucket);
+
+        CREATE TABLE IF NOT EXISTS EngagementDaily (
+            post_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            views INTEGER NOT NULL DEFAULT 0,
+            likes INTEGER NOT NULL DEFAULT 0,
+            comments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (post_id, bucket)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_engagement_daily_bucket ON EngagementDaily (bucket);
+
+        -- Last event folded into the rollups by the compaction job
+        CREATE TABLE IF NOT EXISTS EventRollupState (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_event_id INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO EventRollupState (id, last_event_id) VALUES (1, 0);
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_event AFTER INSERT ON Comments
+        BEGIN
+            INSERT INTO Events (post_id, kind, ts)
+            VALUES (NEW.post_id, 3, CAST(strftime('%s', 'now') AS INTEGER));
+        END;
+    """),
+
+    (8, "Full-text search over post descriptions and comments", """
+        -- External-content FTS5 indexes: the text lives only in Posts and
+        -- Comments, the indexes store the tokens and are kept in sync by triggers
+        CREATE VIRTUAL TABLE IF NOT EXISTS PostSearch USING fts5 (
+            content, content = 'Posts', content_rowid = 'post_id', tokenize = 'unicode61 remove_diacritics 2'
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS CommentSearch USING fts5 (
+            body, content = 'Comments', content_rowid = 'comment_id', tokenize = 'unicode61 remove_diacritics 2'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_search_insert AFTER INSERT ON Posts
+        BEGIN
+            INSERT INTO PostSearch (rowid, content) VALUES (NEW.post_id, COALESCE(NEW.content, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_posts_search_delete AFTER DELETE ON Posts
+        BEGIN
+            INSERT INTO PostSearch (PostSearch, rowid, content) VALUES ('delete', OLD.post_id, COALESCE(OLD.content, ''));
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_posts_search_update AFTER UPDATE OF content ON Posts
+        BEGIN
+            INSERT INTO PostSearch (PostSearch, rowid, content) VALUES ('delete', OLD.post_id, COALESCE(OLD.content, ''));
+            INSERT INTO PostSearch (rowid, content) VALUES (NEW.post_id, COALESCE(NEW.content, ''));
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_comments_search_insert AFTER INSERT ON Comments
+        BEGIN
+            INSERT INTO CommentSearch (rowid, body) VALUES (NEW.comment_id, NEW.body);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_comments_search_delete AFTER DELETE ON Comments
+        BEGIN
+            INSERT INTO CommentSearch (CommentSearch, rowid, body) VALUES ('delete', OLD.comment_id, OLD.body);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_comments_search_update AFTER UPDATE OF body ON Comments
+        BEGIN
+            INSERT INTO CommentSearch (CommentSearch, rowid, body) VALUES ('delete', OLD.comment_id, OLD.body);
+            INSERT INTO CommentSearch (rowid, body) VALUES (NEW.comment_id, NEW.body);
+        END;
+
+        -- Index everything already in the database
+        INSERT INTO PostSearch (PostSearch) VALUES ('rebuild');
+        INSERT INTO CommentSearch (CommentSearch) VALUES ('rebuild');
+    """),
+
+    (9, "Shard identity for databases split across several files", """
+        -- Which shard this file is and how many there are, filled in by
+        -- final_db the first time the file is opened
+        CREATE TABLE IF NOT EXISTS ShardInfo (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            shard_index INTEGER NOT NULL,
+            shard_count INTEGER NOT NULL
+        );
+    """),
+
+    (10, "Compression codec and stored size of each blob", """
+        -- Blobs written before this are stored uncompressed
+        ALTER TABLE Blobs ADD COLUMN codec TEXT NOT NULL DEFAULT 'raw';
+        ALTER TABLE Blobs ADD COLUMN stored_size INTEGER;
+        UPDATE Blobs SET stored_size = size;
+    """),
+
+    (11, "Numeric post times, per-user feed indexes, follows and timelines", """
+        -- post_DateTime is local wall-clock text; post_ts is the same moment
+        -- in Unix seconds (0 if the text cannot be read), filled by triggers
+        ALTER TABLE Posts ADD COLUMN post_ts INTEGER;
+        UPDATE Posts SET post_ts = COALESCE(CAST(strftime('%s', post_DateTime, 'utc') AS INTEGER), 0);
+
+        CREATE TRIGGER IF NOT EXISTS trg_posts_ts AFTER INSERT ON Posts WHEN NEW.post_ts IS NULL
+        BEGIN
+            UPDATE Posts SET post_ts = COALESCE(CAST(strftime('%s', NEW.post_DateTime, 'utc') AS INTEGER), 0)
+            WHERE post_id = NEW.post_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_posts_ts_update AFTER UPDATE OF post_DateTime ON Posts
+        BEGIN
+            UPDATE Posts SET post_ts = COALESCE(CAST(strftime('%s', NEW.post_DateTime, 'utc') AS INTEGER), 0)
+            WHERE post_id = NEW.post_id;
+        END;
+
+        -- A user's posts newest first, and all posts in a time window.
+        -- The rowid (post_id) is part of both, which breaks ties in order.
+        DROP INDEX IF EXISTS idx_posts_user;
+        CREATE INDEX IF NOT EXISTS idx_posts_user_ts ON Posts (user_id, post_ts);
+        CREATE INDEX IF NOT EXISTS idx_posts_ts ON Posts (post_ts);
+
+        -- Stored in the followed user's shard, next to the posts it fans out
+        CREATE TABLE IF NOT EXISTS Follows (
+            followee_id INTEGER NOT NULL,
+            follower_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (followee_id, follower_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_follows_follower ON Follows (follower_id);
+
+        -- Home timeline cache: one row per post pushed to a follower, stored
+        -- in the follower's shard. No foreign keys, the post may be in
+        -- another shard; deleted posts are removed by final_db.
+        CREATE TABLE IF NOT EXISTS Timelines (
+            user_id INTEGER NOT NULL,
+            post_ts INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, post_ts, post_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_timelines_post ON Timelines (post_id);
+    """),
+
+    (12, "Who liked each post, as one compressed bitmap per post", """
+        -- likers is a final_bitmaps.Bitmap of user ids and like_count its
+        -- size. Likes counted before this have no user and are only in
+        -- Analytics.likes.
+        CREATE TABLE IF NOT EXISTS PostLikes (
+            post_id INTEGER PRIMARY KEY REFERENCES Posts (post_id) ON DELETE CASCADE,
+            likers BLOB NOT NULL,
+            like_count INTEGER NOT NULL DEFAULT 0
+        );
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    """Return the schema version recorded in the database."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _statements(script):
+    """Split a migration script into single statements (trigger bodies stay whole)."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+
+
+def migrate(conn, verbose=False):
+    """
+    Bring the database up to LATEST_VERSION.
+    Each pending migration runs in its own transaction, so a failure leaves
+    the database at the last version that applied cleanly. conn must be
+    in autocommit mode (isolation_level=None).
+    Returns:
+        int: The schema version after migrating.
+    """
+    version = get_version(conn)
+    for target, description, script in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have applied it while we waited for the lock
+            version = get_version(conn)
+            if target > version:
+                if verbose:
+                    print(f"Applying migration {target}: {description}")
+                for statement in _statements(script):
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target}")
+                version = target
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    return version
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "final.db"
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("PRAGMA foreign_keys = ON")
+    print(f"{path}: schema version {get_version(connection)}")
+    print(f"{path}: schema version {migrate(connection, verbose=True)}")
+    connection.close()
@@ -0,0 +1,394 @@
+# final_server.py - Headless HTTP/JSON API over final_db
+#
+# Usage: python final_server.py [--host 127.0.0.1] [--port 8080] [--workers N]
+#                               [--db PATH] [--blob-dir PATH] [--shards N]
+#
+# Endpoints (all responses are JSON except file downloads):
+#   GET  /posts?after_id=0&limit=20         page of posts, oldest first (keyset paging)
+#   GET  /posts/<id>                        post, analytics and attachment list
+#   GET  /posts/<id>/comments?after_id=0    page of comments
+#   GET  /posts/<id>/files/<n>              download the n-th attachment (1-3), streamed
+#   POST /posts/<id>/view                   count a view, returns the analytics
+#   POST /posts/<id>/like?user_id=<user>    like as a user (once per user), returns the analytics
+#   POST /posts/<id>/unlike?user_id=<user>  take the user's like back
+#   GET  /users/<id>/posts?limit=20         a user's posts, newest first; continue
+#        &before_post=<post_id>             after a post, or start at &before=<unix time>
+#   GET  /users/<id>/feed?limit=20          posts of the users they follow (same paging)
+#   POST /users/<id>/follow/<other>         follow another user
+#   POST /users/<id>/unfollow/<other>       stop following another user
+#   GET  /search?q=words&limit=20&offset=0  full-text search
+#   GET  /stats                             object cache, storage and tracing statistics
+#
+# The event loop only parses requests and writes responses; every final_db
+# call runs on a thread pool, where each worker thread keeps its own pooled
+# connection. Connections are kept alive between requests. The server
+# listens on localhost only unless --host says otherwise.
+
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+import final_blobs
+import final_db
+import final_trace
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 8
+
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 200
+DEFAULT_PAGE_SIZE = 20
+
+# Bytes read from an attachment per write to the socket
+STREAM_CHUNK_SIZE = 256 * 1024
+
+MAX_HEADER_BYTES = 16 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def post_to_dict(post):
+    return {"post_id": post.get_post_id(), "user_id": post.get_user_id(),
+            "date_time": post.get_date_time(), "content": post.get_content()}
+
+
+def analytics_to_dict(analytics):
+    return {"post_id": analytics.get_post_id(), "likes": analytics.get_likes(),
+            "views": analytics.get_views(), "comment_count": analytics.get_comment_count()}
+
+
+def comment_to_dict(comment):
+    return {"comment_id": comment.get_comment_id(), "post_id": comment.get_post_id(),
+            "user_id": comment.get_user_id(), "created_at": comment.get_created_at(),
+            "body": comment.get_body()}
+
+
+# ---- Handlers (run on the worker pool, no asyncio calls in these) ----
+
+def list_posts(after_id, limit):
+    posts = []
+    for post in final_db.iter_posts(page_size=limit, after_id=after_id):
+        posts.append(post_to_dict(post))
+        if len(posts) == limit:
+            break
+    next_after = posts[-1]["post_id"] if len(posts) == limit else None
+    return {"posts": posts, "next_after_id": next_after}
+
+
+def post_detail(post_id):
+    post = final_db.get_post_by_id(post_id)
+    if post is None:
+        raise HTTPError(404, f"post {post_id} not found")
+    analytics = final_db.get_analytics_by_post_id(post_id)
+    files = [{"slot": slot, "name": name, "size": handle.get_size()}
+             for slot, (name, handle) in enumerate(final_db.get_attached_files(post_id), start=1)]
+    return {"post": post_to_dict(post),
+            "analytics": analytics_to_dict(analytics) if analytics else None,
+            "files": files}
+
+
+def post_comments(post_id, after_id, limit):
+    comments = final_db.get_comments(post_id, after_id, limit)
+    next_after = comments[-1].get_comment_id() if len(comments) == limit else None
+    return {"comments": [comment_to_dict(c) for c in comments], "next_after_id": next_after}
+
+
+def count(post_id, action, user_id=None):
+    if final_db.get_post_by_id(post_id) is None:
+        raise HTTPError(404, f"post {post_id} not found")
+    if action == "view":
+        final_db.increment_view(post_id)
+        return analytics_to_dict(final_db.get_analytics_by_post_id(post_id))
+    if action == "like":
+        final_db.increment_like(post_id, user_id)
+    else:
+        final_db.remove_like(post_id, user_id)
+    body = analytics_to_dict(final_db.get_analytics_by_post_id(post_id))
+    body["liked"] = final_db.has_liked(post_id, user_id)
+    body["like_count"] = final_db.get_like_count(post_id)
+    return body
+
+
+def open_attachment(post_id, slot):
+    files = final_db.get_attached_files(post_id)
+    if not 1 <= slot <= len(files):
+        raise HTTPError(404, f"post {post_id} has no file {slot}")
+    name, handle = files[slot - 1]
+    return name, handle.get_size(), handle.stream()
+
+
+def user_feed(user_id, home, before, before_post, limit):
+    if before_post:
+        before = final_db.get_post_by_id(before_post)
+        if before is None:
+            raise HTTPError(404, f"post {before_post} not found")
+    elif before:
+        before = datetime.fromtimestamp(before)
+    else:
+        before = None
+    feed = final_db.get_home_feed if home else final_db.get_feed
+    posts = [post_to_dict(p) for p in feed(user_id, before, limit)]
+    next_before = posts[-1]["post_id"] if len(posts) == limit else None
+    return {"posts": posts, "next_before_post": next_before}
+
+
+def change_follow(user_id, action, other_id):
+    if user_id == other_id:
+        raise HTTPError(400, "users cannot follow themselves")
+    if action == "follow":
+        final_db.follow(user_id, other_id)
+    else:
+        final_db.unfollow(user_id, other_id)
+    return {"user_id": user_id, "other_id": other_id, "following": action == "follow"}
+
+
+def search(query, limit, offset):
+    return {"posts": [post_to_dict(p) for p in final_db.search_posts(query, limit, offset)]}
+
+
+def server_stats():
+    return {"caches": final_db.cache_stats(), "storage": final_db.storage_stats(),
+            "trace": final_trace.get_stats()}
+
+
+# ---- HTTP ----
+
+def _int_param(params, name, default, low=0, high=None):
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer")
+    if high is None and value < low:
+        raise HTTPError(400, f"{name} must be at least {low}")
+    if high is not None and not low <= value <= high:
+        raise HTTPError(400, f"{name} must be between {low} and {high}")
+    return value
+
+
+class APIServer:
+    """Serves the JSON API; one instance per listening socket."""
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-db")
+
+    async def run_db(self, func, *args):
+        """Run a final_db call on the worker pool and wait for its result."""
+        return await asyncio.get_running_loop().run_in_executor(self.__pool, func, *args)
+
+    def close(self):
+        self.__pool.shutdown(wait=True)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self.send_json(writer, 413, {"error": "request headers too large"}, False)
+                    return
+
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    await self.send_json(writer, 400, {"error": "bad request line"}, False)
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                # Request bodies are not used by any endpoint; read and drop them
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    await self.send_json(writer, 400, {"error": "bad Content-Length"}, False)
+                    return
+                if length:
+                    await reader.readexactly(length)
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                if not await self.dispatch(method, target, writer, keep_alive):
+                    return
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def dispatch(self, method, target, writer, keep_alive):
+        """
+        Answer one request.
+        Returns:
+            bool: Whether the connection can take another request.
+        """
+        url = urlsplit(target)
+        parts = [p for p in url.path.split("/") if p]
+        params = parse_qs(url.query)
+        try:
+            if parts == ["posts"] and method == "GET":
+                after_id = _int_param(params, "after_id", 0)
+                limit = _int_param(params, "limit", DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+                body = await self.run_db(list_posts, after_id, limit)
+            elif len(parts) >= 2 and parts[0] == "posts":
+                try:
+                    post_id = int(parts[1])
+                except ValueError:
+                    raise HTTPError(404, "no such endpoint")
+                rest = parts[2:]
+                if rest == [] and method == "GET":
+                    body = await self.run_db(post_detail, post_id)
+                elif rest == ["comments"] and method == "GET":
+                    after_id = _int_param(params, "after_id", 0)
+                    limit = _int_param(params, "limit", final_db.COMMENT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+                    body = await self.run_db(post_comments, post_id, after_id, limit)
+                elif rest == ["view"] and method == "POST":
+                    body = await self.run_db(count, post_id, "view")
+                elif rest in (["like"], ["unlike"]) and method == "POST":
+                    if "user_id" not in params:
+                        raise HTTPError(400, "user_id is required")
+                    user_id = _int_param(params, "user_id", 0, 1, 2 ** 32 - 1)
+                    body = await self.run_db(count, post_id, rest[0], user_id)
+                elif len(rest) == 2 and rest[0] == "files" and rest[1].isdigit() and method == "GET":
+                    return await self.send_file(writer, post_id, int(rest[1]), keep_alive)
+                elif rest in ([], ["comments"], ["view"], ["like"], ["unlike"]) or (len(rest) == 2 and rest[0] == "files"):
+                    raise HTTPError(405, "method not allowed")
+                else:
+                    raise HTTPError(404, "no such endpoint")
+            elif len(parts) >= 3 and parts[0] == "users" and parts[1].isdigit():
+                user_id = int(parts[1])
+                rest = parts[2:]
+                if rest in (["posts"], ["feed"]) and method == "GET":
+                    before = _int_param(params, "before", 0)
+                    before_post = _int_param(params, "before_post", 0)
+                    limit = _int_param(params, "limit", final_db.FEED_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+                    body = await self.run_db(user_feed, user_id, rest == ["feed"], before, before_post, limit)
+                elif len(rest) == 2 and rest[0] in ("follow", "unfollow") and rest[1].isdigit() and method == "POST":
+                    body = await self.run_db(change_follow, user_id, rest[0], int(rest[1]))
+                elif rest in (["posts"], ["feed"]) or (len(rest) == 2 and rest[0] in ("follow", "unfollow")):
+                    raise HTTPError(405, "method not allowed")
+                else:
+                    raise HTTPError(404, "no such endpoint")
+            elif parts == ["search"] and method == "GET":
+                query = params.get("q", [""])[0]
+                limit = _int_param(params, "limit", DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+                offset = _int_param(params, "offset", 0)
+                body = await self.run_db(search, query, limit, offset)
+            elif parts == ["stats"] and method == "GET":
+                body = await self.run_db(server_stats)
+            else:
+                raise HTTPError(404, "no such endpoint")
+        except HTTPError as e:
+            await self.send_json(writer, e.status, {"error": str(e)}, keep_alive)
+        except Exception as e:
+            print("Error handling", method, target, "-", e)
+            await self.send_json(writer, 500, {"error": "internal error"}, keep_alive)
+        else:
+            await self.send_json(writer, 200, body, keep_alive)
+        return keep_alive
+
+    async def send_json(self, writer, status, body, keep_alive):
+        data = json.dumps(body).encode("utf-8")
+        self.write_head(writer, status, "application/json", len(data), keep_alive)
+        writer.write(data)
+        await writer.drain()
+
+    def write_head(self, writer, status, content_type, length, keep_alive, extra=""):
+        writer.write((
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {length}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"{extra}\r\n"
+        ).encode("latin-1"))
+
+    async def send_file(self, writer, post_id, slot, keep_alive):
+        """
+        Stream an attachment to the client one chunk at a time.
+        Once the headers are out an error can no longer be reported, so if
+        the file cannot be read to the end the connection is closed, which
+        tells the client the body is incomplete.
+        Returns:
+            bool: Whether the connection can take another request.
+        """
+        try:
+            name, size, stream = await self.run_db(open_attachment, post_id, slot)
+        except HTTPError as e:
+            await self.send_json(writer, e.status, {"error": str(e)}, keep_alive)
+            return keep_alive
+        safe_name = name.replace('"', "")
+        self.write_head(writer, 200, "application/octet-stream", size, keep_alive,
+                        f'Content-Disposition: attachment; filename="{safe_name}"\r\n')
+        sent = 0
+        try:
+            with stream:
+                while True:
+                    chunk = await self.run_db(stream.read, STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    sent += len(chunk)
+                    await writer.drain()
+        except ConnectionError:
+            return False
+        except Exception as e:
+            print(f"Error streaming file {slot} of post {post_id} after {sent} bytes -", e)
+            return False
+        if sent != size:
+            print(f"File {slot} of post {post_id} ended after {sent} of {size} bytes")
+            return False
+        return keep_alive
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS):
+    api = APIServer(workers)
+    server = await asyncio.start_server(api.handle_client, host, port, limit=MAX_HEADER_BYTES)
+    shards = f" ({final_db.SHARD_COUNT} shards)" if final_db.SHARD_COUNT > 1 else ""
+    print(f"Serving {final_db.DB_PATH}{shards} on http://{host}:{port} with {workers} database workers")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        api.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve posts and analytics over HTTP/JSON.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on (default: localhost only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="database worker threads")
+    parser.add_argument("--db", default=final_db.DB_PATH, help="database file to serve")
+    parser.add_argument("--blob-dir", default=final_blobs.BLOB_DIR, help="blob store folder for --db")
+    parser.add_argument("--shards", type=int, default=final_db.SHARD_COUNT, help="number of database shards")
+    args = parser.parse_args(argv)
+
+    final_db.DB_PATH = args.db
+    final_db.SHARD_COUNT = args.shards
+    final_blobs.BLOB_DIR = args.blob_dir
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        final_db.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# final_shards.py - Splits a database into shards and shows how posts are spread
+#
+# Usage: python final_shards.py split N [--db PATH] [--blob-dir PATH]
+#        python final_shards.py info [--db PATH] [--shards N]
+#
+# split moves every post whose post_id % N is not 0, with its analytics,
+# comments, likes, attachments, thumbnails and engagement rollups, and
+# the follows and timelines of every user whose user_id % N is not 0, into
+# the files final.shard1.db ... final.shard<N-1>.db next to the database (see the
+# SHARDS section of final_db). Close the app before splitting. The new files
+# are filled first and the original is only changed at the end, so if a
+# split is interrupted, delete the new shard files and run it again.
+# Afterwards start the app with FINAL_DB_SHARDS=N (or --shards N).
+#
+# The blob store folder stays shared by all shards.
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import final_blobs
+import final_db
+import final_schema
+
+# Tables copied to the shard that owns each row's post
+POST_TABLES = ("Posts", "Attachments", "Comments", "PostLikes", "EngagementHourly", "EngagementDaily")
+
+# Tables copied to the shard of a user, with the column holding the user
+USER_TABLES = {"Follows": "followee_id", "Timelines": "user_id"}
+
+
+def _columns(conn, table):
+    return ", ".join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+
+
+def _copy_shard(conn, path, shard, count):
+    """Create one shard file and copy its rows into it from the source database."""
+    target = sqlite3.connect(path, isolation_level=None)
+    try:
+        target.execute("PRAGMA journal_mode = WAL")
+        final_schema.migrate(target)
+        target.execute("INSERT INTO ShardInfo (id, shard_index, shard_count) VALUES (1, ?, ?)", (shard, count))
+    finally:
+        target.close()
+
+    conn.execute("ATTACH DATABASE ? AS shard", (path,))
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        where = f"post_id % {count} = {shard}"
+        # Blob rows start unreferenced; the Attachments trigger counts them up
+        conn.execute(f"""
+            INSERT INTO shard.Blobs (blob_hash, size, ref_count, codec, stored_size)
+            SELECT b.blob_hash, b.size, 0, b.codec, b.stored_size FROM main.Blobs b
+            WHERE b.blob_hash IN (SELECT blob_hash FROM main.Attachments WHERE {where})
+        """)
+        for table in POST_TABLES:
+            columns = _columns(conn, table)
+            conn.execute(f"INSERT INTO shard.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE {where}")
+        for table, user_column in USER_TABLES.items():
+            conn.execute(f"INSERT INTO shard.{table} SELECT * FROM main.{table} WHERE {user_column} % {count} = {shard}")
+        conn.execute("""
+            INSERT INTO shard.Thumbnails (blob_hash, thumb)
+            SELECT blob_hash, thumb FROM main.Thumbnails WHERE blob_hash IN (SELECT blob_hash FROM shard.Blobs)
+        """)
+        # Triggers created the Analytics rows and counted the comments; the
+        # views and likes come from the source. The comment trigger also
+        # logged each copied comment as a new event, but those are already
+        # in the copied rollups.
+        conn.execute("""
+            UPDATE shard.Analytics AS a SET views = s.views, likes = s.likes
+            FROM main.Analytics AS s WHERE s.post_id = a.post_id
+        """)
+        conn.execute("DELETE FROM shard.Events")
+        # Carry over the id high-water marks so no shard hands out an id
+        # that another shard still uses
+        conn.execute("DELETE FROM shard.sqlite_sequence")
+        conn.execute("INSERT INTO shard.sqlite_sequence (name, seq) SELECT name, seq FROM main.sqlite_sequence")
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("DETACH DATABASE shard")
+
+
+def split(db_path, count):
+    """
+    Split a single-file database into count shards.
+    Returns:
+        list: Number of posts in each shard afterwards.
+    """
+    if count < 2:
+        raise SystemExit("Split into at least 2 shards.")
+    final_db.DB_PATH = db_path
+    final_db.SHARD_COUNT = 1
+    paths = [final_db.shard_path(shard) for shard in range(count)]
+    existing = [path for path in paths[1:] if os.path.exists(path)]
+    if existing:
+        raise SystemExit(f"Shard files already exist, delete them first: {', '.join(existing)}")
+
+    # Opening it through final_db migrates it and checks it is not already sharded
+    final_db.get_connection()
+    final_db.flush_counters()
+    final_db.compact_events()
+    final_db.close_all()
+
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA foreign_keys = ON")
+        # Unreferenced blobs would otherwise leave files nobody can collect
+        conn.execute("BEGIN IMMEDIATE")
+        final_blobs.collect_garbage(conn.cursor())
+        conn.execute("COMMIT")
+
+        for shard in range(1, count):
+            _copy_shard(conn, paths[shard], shard, count)
+            print(f"  wrote {paths[shard]}")
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            where = f"post_id % {count} <> 0"
+            # Cascades remove the moved posts' analytics, comments and attachments
+            conn.execute(f"DELETE FROM Posts WHERE {where}")
+            conn.execute(f"DELETE FROM EngagementHourly WHERE {where}")
+            conn.execute(f"DELETE FROM EngagementDaily WHERE {where}")
+            for table, user_column in USER_TABLES.items():
+                conn.execute(f"DELETE FROM {table} WHERE {user_column} % {count} <> 0")
+            # The moved blobs' files now belong to the other shards, so only drop the rows
+            conn.execute("DELETE FROM Blobs WHERE ref_count <= 0")
+            conn.execute("INSERT OR REPLACE INTO ShardInfo (id, shard_index, shard_count) VALUES (1, 0, ?)", (count,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+    final_db.SHARD_COUNT = count
+    counts = post_counts()
+    print(f"Split {db_path} into {count} shards in {time.perf_counter() - started:.1f}s")
+    return counts
+
+
+def post_counts():
+    """Return the number of posts in each shard."""
+    return final_db.fan_out(lambda shard: final_db.get_connection(shard).execute(
+        "SELECT COUNT(*) FROM Posts").fetchone()[0])
+
+
+def info():
+    """Print each shard's file, post count and size."""
+    for shard, posts in enumerate(post_counts()):
+        path = final_db.shard_path(shard)
+        print(f"  shard {shard}: {path}, {posts} posts, {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split the database into shards or show the shards.")
+    parser.add_argument("command", choices=("split", "info"))
+    parser.add_argument("count", type=int, nargs="?", help="number of shards to split into")
+    parser.add_argument("--db", default=final_db.DB_PATH, help="database file (shard 0)")
+    parser.add_argument("--blob-dir", default=final_blobs.BLOB_DIR, help="blob store folder for --db")
+    parser.add_argument("--shards", type=int, default=final_db.SHARD_COUNT, help="number of shards for info")
+    args = parser.parse_args(argv)
+
+    final_blobs.BLOB_DIR = args.blob_dir
+    if args.command == "split":
+        if args.count is None:
+            parser.error("split needs the number of shards")
+        for shard, posts in enumerate(split(args.db, args.count)):
+            print(f"  shard {shard}: {posts} posts")
+    else:
+        final_db.DB_PATH = args.db
+        final_db.SHARD_COUNT = args.shards
+        info()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+# final_tempcache.py - On-disk cache of attachments opened with the system viewer
+# Each file is written once to <folder>/<hash>/<file name>, keyed by the
+# attachment's content hash, so opening it again reuses the same file and
+# two attachments with the same name never overwrite each other. Files are
+# written under a temp name and renamed into place. When the folder grows
+# past max_bytes the least recently opened files are deleted.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import final_blobs
+
+# Default disk budget for opened files (bytes)
+TEMP_CACHE_BYTES = 256 * 1024 * 1024
+
+_TEMP_PREFIX = ".tmp-"
+
+
+class TempFileCache:
+    """
+    Content-addressed folder of attachment copies with LRU eviction.
+    A file's modification time is bumped every time it is opened and is
+    used as its last-use time when evicting.
+    """
+
+    def __init__(self, folder, max_bytes=TEMP_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+
+    def get_path(self, handle, file_name):
+        """
+        Return a path holding the attachment's bytes, writing it only if
+        this content has not been opened before.
+        """
+        file_name = os.path.basename(file_name) or "attachment"
+        with self.__lock:
+            blob_hash = handle.get_hash()
+            if blob_hash:
+                path = os.path.join(self.folder, blob_hash, file_name)
+                if os.path.exists(path):
+                    os.utime(path)
+                    return path
+            path = self.__write(handle, file_name, blob_hash)
+            self.__evict(keep=path)
+            return path
+
+    def cleanup(self):
+        """
+        Remove half-written files and files left by the old temp_<name>
+        layout, then evict down to max_bytes (run at startup and shutdown).
+        """
+        with self.__lock:
+            if not os.path.isdir(self.folder):
+                return
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and (entry.name.startswith(_TEMP_PREFIX) or entry.name.startswith("temp_")):
+                    _remove(entry.path)
+            self.__evict()
+
+    def get_total_bytes(self):
+        with self.__lock:
+            return sum(size for _, size, _ in self.__entries())
+
+    def __write(self, handle, file_name, blob_hash):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix=_TEMP_PREFIX)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, "wb") as f, handle.stream() as reader:
+                while True:
+                    chunk = reader.read(final_blobs.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            # Older inline attachments have no stored hash; key them by their content
+            blob_hash = blob_hash or digest.hexdigest()
+            path = os.path.join(self.folder, blob_hash, file_name)
+            if os.path.exists(path):
+                os.remove(temp_path)
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+            return path
+        except BaseException:
+            _remove(temp_path)
+            raise
+
+    def __entries(self):
+        """(path, size, last use) for every cached file."""
+        entries = []
+        if not os.path.isdir(self.folder):
+            return entries
+        for folder in os.scandir(self.folder):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def __evict(self, keep=None):
+        entries = self.__entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            # A file still open in another program (Windows) cannot be deleted yet
+            if _remove(path):
+                total -= size
+                folder = os.path.dirname(path)
+                if not os.listdir(folder):
+                    shutil.rmtree(folder, ignore_errors=True)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,102 @@
+# final_thumbs.py - Thumbnail generation and a bounded cache of decoded images
+# Thumbnails are made once when a post is stored and kept in the Thumbnails
+# table next to the attachment's blob, so the post screen only ever decodes
+# a small image. PIL is imported on first use.
+
+import io
+from collections import OrderedDict
+
+THUMB_SIZE = (200, 200)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Default memory budget for decoded images (bytes)
+IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def is_image(file_name):
+    """Return True if the file name looks like an image we can preview."""
+    return file_name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def make_thumbnail(source):
+    """
+    Build a PNG thumbnail from image bytes or a file-like object.
+    Returns:
+        bytes: The encoded thumbnail, or None if it cannot be decoded.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as image:
+            # Let JPEG decode at reduced scale instead of full resolution
+            image.draft("RGB", THUMB_SIZE)
+            image.thumbnail(THUMB_SIZE)
+            if image.mode not in ("RGB", "RGBA", "L", "LA"):
+                image = image.convert("RGBA")
+            out = io.BytesIO()
+            image.save(out, format="PNG", optimize=True)
+            return out.getvalue()
+    except Exception:
+        return None
+
+
+def thumbnail_file(path):
+    """Build a thumbnail from an image file on disk (process pool worker)."""
+    try:
+        with open(path, "rb") as f:
+            return make_thumbnail(f)
+    except OSError:
+        return None
+
+
+class ImageCache:
+    """
+    LRU cache of decoded images with a memory budget.
+    Each entry is charged width * height * 4 bytes, the size of its RGBA
+    pixels, and the least recently used entries are dropped when the total
+    goes over max_bytes.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.__entries = OrderedDict()  # key -> (image, cost)
+        self.__total = 0
+
+    def get(self, key):
+        """Return a cached image and mark it recently used, or None."""
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        self.__entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, image, width, height):
+        """Add an image to the cache, evicting older entries as needed."""
+        cost = width * height * 4
+        if key in self.__entries:
+            self.__total -= self.__entries.pop(key)[1]
+        if cost > self.max_bytes:
+            return
+        self.__entries[key] = (image, cost)
+        self.__total += cost
+        while self.__total > self.max_bytes:
+            _, (_, old_cost) = self.__entries.popitem(last=False)
+            self.__total -= old_cost
+
+    def clear(self):
+        self.__entries.clear()
+        self.__total = 0
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_total_bytes(self):
+        return self.__total
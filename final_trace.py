@@ -0,0 +1,245 @@
+# final_trace.py - Opt-in query tracing and latency statistics for final_db
+# When tracing is on, every statement run through a pooled connection is
+# timed (execute plus the fetches that read its rows) and counted together
+# with the rows and BLOB bytes it returned. Statements SQLite runs inside
+# triggers and virtual tables are counted through its trace callback, and
+# the public final_db functions record latency histograms. Statements
+# slower than SLOW_QUERY_MS go to a slow-query log.
+#
+# Turn it on with final_db.enable_tracing() or by setting FINAL_DB_TRACE=1
+# (and optionally FINAL_DB_SLOW_MS) before starting the app. Read the
+# results with get_stats(), dump_json() or the Debug screen.
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+enabled = os.environ.get("FINAL_DB_TRACE", "") not in ("", "0")
+
+# Statements taking longer than this (milliseconds) are logged
+SLOW_QUERY_MS = float(os.environ.get("FINAL_DB_SLOW_MS", 50))
+SLOW_LOG_SIZE = 100
+
+# Upper bounds (milliseconds) of the latency histogram buckets
+HISTOGRAM_BOUNDS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000, float("inf"))
+
+_lock = threading.Lock()
+_queries = {}      # normalized SQL -> [executions, seconds, max seconds, rows, blob bytes]
+_statements = {}   # SQL seen by the trace callback (including trigger steps) -> count
+_functions = {}    # function name -> [calls, seconds, max seconds, histogram counts]
+_slow_queries = deque(maxlen=SLOW_LOG_SIZE)
+
+
+def _normalize(sql):
+    return " ".join(sql.split())
+
+
+def _blob_bytes(rows):
+    total = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                total += len(value)
+    return total
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that times its statement and everything fetched from it."""
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, 1)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._add(time.perf_counter() - started, ())
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self._begin(sql, len(seq_of_parameters))
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._add(time.perf_counter() - started, ())
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._add(time.perf_counter() - started, () if row is None else (row,))
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add(time.perf_counter() - started, rows)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._add(time.perf_counter() - started, rows)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._add(time.perf_counter() - started, (row,))
+        return row
+
+    def _begin(self, sql, executions):
+        self._sql = _normalize(sql)
+        self._elapsed = 0.0
+        self._slow_entry = None
+        with _lock:
+            entry = _queries.setdefault(self._sql, [0, 0.0, 0.0, 0, 0])
+            entry[0] += executions
+
+    def _add(self, seconds, rows):
+        sql = getattr(self, "_sql", None)
+        if sql is None:
+            return
+        self._elapsed += seconds
+        with _lock:
+            entry = _queries[sql]
+            entry[1] += seconds
+            entry[2] = max(entry[2], self._elapsed)
+            entry[3] += len(rows)
+            entry[4] += _blob_bytes(rows)
+            # One log entry per statement, updated while its rows are fetched
+            if self._elapsed * 1000 >= SLOW_QUERY_MS:
+                if self._slow_entry is None:
+                    self._slow_entry = {"sql": sql, "ms": 0.0, "rows": 0,
+                                        "at": datetime.now().isoformat(timespec="seconds")}
+                    _slow_queries.append(self._slow_entry)
+                self._slow_entry["ms"] = round(self._elapsed * 1000, 3)
+            if self._slow_entry is not None:
+                self._slow_entry["rows"] += len(rows)
+
+
+def trace_statement(sql):
+    """sqlite3 trace callback: counts every statement SQLite runs, trigger steps included."""
+    if not enabled:
+        return
+    sql = _normalize(sql)
+    with _lock:
+        _statements[sql] = _statements.get(sql, 0) + 1
+
+
+def timed(func):
+    """Decorator that records a function's latency while tracing is on."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_call(func.__name__, time.perf_counter() - started)
+    return wrapper
+
+
+def record_call(name, seconds):
+    """Add one call of a function to its latency histogram."""
+    ms = seconds * 1000
+    with _lock:
+        entry = _functions.get(name)
+        if entry is None:
+            entry = _functions[name] = [0, 0.0, 0.0, [0] * len(HISTOGRAM_BOUNDS_MS)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if ms <= bound:
+                entry[3][i] += 1
+                break
+
+
+def _histogram_percentile(counts, fraction):
+    """Upper bound of the bucket holding the given fraction of calls."""
+    target = sum(counts) * fraction
+    seen = 0
+    for bound, count in zip(HISTOGRAM_BOUNDS_MS, counts):
+        seen += count
+        if count and seen >= target:
+            return bound
+    return 0.0
+
+
+def reset():
+    """Forget everything recorded so far."""
+    with _lock:
+        _queries.clear()
+        _statements.clear()
+        _functions.clear()
+        _slow_queries.clear()
+
+
+def get_stats():
+    """
+    Return a snapshot of everything recorded, as plain JSON-serializable values.
+    Queries and functions are sorted by total time, slowest first.
+    """
+    with _lock:
+        queries = [
+            {"sql": sql, "executions": n, "total_ms": round(total * 1000, 3),
+             "max_ms": round(longest * 1000, 3), "rows": rows, "blob_bytes": blob_bytes}
+            for sql, (n, total, longest, rows, blob_bytes) in _queries.items()
+        ]
+        functions = [
+            {"name": name, "calls": n, "total_ms": round(total * 1000, 3),
+             "mean_ms": round(total * 1000 / n, 4), "max_ms": round(longest * 1000, 3),
+             # The last bucket is open-ended, so never report more than the slowest call
+             "p50_ms": min(_histogram_percentile(counts, 0.5), round(longest * 1000, 3)),
+             "p99_ms": min(_histogram_percentile(counts, 0.99), round(longest * 1000, 3)),
+             "histogram": {("inf" if bound == float("inf") else str(bound)): count
+                           for bound, count in zip(HISTOGRAM_BOUNDS_MS, counts)}}
+            for name, (n, total, longest, counts) in _functions.items()
+        ]
+        statements = dict(_statements)
+        slow = [dict(entry) for entry in _slow_queries]
+    queries.sort(key=lambda q: q["total_ms"], reverse=True)
+    functions.sort(key=lambda f: f["total_ms"], reverse=True)
+    return {
+        "enabled": enabled,
+        "slow_query_ms": SLOW_QUERY_MS,
+        "queries": queries,
+        "functions": functions,
+        "statements_run": sum(statements.values()),
+        "nested_statements": {sql: n for sql, n in statements.items() if sql.startswith("--")},
+        "slow_queries": slow,
+    }
+
+
+def dump_json(path=None):
+    """Return the stats as JSON text, also writing them to path if given."""
+    text = json.dumps(get_stats(), indent=2)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+    return text
+
+
+def format_stats(stats=None, limit=10):
+    """Render get_stats() as readable text for the Debug screen."""
+    stats = stats or get_stats()
+    lines = [f"Tracing: {'on' if stats['enabled'] else 'off'}   "
+             f"slow query threshold: {stats['slow_query_ms']} ms   "
+             f"statements run: {stats['statements_run']}", "", "Functions (by total time):"]
+    for f in stats["functions"][:limit]:
+        lines.append(f"  {f['name']}: {f['calls']} calls, mean {f['mean_ms']:.3f} ms, "
+                     f"p50 <= {f['p50_ms']} ms, p99 <= {f['p99_ms']} ms, max {f['max_ms']:.3f} ms")
+    lines += ["", "Queries (by total time):"]
+    for q in stats["queries"][:limit]:
+        lines.append(f"  {q['total_ms']:.3f} ms, {q['executions']}x, {q['rows']} rows, "
+                     f"{q['blob_bytes']} blob bytes: {q['sql'][:120]}")
+    lines += ["", "Slow queries:"]
+    for q in list(stats["slow_queries"])[-limit:]:
+        lines.append(f"  {q['at']}  {q['ms']:.1f} ms, {q['rows']} rows: {q['sql'][:120]}")
+    return "\n".join(lines)
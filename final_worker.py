@@ -0,0 +1,84 @@
+# final_worker.py - Runs database work off the Tk main thread
+# UI handlers submit a function to the worker; it runs on a background
+# thread (with its own pooled SQLite connection) and the result is handed
+# back to a callback on the Tk thread, so the window never freezes on a
+# slow query or a lock wait.
+
+import itertools
+import queue
+import threading
+import traceback
+
+# How often the Tk thread checks for finished work (milliseconds)
+POLL_INTERVAL_MS = 20
+
+# Job priorities: user actions always run before background prefetching
+FOREGROUND = 0
+BACKGROUND = 1
+_STOP = 2
+
+
+class DBWorker:
+    """
+    Single background thread that executes submitted jobs in order.
+    Results are delivered through root.after polling, because Tk widgets
+    may only be touched from the thread running the mainloop.
+    """
+
+    def __init__(self, root, poll_ms=POLL_INTERVAL_MS):
+        self.__root = root
+        self.__poll_ms = poll_ms
+        self.__requests = queue.PriorityQueue()
+        self.__order = itertools.count()
+        self.__results = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, name="db-worker", daemon=True)
+        self.__thread.start()
+        self.__root.after(self.__poll_ms, self.__poll)
+
+    def submit(self, func, *args, callback=None, errback=None, **kwargs):
+        """
+        Queue func(*args, **kwargs) for the worker thread.
+        callback(result) or errback(exception) is later called on the Tk thread.
+        """
+        self.__put(FOREGROUND, (func, args, kwargs, callback, errback))
+
+    def submit_background(self, func, *args, callback=None, errback=None, **kwargs):
+        """Like submit(), but the job only runs when no user-initiated job is waiting."""
+        self.__put(BACKGROUND, (func, args, kwargs, callback, errback))
+
+    def stop(self):
+        """Finish queued jobs, then stop the worker thread."""
+        self.__put(_STOP, None)
+        self.__thread.join()
+
+    def __put(self, priority, request):
+        # The counter keeps jobs of equal priority in submission order
+        self.__requests.put((priority, next(self.__order), request))
+
+    def __run(self):
+        while True:
+            _, _, request = self.__requests.get()
+            if request is None:
+                return
+            func, args, kwargs, callback, errback = request
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if errback is None:
+                    traceback.print_exc()
+                self.__results.put((errback, e))
+            else:
+                self.__results.put((callback, result))
+
+    def __poll(self):
+        while True:
+            try:
+                handler, value = self.__results.get_nowait()
+            except queue.Empty:
+                break
+            if handler is not None:
+                try:
+                    handler(value)
+                except Exception:
+                    traceback.print_exc()
+        self.__root.after(self.__poll_ms, self.__poll)
@@ -0,0 +1,24 @@
+# conftest.py - Shared fixtures for the test suite
+# Every test that touches the database gets its own database file and blob
+# folder in a temp directory, so tests never see each other's rows.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import final_blobs
+import final_db
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point final_db and final_blobs at an empty database in tmp_path."""
+    final_db.close_all()
+    monkeypatch.setattr(final_db, "DB_PATH", str(tmp_path / "final.db"))
+    monkeypatch.setattr(final_db, "SHARD_COUNT", 1)
+    monkeypatch.setattr(final_blobs, "BLOB_DIR", str(tmp_path / "blob_store"))
+    yield tmp_path
+    final_db.close_all()
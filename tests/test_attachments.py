@@ -0,0 +1,68 @@
+import io
+import threading
+
+import pytest
+
+import final_blobs
+import final_db
+from final_objects import Post
+
+
+def png_bytes():
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 200), "red").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def add_inline_post(data, name="photo.png"):
+    """Store a post the way versions before the blob store did."""
+    post_id = final_db.insert_post(Post(user_id=1, content="old post"), [])
+    with final_db.transaction() as cursor:
+        cursor.execute("UPDATE Posts SET file_name_1 = ?, file_content_1 = ? WHERE post_id = ?",
+                       (name, data, post_id))
+    final_db.invalidate_post_cache(post_id)
+    return post_id
+
+
+def test_upgrade_moves_inline_files_and_builds_thumbnails(db):
+    data = png_bytes()
+    post_id = add_inline_post(data)
+
+    assert final_db.upgrade_attachments() == (1, 1)
+
+    [(name, handle)] = final_db.get_attached_files(post_id)
+    assert name == "photo.png" and handle.get_hash() is not None
+    assert handle.read() == data
+    assert final_db.get_thumbnail(handle.get_hash()) is not None
+    assert final_db.get_connection().execute(
+        "SELECT file_content_1 FROM Posts WHERE post_id = ?", (post_id,)).fetchone()[0] is None
+
+    # Nothing is left to do on the next start
+    assert final_db.upgrade_attachments() == (0, 0)
+
+
+def test_blob_files_are_written_outside_the_write_transaction(db, monkeypatch):
+    add_inline_post(b"legacy notes " * 50, "notes.txt")
+    write_blob = final_blobs.write_blob
+    depths = []
+
+    def recording_write_blob(*args, **kwargs):
+        depths.append(final_db._thread_state()[1][final_db.shard_path(0)])
+        return write_blob(*args, **kwargs)
+
+    monkeypatch.setattr(final_blobs, "write_blob", recording_write_blob)
+    assert final_db.migrate_inline_attachments() == 1
+    assert depths == [0]
+
+
+def test_stopped_upgrade_leaves_the_rest_for_later(db):
+    post_ids = [add_inline_post(b"legacy notes %d" % i, "notes.txt") for i in range(3)]
+    stop = threading.Event()
+    stop.set()
+
+    assert final_db.upgrade_attachments(stop) == (0, 0)
+    assert final_db.upgrade_attachments() == (3, 0)
+    for post_id in post_ids:
+        [(_, handle)] = final_db.get_attached_files(post_id)
+        assert handle.get_hash() is not None
@@ -0,0 +1,66 @@
+import pytest
+
+from final_bitmaps import _CHUNK, _HEADER, ARRAY_LIMIT, MAX_VALUE, Bitmap
+
+
+def round_trip(bitmap):
+    return Bitmap.from_bytes(bitmap.to_bytes())
+
+
+def first_chunk_kind(bitmap):
+    # 0 for a sorted array, 1 for a dense bitmap
+    return _CHUNK.unpack_from(bitmap.to_bytes(), _HEADER.size)[1]
+
+
+@pytest.mark.parametrize("size", [0, 1, ARRAY_LIMIT - 1, ARRAY_LIMIT, ARRAY_LIMIT + 1, 3 * ARRAY_LIMIT])
+def test_round_trip_around_the_array_limit(size):
+    values = list(range(0, 2 * size, 2))
+    bitmap = Bitmap(values)
+    copy = round_trip(bitmap)
+    if size:
+        assert first_chunk_kind(copy) == (0 if size <= ARRAY_LIMIT else 1)
+
+    assert len(copy) == size
+    assert list(copy) == values
+    assert copy.to_bytes() == bitmap.to_bytes()
+
+
+def test_round_trip_across_chunks():
+    values = [0, 1, 65535, 65536, 1 << 20, MAX_VALUE] + list(range(200000, 200000 + ARRAY_LIMIT + 10))
+    copy = round_trip(Bitmap(values))
+
+    assert list(copy) == sorted(values)
+    assert MAX_VALUE in copy and 2 not in copy and -1 not in copy
+
+
+def test_dense_chunk_shrinks_back_to_an_array():
+    bitmap = Bitmap(range(ARRAY_LIMIT + 1))
+    assert first_chunk_kind(round_trip(bitmap)) == 1
+    assert bitmap.discard(0) and not bitmap.discard(0)
+
+    copy = round_trip(bitmap)
+    assert first_chunk_kind(copy) == 0
+    assert list(copy) == list(range(1, ARRAY_LIMIT + 1))
+
+    # Values added after reloading go to the right place
+    assert copy.add(0) and not copy.add(0)
+    assert list(round_trip(copy)) == list(range(ARRAY_LIMIT + 1))
+
+
+def test_from_bytes_rejects_other_data():
+    with pytest.raises(ValueError):
+        Bitmap.from_bytes(b"not a bitmap")
+    for bitmap in (Bitmap(range(10)), Bitmap(range(ARRAY_LIMIT + 1))):
+        for cut in (1, 2, 4):
+            with pytest.raises(ValueError):
+                Bitmap.from_bytes(bitmap.to_bytes()[:-cut])
+    with pytest.raises(ValueError):
+        Bitmap.from_bytes(b"BM")
+
+
+def test_values_out_of_range():
+    bitmap = Bitmap()
+    with pytest.raises(ValueError):
+        bitmap.add(MAX_VALUE + 1)
+    with pytest.raises(ValueError):
+        bitmap.add(-1)
@@ -0,0 +1,69 @@
+import threading
+
+import final_blobs
+import final_db
+from final_objects import Post
+
+
+def test_shared_blob_survives_collection_in_another_shard(db, monkeypatch):
+    monkeypatch.setattr(final_db, "SHARD_COUNT", 2)
+    data = b"shared attachment " * 100
+    first = final_db.insert_post(Post(user_id=2, content="first"), [("a.txt", data)])
+    assert final_db.shard_for_post(first) == 0
+
+    # Delete the first post from another thread while the second post's
+    # transaction, which references the same blob, is still open
+    register_blob = final_blobs.register_blob
+
+    def register_then_delete(cursor, *stored):
+        register_blob(cursor, *stored)
+        thread = threading.Thread(target=final_db.delete_post, args=(first,))
+        thread.start()
+        thread.join()
+
+    monkeypatch.setattr(final_blobs, "register_blob", register_then_delete)
+    second = final_db.insert_post(Post(user_id=1, content="second"), [("a.txt", data)])
+    monkeypatch.setattr(final_blobs, "register_blob", register_blob)
+
+    [(name, handle)] = final_db.get_attached_files(second)
+    assert handle.read() == data
+
+
+def test_collection_waits_for_the_gc_lock(db):
+    post_id = final_db.insert_post(Post(user_id=1, content="x"), [("a.txt", b"only copy")])
+    [(_, handle)] = final_db.get_attached_files(post_id)
+
+    deleter = threading.Thread(target=final_db.delete_post, args=(post_id,))
+    with final_blobs.gc_lock():
+        deleter.start()
+        deleter.join(timeout=0.5)
+        assert deleter.is_alive()
+        assert final_blobs.find_blob(handle.get_hash()) is not None
+    deleter.join()
+    assert final_blobs.find_blob(handle.get_hash()) is None
+
+
+def test_file_that_cannot_be_removed_is_swept_later(db, monkeypatch):
+    post_id = final_db.insert_post(Post(user_id=1, content="x"), [("a.txt", b"still open")])
+    [(_, handle)] = final_db.get_attached_files(post_id)
+    blob_hash = handle.get_hash()
+
+    def locked_remove(path):
+        raise PermissionError(13, "The process cannot access the file", path)
+
+    # Windows refuses to remove a file that is still mapped
+    with monkeypatch.context() as patch:
+        patch.setattr(final_blobs.os, "remove", locked_remove)
+        final_db.delete_post(post_id)
+    assert final_blobs.find_blob(blob_hash) is not None
+
+    assert final_db.remove_orphan_blobs() == 1
+    assert final_blobs.find_blob(blob_hash) is None
+
+
+def test_orphan_sweep_keeps_referenced_blobs(db):
+    post_id = final_db.insert_post(Post(user_id=1, content="x"), [("a.txt", b"in use")])
+    [(_, handle)] = final_db.get_attached_files(post_id)
+
+    assert final_db.remove_orphan_blobs() == 0
+    assert handle.read() == b"in use"
@@ -0,0 +1,70 @@
+import json
+
+import final_bulk_import
+import final_codecs
+import final_db
+
+
+def write_manifest(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(lines):
+            f.write(json.dumps({"user_id": i + 1, "content": f"post {i}", "files": ["notes.txt"]}) + "\n")
+
+
+def count_posts():
+    return sum(final_db.fan_out(
+        lambda shard: final_db.get_connection(shard).execute("SELECT COUNT(*) FROM Posts").fetchone()[0]))
+
+
+def test_rerun_without_deferred_indexes_imports_nothing_twice(db):
+    (db / "notes.txt").write_text("hello")
+    manifest = db / "manifest.jsonl"
+    write_manifest(manifest, 10)
+
+    assert final_bulk_import.run_import(str(manifest), batch_size=4, workers=1) == 10
+    assert count_posts() == 10
+    assert final_bulk_import.load_progress(str(manifest))[:2] == (10, 10)
+
+    assert final_bulk_import.run_import(str(manifest), batch_size=4, workers=1) == 0
+    assert count_posts() == 10
+
+
+def test_resume_counts_only_new_posts(db, monkeypatch):
+    monkeypatch.setattr(final_db, "SHARD_COUNT", 2)
+    (db / "notes.txt").write_text("hello")
+    manifest = db / "manifest.jsonl"
+    write_manifest(manifest, 8)
+
+    # Shard 1 fails on the second batch after shard 0 has committed it
+    write_batch = final_bulk_import.write_batch
+    calls = []
+
+    def failing_write_batch(shard, *args):
+        calls.append(shard)
+        if shard == 1 and calls.count(1) == 2:
+            raise RuntimeError("disk full")
+        return write_batch(shard, *args)
+
+    monkeypatch.setattr(final_bulk_import, "write_batch", failing_write_batch)
+    try:
+        final_bulk_import.run_import(str(manifest), batch_size=4, workers=1)
+    except RuntimeError:
+        pass
+    monkeypatch.setattr(final_bulk_import, "write_batch", write_batch)
+    assert count_posts() == 6
+
+    # Only shard 1's two posts from the second batch are still missing
+    assert final_bulk_import.run_import(str(manifest), batch_size=4, workers=1) == 2
+    assert count_posts() == 8
+
+
+def test_imported_blobs_use_the_same_codec_as_the_app(db):
+    (db / "notes.dat").write_text("the same words again and again " * 200)
+    manifest = db / "manifest.jsonl"
+    manifest.write_text(json.dumps({"user_id": 1, "file_type": "Text", "files": ["notes.dat"]}) + "\n")
+
+    final_bulk_import.run_import(str(manifest), batch_size=10, workers=1)
+
+    codec, ref_count = final_db.get_connection().execute("SELECT codec, ref_count FROM Blobs").fetchone()
+    assert codec == final_codecs.choose_codec("notes.dat", "Text") == final_codecs.TEXT_CODEC
+    assert ref_count == 1
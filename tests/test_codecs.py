@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import final_codecs
+
+# Compresses very well, so one chunk of input expands to far more than a read asks for
+DATA = b"".join(b"line %d of a long and repetitive log file\n" % (i % 50) for i in range(200000))
+
+
+def write_compressed(path, codec, data=DATA):
+    compressor = final_codecs.get_codec(codec).compressor()
+    with open(path, "wb") as f:
+        for start in range(0, len(data), 100000):
+            f.write(compressor.compress(data[start:start + 100000]))
+        f.write(compressor.flush())
+
+
+@pytest.mark.parametrize("codec", sorted(final_codecs.CODECS))
+def test_partial_reads_return_the_original_bytes(tmp_path, codec):
+    path = os.path.join(tmp_path, "blob")
+    write_compressed(path, codec)
+
+    reader = final_codecs.DecompressingReader(path, codec)
+    buffer = bytearray(4096)
+    parts = []
+    while True:
+        n = reader.readinto(buffer)
+        assert n <= len(buffer)
+        if not n:
+            break
+        parts.append(bytes(buffer[:n]))
+    reader.close()
+    assert b"".join(parts) == DATA
+
+
+@pytest.mark.parametrize("codec", sorted(final_codecs.CODECS))
+def test_buffered_reader_reads_in_odd_sizes(tmp_path, codec):
+    path = os.path.join(tmp_path, "blob")
+    write_compressed(path, codec)
+
+    with final_codecs.open_reader(path, codec) as reader:
+        assert reader.read(7) == DATA[:7]
+        assert reader.read(100003) == DATA[7:100010]
+        assert reader.read() == DATA[100010:]
+        assert reader.read(10) == b""
+
+
+@pytest.mark.parametrize("codec", sorted(final_codecs.CODECS))
+def test_empty_blob(tmp_path, codec):
+    path = os.path.join(tmp_path, "blob")
+    write_compressed(path, codec, b"")
+
+    with final_codecs.open_reader(path, codec) as reader:
+        assert reader.read() == b""
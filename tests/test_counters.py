@@ -0,0 +1,121 @@
+import sqlite3
+import threading
+
+import pytest
+
+import final_db
+from final_objects import Post
+
+
+@pytest.fixture
+def buffer(db):
+    # Never flushes on its own while a test runs
+    counters = final_db.CounterBuffer(flush_threshold=10 ** 9, flush_interval=3600)
+    yield counters
+    counters.stop()
+
+
+def new_post():
+    return final_db.insert_post(Post(user_id=1, content="x"), [])
+
+
+def stored_counts(post_id):
+    return final_db.get_connection().execute(
+        "SELECT views, likes FROM Analytics WHERE post_id = ?", (post_id,)).fetchone()
+
+
+def event_total(post_id):
+    return final_db.get_connection().execute(
+        "SELECT COALESCE(SUM(n), 0) FROM Events WHERE post_id = ?", (post_id,)).fetchone()[0]
+
+
+def test_failed_flush_merges_the_deltas_back(buffer, monkeypatch):
+    post_id = new_post()
+    buffer.add(post_id, views=3)
+    buffer.set_liked(post_id, 5, True)
+
+    def broken_save(cursor, post_id, changes):
+        raise sqlite3.OperationalError("database is locked")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(final_db, "_save_likes", broken_save)
+        with pytest.raises(sqlite3.OperationalError):
+            buffer.flush()
+
+    # Nothing was written, and nothing was lost
+    assert stored_counts(post_id) == (0, 0)
+    assert event_total(post_id) == 0
+    assert buffer.pending_for(post_id) == (3, 1)
+    assert buffer.pending_like(post_id, 5) is True
+
+    assert buffer.flush() == 1
+    assert stored_counts(post_id) == (3, 1)
+    assert event_total(post_id) == 4
+    assert buffer.pending_for(post_id) == (0, 0)
+    assert buffer.pending_like(post_id, 5) is None
+
+
+def test_newer_like_change_wins_over_a_merged_back_one(buffer, monkeypatch):
+    post_id = new_post()
+    buffer.set_liked(post_id, 5, True)
+
+    def save_then_fail(cursor, pid, changes):
+        # The user takes the like back while the failing flush is running
+        thread = threading.Thread(target=buffer.set_liked, args=(post_id, 5, False))
+        thread.start()
+        thread.join()
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(final_db, "_save_likes", save_then_fail)
+        with pytest.raises(sqlite3.OperationalError):
+            buffer.flush()
+
+    assert buffer.pending_like(post_id, 5) is False
+    assert buffer.pending_for(post_id) == (0, 0)
+    buffer.flush()
+    assert stored_counts(post_id) == (0, 0)
+
+
+def test_add_during_flush_is_neither_lost_nor_counted_twice(buffer, monkeypatch):
+    post_id = new_post()
+    buffer.add(post_id, views=2)
+    buffer.set_liked(post_id, 5, True)
+    seen_during_flush = []
+    save_likes = final_db._save_likes
+
+    def save_with_concurrent_add(cursor, pid, changes):
+        # Another thread counts a view while this flush holds the write lock;
+        # it must not wait for the flush
+        thread = threading.Thread(target=buffer.add, args=(post_id,), kwargs={"views": 1})
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        seen_during_flush.append(buffer.pending_for(post_id))
+        save_likes(cursor, pid, changes)
+
+    monkeypatch.setattr(final_db, "_save_likes", save_with_concurrent_add)
+    assert buffer.flush() == 1
+
+    # Before the commit the in-flight deltas and the new view are both pending
+    assert seen_during_flush == [(3, 1)]
+    assert stored_counts(post_id) == (2, 1)
+    assert buffer.pending_for(post_id) == (1, 0)
+
+    monkeypatch.setattr(final_db, "_save_likes", save_likes)
+    buffer.flush()
+    assert stored_counts(post_id) == (3, 1)
+    assert buffer.pending_for(post_id) == (0, 0)
+    assert event_total(post_id) == 4
+
+
+def test_read_through_sees_each_delta_once(buffer):
+    post_id = new_post()
+    buffer.add(post_id, views=4)
+
+    def total():
+        return stored_counts(post_id)[0] + buffer.pending_for(post_id)[0]
+
+    assert buffer.read_through(total) == 4
+    buffer.flush()
+    assert buffer.read_through(total) == 4
@@ -0,0 +1,27 @@
+import io
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+final_main = pytest.importorskip("final_main")
+import final_blobs
+
+
+class TrackedStream(io.BytesIO):
+    closed_by_caller = False
+
+    def close(self):
+        self.closed_by_caller = True
+        super().close()
+
+
+def test_preview_closes_the_blob_stream():
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), "blue").save(buffer, "PNG")
+    stream = TrackedStream(buffer.getvalue())
+    handle = final_blobs.BlobHandle(size=len(buffer.getvalue()), opener=lambda: stream)
+
+    image = final_main.load_preview_image(handle)
+
+    assert stream.closed_by_caller
+    assert max(image.size) <= max(final_main.THUMB_SIZE)
@@ -0,0 +1,83 @@
+import sqlite3
+import time
+
+import final_db
+import final_schema
+
+# The tables as the first version of the app created them (schema version 0)
+BASELINE = """
+    CREATE TABLE Posts (
+        post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        file_type TEXT,
+        content TEXT,
+        post_DateTime TEXT,
+        file_name_1 TEXT,
+        file_content_1 BLOB,
+        file_name_2 TEXT,
+        file_content_2 BLOB,
+        file_name_3 TEXT,
+        file_content_3 BLOB,
+        comments TEXT
+    );
+    CREATE TABLE Analytics (
+        post_id INTEGER,
+        likes INTEGER DEFAULT 0,
+        views INTEGER DEFAULT 0,
+        comments TEXT
+    );
+"""
+
+
+def make_baseline_db(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(BASELINE)
+    conn.execute("""
+        INSERT INTO Posts (post_id, user_id, file_type, content, post_DateTime,
+                           file_name_1, file_content_1, file_name_2, file_name_3, comments)
+        VALUES (1, 7, 'Text', 'hello world', '2024-03-01 09:30:00',
+                'notes.txt', ?, 'none.txt', 'none.txt', 'first' || char(13, 10) || 'second')
+    """, (b"inline notes",))
+    conn.execute("""
+        INSERT INTO Posts (post_id, user_id, file_type, content, post_DateTime)
+        VALUES (2, 8, 'Image', 'no analytics yet', '2024-03-02 18:00:00')
+    """)
+    # A duplicate analytics row for post 1 and one for a post that was deleted
+    conn.executemany("INSERT INTO Analytics (post_id, likes, views) VALUES (?, ?, ?)",
+                     [(1, 2, 10), (1, 3, 12), (99, 1, 1)])
+    return conn
+
+
+def test_baseline_database_migrates_to_the_latest_version(tmp_path):
+    conn = make_baseline_db(str(tmp_path / "old.db"))
+    assert final_schema.get_version(conn) == 0
+
+    assert final_schema.migrate(conn) == final_schema.LATEST_VERSION
+    assert final_schema.get_version(conn) == final_schema.LATEST_VERSION
+
+    assert conn.execute("SELECT post_id, likes, views, comment_count FROM Analytics ORDER BY post_id").fetchall() \
+        == [(1, 3, 12, 2), (2, 0, 0, 0)]
+    assert conn.execute("SELECT body FROM Comments WHERE post_id = 1 ORDER BY comment_id").fetchall() \
+        == [("first",), ("second",)]
+    assert conn.execute("SELECT comments FROM Posts WHERE post_id = 1").fetchone()[0] is None
+    post_ts = conn.execute("SELECT post_ts FROM Posts WHERE post_id = 1").fetchone()[0]
+    assert post_ts == int(time.mktime(time.strptime("2024-03-01 09:30:00", "%Y-%m-%d %H:%M:%S")))
+    assert conn.execute("SELECT rowid FROM PostSearch WHERE PostSearch MATCH 'hello'").fetchall()
+
+    # Migrating again changes nothing
+    assert final_schema.migrate(conn) == final_schema.LATEST_VERSION
+    conn.close()
+
+
+def test_app_reads_and_upgrades_a_baseline_database(db):
+    make_baseline_db(final_db.DB_PATH).close()
+
+    post = final_db.get_post_by_id(1)
+    assert post.get_content() == "hello world"
+    [(name, handle)] = final_db.get_attached_files(1)
+    assert name == "notes.txt" and handle.get_hash() is None
+    assert handle.read() == b"inline notes"
+
+    assert final_db.upgrade_attachments() == (1, 0)
+    [(name, handle)] = final_db.get_attached_files(1)
+    assert handle.get_hash() is not None and handle.read() == b"inline notes"
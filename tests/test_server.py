@@ -0,0 +1,56 @@
+import asyncio
+import io
+
+import pytest
+
+import final_server
+
+
+class FailingStream(io.BytesIO):
+    def read(self, size=-1):
+        if self.tell():
+            raise OSError("disk read error")
+        return super().read(4)
+
+
+async def fetch(port, path):
+    """Send one keep-alive GET and return everything read until the server closes."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: test\r\n\r\n".encode())
+    await writer.drain()
+    data = await asyncio.wait_for(reader.read(), timeout=5)
+    writer.close()
+    return data
+
+
+def run_server(coroutine_factory):
+    async def main():
+        api = final_server.APIServer(workers=2)
+        server = await asyncio.start_server(api.handle_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await coroutine_factory(port)
+        finally:
+            server.close()
+            await server.wait_closed()
+            api.close()
+    return asyncio.run(main())
+
+
+def test_failed_download_closes_the_connection(monkeypatch):
+    monkeypatch.setattr(final_server, "open_attachment",
+                        lambda post_id, slot: ("a.txt", 100, FailingStream(b"x" * 100)))
+
+    response = run_server(lambda port: fetch(port, "/posts/1/files/1"))
+
+    head, body = response.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200")
+    # The connection was closed after the partial body, with no error JSON appended
+    assert body == b"xxxx"
+
+
+def test_int_param_without_upper_bound():
+    with pytest.raises(final_server.HTTPError, match="after_id must be at least 0"):
+        final_server._int_param({"after_id": ["-1"]}, "after_id", 0)
+    with pytest.raises(final_server.HTTPError, match="limit must be between 1 and 200"):
+        final_server._int_param({"limit": ["500"]}, "limit", 20, 1, 200)